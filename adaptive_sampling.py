@@ -0,0 +1,294 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+自适应（序贯）评估抽样
+按随机顺序评估轨迹，持续更新各维度的均值和bootstrap置信区间，
+置信区间宽度达到目标、或A/B两组的差异已显著时提前停止，不再评估剩余文件。
+差异显著性按维度数做 Bonferroni 校正，并把显著性水平分摊到各次查看（alpha spending），
+无论查看多少次、检验多少个维度，误判"存在显著差异"而提前停止的概率都不超过 1 - confidence
+"""
+
+import os
+import math
+import queue
+import random
+import threading
+from statistics import NormalDist
+
+import numpy as np
+
+from judge_pool import STOP, run_pool_sync
+from results_store import DIMENSIONS, ResultsStore
+
+CONFIDENCE = 0.95
+N_BOOTSTRAP = 2000
+CHECK_EVERY = 10  # 每新增多少个分数检查一次停止条件
+
+
+def t_critical(alpha, df):
+    """双侧t检验的临界值（正态分位数的 Cornish-Fisher 展开，df>=10时误差小于1%）"""
+    z = NormalDist().inv_cdf(1 - alpha / 2)
+    return (z + (z ** 3 + z) / (4 * df) + (5 * z ** 5 + 16 * z ** 3 + 3 * z) / (96 * df ** 2)
+            + (3 * z ** 7 + 19 * z ** 5 + 17 * z ** 3 - 15 * z) / (384 * df ** 3))
+
+
+class SequentialEstimator:
+    """
+    各组各维度分数的在线估计
+
+    反复查看结果、同时检验多个维度都会放大第一类错误：每隔 check_every 个分数才查看一次，
+    第k次查看的显著性水平为 (1 - confidence) * 6 / (π²k²)（对所有k求和恰为 1 - confidence），
+    再除以维度数（Bonferroni）；差异检验为Welch t检验，
+    因此整个序贯过程中误报显著差异的概率不超过 1 - confidence（默认5%）。
+    置信区间宽度只用于判断精度是否足够，按名义置信水平计算
+    """
+
+    def __init__(self, arms, ci_width=0.5, confidence=CONFIDENCE, min_samples=30,
+                 n_bootstrap=N_BOOTSTRAP, check_every=CHECK_EVERY, seed=42):
+        self.arms = list(arms)
+        self.ci_width = ci_width
+        self.confidence = confidence
+        self.min_samples = min_samples
+        self.n_bootstrap = n_bootstrap
+        self.check_every = check_every
+        self.rng = np.random.default_rng(seed)
+        self.values = {arm: {dim: [] for dim in DIMENSIONS} for arm in self.arms}
+        self.added = 0
+        self.looks = 0
+        self.lock = threading.Lock()
+        self.stop_reason = None
+
+    def count(self, arm):
+        return len(self.values[arm][DIMENSIONS[0]])
+
+    def add(self, arm, scores):
+        """加入一条轨迹的分数，返回是否满足停止条件"""
+        with self.lock:
+            for dim in DIMENSIONS:
+                if scores.get(dim) is not None:
+                    self.values[arm][dim].append(float(scores[dim]))
+            self.added += 1
+            if self.stop_reason is None and self.added % self.check_every == 0:
+                self.stop_reason = self.check()
+            return self.stop_reason is not None
+
+    def bootstrap_means(self, values):
+        """对均值做bootstrap重抽样，返回 n_bootstrap 个重抽样均值"""
+        data = np.asarray(values, dtype=float)
+        index = self.rng.integers(0, len(data), size=(self.n_bootstrap, len(data)))
+        return data[index].mean(axis=1)
+
+    def interval(self, samples):
+        tail = (1 - self.confidence) / 2 * 100
+        low, high = np.percentile(samples, [tail, 100 - tail])
+        return float(low), float(high)
+
+    def summary(self):
+        """各组各维度的样本数、均值和置信区间"""
+        result = {}
+        for arm in self.arms:
+            result[arm] = {}
+            for dim in DIMENSIONS:
+                values = self.values[arm][dim]
+                if len(values) < 2:
+                    result[arm][dim] = {'n': len(values), 'mean': float(np.mean(values)) if values else None,
+                                        'ci': None, 'width': None}
+                    continue
+                low, high = self.interval(self.bootstrap_means(values))
+                result[arm][dim] = {'n': len(values), 'mean': float(np.mean(values)),
+                                    'ci': (low, high), 'width': high - low}
+        return result
+
+    def look_alpha(self, look):
+        """第 look 次查看（从1开始）每个维度的显著性水平"""
+        return (1 - self.confidence) * 6 / (math.pi ** 2 * max(look, 1) ** 2) / len(DIMENSIONS)
+
+    def difference(self):
+        """
+        A/B两组各维度均值差（B-A）、bootstrap置信区间（名义置信水平）和显著性
+
+        significant 按当前查看次数校正后的显著性水平 alpha 判断
+        """
+        if len(self.arms) != 2:
+            return {}
+        a, b = self.arms
+        alpha = self.look_alpha(self.looks)
+        result = {}
+        for dim in DIMENSIONS:
+            va, vb = self.values[a][dim], self.values[b][dim]
+            if len(va) < 2 or len(vb) < 2:
+                continue
+            diffs = self.bootstrap_means(vb) - self.bootstrap_means(va)
+            low, high = self.interval(diffs)
+            diff = float(np.mean(vb) - np.mean(va))
+            sa, sb = np.var(va, ddof=1) / len(va), np.var(vb, ddof=1) / len(vb)
+            se = math.sqrt(sa + sb)
+            if se > 0:
+                # Welch-Satterthwaite 自由度
+                df = (sa + sb) ** 2 / (sa ** 2 / (len(va) - 1) + sb ** 2 / (len(vb) - 1))
+                significant = abs(diff) > t_critical(alpha, max(df, 1.0)) * se
+            else:
+                significant = diff != 0
+            result[dim] = {'diff': diff, 'ci': (low, high), 'width': high - low,
+                           'significant': bool(significant), 'alpha': alpha}
+        return result
+
+    def check(self):
+        """返回停止原因；未满足停止条件时返回None"""
+        if min(self.count(arm) for arm in self.arms) < self.min_samples:
+            return None
+        self.looks += 1
+        if len(self.arms) == 2:
+            diff = self.difference()
+            significant = [dim for dim, d in diff.items() if d['significant']]
+            if significant:
+                return f"significant difference on {', '.join(significant)}"
+            if diff and all(d['width'] <= self.ci_width for d in diff.values()):
+                return f"difference CI width <= {self.ci_width} on all dimensions"
+            return None
+        summary = self.summary()[self.arms[0]]
+        if all(s['width'] is not None and s['width'] <= self.ci_width for s in summary.values()):
+            return f"CI width <= {self.ci_width} on all dimensions"
+        return None
+
+
+def interleave(orders):
+    """轮流从各组中取文件，使两组的样本数同步增长"""
+    result = []
+    for i in range(max(len(order) for order in orders)):
+        for arm, order in enumerate(orders):
+            if i < len(order):
+                result.append((arm, order[i]))
+    return result
+
+
+def run_adaptive(stores, folders, file_lists, judge_fn, commit_fn, max_workers=8, requests_per_second=None,
+                 ci_width=0.5, confidence=CONFIDENCE, min_samples=30, seed=42):
+    """
+    自适应评估一组或两组（A/B）轨迹
+
+    参数:
+        stores (list): 每组的 ResultsStore
+        folders (list): 每组的输入目录
+        file_lists (list): 每组待评估的JSON文件名；结果库中已评分的文件也作为候选，按随机顺序复用其分数
+        judge_fn (callable): judge_fn(file_path) -> 与 eval.judge_file 相同格式的结果
+        commit_fn (callable): commit_fn(store, file_name, result)，写入结果库
+
+    返回:
+        dict: 停止原因、各组估计、A/B差异以及评估调用次数和节省的调用次数
+    """
+    arms = [os.path.basename(os.path.normpath(folder)) or folder for folder in folders]
+    if len(arms) == 2 and arms[0] == arms[1]:
+        arms = ['A', 'B']
+    estimator = SequentialEstimator(arms, ci_width, confidence, min_samples, seed=seed)
+
+    rng = random.Random(seed)
+    cached = [store.scored_results() for store in stores]
+    orders = []
+    for files, scored in zip(file_lists, cached):
+        order = sorted(set(files) | set(scored))
+        rng.shuffle(order)
+        orders.append(order)
+    candidates = interleave(orders)
+    uncached_total = sum(1 for arm, name in candidates if name not in cached[arm])
+
+    stop_event = threading.Event()
+    work_queue = queue.Queue(maxsize=max(1, max_workers))
+    counters = {'calls': 0, 'reused': 0, 'failed': 0}
+
+    def feed():
+        # 按随机顺序投放任务；已评分的文件直接复用分数，不调用评估
+        try:
+            for arm, name in candidates:
+                if stop_event.is_set():
+                    break
+                if name in cached[arm]:
+                    counters['reused'] += 1
+                    if estimator.add(arms[arm], cached[arm][name]):
+                        stop_event.set()
+                    continue
+                while not stop_event.is_set():
+                    try:
+                        work_queue.put((arm, name), timeout=1.0)
+                        break
+                    except queue.Full:
+                        continue
+        finally:
+            if stop_event.is_set():
+                # 已满足停止条件，丢弃尚未开始的任务
+                try:
+                    while True:
+                        work_queue.get_nowait()
+                except queue.Empty:
+                    pass
+            work_queue.put(STOP)
+
+    def on_result(item, result, error):
+        arm, name = item
+        if error is not None:
+            print(f"Error processing file {name}: {str(error)}")
+            return
+        counters['calls'] += 1
+        commit_fn(stores[arm], name, result)
+        if result.get('failed'):
+            # 评估调用失败时没有真实分数，不计入估计
+            counters['failed'] += 1
+            return
+        if result['scores'] is not None and estimator.add(arms[arm], result['scores']):
+            if not stop_event.is_set():
+                print(f"Stopping early: {estimator.stop_reason}")
+            stop_event.set()
+
+    feeder = threading.Thread(target=feed, daemon=True)
+    feeder.start()
+    stats = run_pool_sync(work_queue, lambda item: judge_fn(os.path.join(folders[item[0]], item[1])), on_result,
+                          concurrency=max_workers, rate=requests_per_second)
+    feeder.join()
+
+    if estimator.stop_reason is None:
+        estimator.stop_reason = estimator.check() or 'all files evaluated'
+    return {
+        'stop_reason': estimator.stop_reason,
+        'confidence': confidence,
+        'arms': arms,
+        'summary': estimator.summary(),
+        'difference': estimator.difference(),
+        'looks': estimator.looks,
+        'judge_calls': counters['calls'],
+        'failed_calls': counters['failed'],
+        'reused_scores': counters['reused'],
+        'candidate_files': len(candidates),
+        'calls_saved': uncached_total - counters['calls'],
+        'elapsed': stats['elapsed'],
+    }
+
+
+def open_arm_store(folder):
+    """对照组的结果库放在其输入目录下"""
+    return ResultsStore(os.path.join(folder, 'results.db'))
+
+
+def print_adaptive_report(report):
+    """打印自适应评估结果"""
+    print("\n========== 自适应评估结果 ==========")
+    print(f"停止原因: {report['stop_reason']}")
+    for arm in report['arms']:
+        print(f"\n[{arm}]")
+        for dim, s in report['summary'][arm].items():
+            if s['ci'] is None:
+                print(f"  {dim}: n={s['n']}, 样本不足")
+                continue
+            print(f"  {dim}: n={s['n']}, 均值 {s['mean']:.2f}, "
+                  f"{report['confidence'] * 100:.0f}%置信区间 [{s['ci'][0]:.2f}, {s['ci'][1]:.2f}]")
+    if report['difference']:
+        a, b = report['arms']
+        print(f"\n均值差 ({b} - {a})，共查看 {report['looks']} 次，校正后每维度显著性水平 "
+              f"{next(iter(report['difference'].values()))['alpha']:.2g}"
+              f"（整体误报显著差异的概率不超过 {(1 - report['confidence']) * 100:.0f}%）:")
+        for dim, d in report['difference'].items():
+            mark = '显著' if d['significant'] else '不显著'
+            print(f"  {dim}: {d['diff']:+.2f}, 名义{report['confidence'] * 100:.0f}%置信区间 "
+                  f"[{d['ci'][0]:+.2f}, {d['ci'][1]:+.2f}]，{mark}")
+    print(f"\n候选文件: {report['candidate_files']}, 评估调用: {report['judge_calls']} "
+          f"（失败 {report['failed_calls']}，不计入估计）, "
+          f"复用已有分数: {report['reused_scores']}, 节省评估调用: {report['calls_saved']}")
@@ -0,0 +1,254 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+多接口/多密钥的API请求路由
+把请求分发到多条路由（接口地址+密钥+可选模型），每条路由有各自的权重、最大并发数和每秒请求数；
+按加权最少未完成请求选择路由，滑动时间窗口内错误率过高的路由被临时摘除（多次摘除时时间加倍），
+某条路由失败时自动换一条重试，结束时输出每条路由的请求数、错误率、延迟和吞吐量
+
+路由配置为JSON列表，示例见 configs/api_routes_example.json:
+    [{"name": "main", "api_base": "https://...", "api_key": "sk-...", "model": null,
+      "weight": 2, "max_concurrent": 8, "rps": 4}]
+"""
+
+import json
+import time
+import threading
+from collections import deque
+
+from hedging import percentile
+
+WINDOW_SECONDS = 60.0      # 计算错误率的滑动时间窗口
+MIN_REQUESTS = 5           # 窗口内请求数不少于该值才判断是否摘除
+ERROR_THRESHOLD = 0.5      # 窗口内错误率达到该值时摘除
+EJECT_SECONDS = 30.0       # 首次摘除时长，之后每次加倍
+MAX_EJECT_SECONDS = 300.0
+MAX_EJECTED_SHARE = 0.5    # 同时被摘除的路由最多占比，避免全部摘除
+
+
+CHAT_PATH = '/chat/completions'
+
+
+def chat_url(api_base):
+    """接口地址补全为 chat/completions 地址"""
+    api_base = api_base.rstrip('/')
+    return api_base if api_base.endswith(CHAT_PATH) else api_base + CHAT_PATH
+
+
+class Route:
+    """一条路由及其统计"""
+
+    def __init__(self, name, api_base, api_key, model=None, weight=1.0, max_concurrent=8, rps=None):
+        if weight <= 0 or max_concurrent < 1:
+            raise ValueError(f"路由 {name} 的 weight 须大于0、max_concurrent 须不小于1")
+        self.name = name
+        # 统一保存为不含 /chat/completions 的接口地址（eval.py 的 API_URL 是完整地址）
+        api_base = api_base.rstrip('/')
+        self.api_base = api_base[:-len(CHAT_PATH)] if api_base.endswith(CHAT_PATH) else api_base
+        self.api_key = api_key
+        self.model = model
+        self.weight = float(weight)
+        self.max_concurrent = max_concurrent
+        self.rps = rps
+        # 令牌桶，容量为最大并发数
+        self.tokens = float(max_concurrent)
+        self.updated = time.monotonic()
+
+        self.outstanding = 0
+        self.started = 0
+        self.successes = 0
+        self.failures = 0
+        self.total_tokens = 0
+        self.latencies = []
+        self.window = deque()  # (完成时间, 是否成功)
+        self.ejected_until = 0.0
+        self.ejections = 0
+
+    def endpoint(self, default_model):
+        """(接口地址, API密钥, 模型名称)，与 get_qwen_output.make_api_request 的 endpoint 参数一致"""
+        return self.api_base, self.api_key, self.model or default_model
+
+    def _refill(self, now):
+        if self.rps:
+            self.tokens = min(self.max_concurrent, self.tokens + (now - self.updated) * self.rps)
+        self.updated = now
+
+    def ready_in(self, now):
+        """距离可以发起下一个请求的秒数：并发已满时为None，否则为等待令牌的时间"""
+        if self.outstanding >= self.max_concurrent:
+            return None
+        if not self.rps:
+            return 0.0
+        self._refill(now)
+        return 0.0 if self.tokens >= 1 else (1 - self.tokens) / self.rps
+
+    def error_rate(self):
+        return sum(1 for _, ok in self.window if not ok) / len(self.window) if self.window else 0.0
+
+
+class ApiRouter:
+    """
+    加权最少未完成请求路由
+
+    参数:
+        routes (list[Route]): 路由列表
+        window_seconds, min_requests, error_threshold: 滑动窗口内请求数不少于 min_requests 且错误率达到阈值时摘除
+        eject_seconds (float): 首次摘除时长，同一路由再次被摘除时加倍，不超过 max_eject_seconds
+        max_ejected_share (float): 同时被摘除的路由数上限占比；只有一条路由时不会摘除
+    """
+
+    def __init__(self, routes, window_seconds=WINDOW_SECONDS, min_requests=MIN_REQUESTS,
+                 error_threshold=ERROR_THRESHOLD, eject_seconds=EJECT_SECONDS, max_eject_seconds=MAX_EJECT_SECONDS,
+                 max_ejected_share=MAX_EJECTED_SHARE):
+        if not routes:
+            raise ValueError("至少需要一条路由")
+        self.routes = list(routes)
+        self.window_seconds = window_seconds
+        self.min_requests = min_requests
+        self.error_threshold = error_threshold
+        self.eject_seconds = eject_seconds
+        self.max_eject_seconds = max_eject_seconds
+        self.max_ejected_share = max_ejected_share
+        self.condition = threading.Condition()
+        self.start_time = time.monotonic()
+        self.failovers = 0
+
+    def _healthy(self, candidates, now):
+        healthy = [route for route in candidates if route.ejected_until <= now]
+        # 全部被摘除时退回最早恢复的路由，不让请求失败
+        return healthy or [min(candidates, key=lambda route: route.ejected_until)]
+
+    def acquire(self, exclude=()):
+        """选择一条路由并占用一个并发名额，所有路由都已满或限速时等待"""
+        with self.condition:
+            while True:
+                now = time.monotonic()
+                candidates = [route for route in self.routes if route not in exclude] or self.routes
+                healthy = self._healthy(candidates, now)
+                waits = [(route.ready_in(now), route) for route in healthy]
+                ready = [route for wait, route in waits if wait == 0.0]
+                if ready:
+                    # 未完成请求数按权重折算，相同时把请求按权重轮流分给各路由
+                    route = min(ready, key=lambda r: ((r.outstanding + 1) / r.weight, r.started / r.weight))
+                    route.outstanding += 1
+                    route.started += 1
+                    if route.rps:
+                        route.tokens -= 1
+                    return route
+                timeouts = [wait for wait, _ in waits if wait is not None]
+                self.condition.wait(timeout=min(timeouts) if timeouts else None)
+
+    def release(self, route, ok, latency=None, tokens=0):
+        """记录一次请求的结果并释放并发名额；错误率过高时摘除该路由"""
+        with self.condition:
+            now = time.monotonic()
+            route.outstanding -= 1
+            if ok:
+                route.successes += 1
+                route.total_tokens += tokens or 0
+            else:
+                route.failures += 1
+            if latency is not None:
+                route.latencies.append(latency)
+            route.window.append((now, ok))
+            while route.window and route.window[0][0] < now - self.window_seconds:
+                route.window.popleft()
+            if not ok and len(route.window) >= self.min_requests and route.error_rate() >= self.error_threshold:
+                self._eject(route, now)
+            self.condition.notify_all()
+
+    def _eject(self, route, now):
+        ejected = sum(1 for r in self.routes if r.ejected_until > now)
+        if route.ejected_until > now or ejected + 1 > self.max_ejected_share * len(self.routes):
+            return
+        duration = min(self.eject_seconds * 2 ** route.ejections, self.max_eject_seconds)
+        print(f"路由 {route.name} 最近 {len(route.window)} 个请求错误率 {route.error_rate() * 100:.0f}%，"
+              f"摘除 {duration:.0f} 秒")
+        route.ejected_until = now + duration
+        route.ejections += 1
+        route.window.clear()
+
+    def call(self, fn, is_success=bool, max_attempts=None, backoff=1.0, tokens=None):
+        """
+        通过路由执行一次请求，失败时换一条路由重试
+
+        参数:
+            fn (callable): fn(route) -> result，发送一次请求（不在内部重试）
+            is_success (callable): 判断结果是否成功
+            max_attempts (int): 最多尝试次数，默认为路由数+1
+            backoff (float): 所有路由都失败过一轮后，下一轮之前等待的秒数（逐轮加倍）
+            tokens (callable): 从结果中取出token用量，计入路由的吞吐量
+
+        返回:
+            最后一次尝试的结果
+        """
+        max_attempts = max_attempts or len(self.routes) + 1
+        tried, result, error = [], None, None
+        for attempt in range(max_attempts):
+            if attempt and len(tried) >= len(self.routes):
+                time.sleep(backoff * 2 ** (attempt // len(self.routes) - 1))
+                tried = []
+            route = self.acquire(exclude=tried)
+            start = time.monotonic()
+            try:
+                result, error = fn(route), None
+                ok = is_success(result)
+            except Exception as e:
+                result, error, ok = None, e, False
+            self.release(route, ok, time.monotonic() - start, tokens(result) if ok and tokens else 0)
+            if ok:
+                return result
+            tried.append(route)
+            if attempt + 1 < max_attempts:
+                with self.condition:
+                    self.failovers += 1
+        if error is not None:
+            raise error
+        return result
+
+    def report(self):
+        """每条路由的请求数、错误率、摘除次数、延迟分位数和吞吐量"""
+        with self.condition:
+            elapsed = max(time.monotonic() - self.start_time, 1e-9)
+            routes = []
+            for route in self.routes:
+                requests = route.successes + route.failures
+                routes.append({
+                    'name': route.name,
+                    'weight': route.weight,
+                    'requests': requests,
+                    'successes': route.successes,
+                    'failures': route.failures,
+                    'error_rate': route.failures / requests if requests else 0.0,
+                    'ejections': route.ejections,
+                    'latency_p50': percentile(route.latencies, 0.5),
+                    'latency_p95': percentile(route.latencies, 0.95),
+                    'requests_per_minute': route.successes / elapsed * 60,
+                    'tokens_per_second': route.total_tokens / elapsed,
+                })
+            return {'elapsed': elapsed, 'failovers': self.failovers, 'routes': routes}
+
+
+def load_routes(path, **kwargs):
+    """从JSON文件读取路由配置并创建 ApiRouter，kwargs 传给 ApiRouter"""
+    with open(path, 'r', encoding='utf-8') as f:
+        config = json.load(f)
+    routes = [Route(item.get('name') or f"route{i}", item['api_base'], item['api_key'], item.get('model'),
+                    item.get('weight', 1.0), item.get('max_concurrent', 8), item.get('rps'))
+              for i, item in enumerate(config)]
+    return ApiRouter(routes, **kwargs)
+
+
+def print_router_report(report, title="API路由统计"):
+    """打印每条路由的统计"""
+    def fmt(value):
+        return f"{value:.2f}" if value is not None else "-"
+
+    print(f"\n========== {title} ==========")
+    print(f"运行 {report['elapsed']:.0f} 秒，换路由重试 {report['failovers']} 次")
+    print(f"{'路由':<14}{'权重':>6}{'请求':>8}{'错误率':>9}{'摘除':>6}{'p50(秒)':>9}{'p95(秒)':>9}"
+          f"{'成功/分钟':>11}{'tokens/秒':>11}")
+    for route in report['routes']:
+        print(f"{route['name']:<14}{route['weight']:>6.1f}{route['requests']:>8}{route['error_rate'] * 100:>8.1f}%"
+              f"{route['ejections']:>6}{fmt(route['latency_p50']):>9}{fmt(route['latency_p95']):>9}"
+              f"{route['requests_per_minute']:>11.1f}{route['tokens_per_second']:>11.1f}")
@@ -0,0 +1,366 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+训练数据清洗与校验
+替代 data_process.ipynb 中的 fix_json_in_tags / fix_escaped_quotes：在 <tool_call>、<tool_response>、<think> 标签内
+去掉多余的引号转义，内容是JSON时统一格式；每条样本按对话格式校验，通过的写入 clean 分片，未通过的连同原因写入 rejected 分片。
+多进程按块处理，正则预编译，最后输出各规则的命中次数和每秒处理条数
+
+用法:
+    python clean_dataset.py --input_file lora_finetune_dataset_functioncall.jsonl --output_dir autodl-tmp/datas/cleaned
+    训练时设置 data.path=autodl-tmp/datas/cleaned/clean-*.jsonl
+"""
+
+import os
+import re
+import ast
+import json
+import time
+import argparse
+from collections import Counter
+from multiprocessing import Pool
+
+TAGS = ('tool_call', 'tool_response', 'think')
+TAG_BLOCK = re.compile(r'(<(tool_call|tool_response|think)>)(.*?)(</\2>)', re.DOTALL)
+OPEN_TAG = re.compile(r'<(tool_call|tool_response|think)>')
+CLOSE_TAG = re.compile(r'</(tool_call|tool_response|think)>')
+ESCAPED_QUOTE = re.compile(r"""\\(['"])""")
+
+ROLES = {'system', 'user', 'human', 'assistant', 'model', 'tool'}
+ASSISTANT_ROLES = {'assistant', 'model'}
+CHUNK_LINES = 2000
+SHARD_RECORDS = 100000
+REPORT_FILE = 'clean_report.json'
+SAMPLE_FILE = 'configs/clean_sample.jsonl'  # 真实数据集中的一条样本（runft.ipynb 输出），用于 --check
+
+# 清洗规则，统计命中次数
+RULES = ('unescape_quotes', 'tag_json_format', 'python_literal', 'steps_json')
+# 拒绝原因
+REASONS = ('invalid_json', 'no_messages', 'bad_message', 'bad_role', 'empty_content', 'no_assistant',
+           'unbalanced_tags', 'tool_call_json')
+
+
+class RejectedSample(Exception):
+    """样本不符合对话格式，reason 为 REASONS 之一"""
+
+    def __init__(self, reason, detail=''):
+        super().__init__(f"{reason}: {detail}" if detail else reason)
+        self.reason = reason
+        self.detail = detail
+
+
+def parse_structured(content):
+    """
+    解析标签内的结构化内容
+
+    返回:
+        (对象, 格式)：格式为 'json' 或 'python'（数据集中的工具调用是 Python 字典字面量，如 {'name': ...}）；
+        无法解析时对象为None
+    """
+    try:
+        return json.loads(content), 'json'
+    except json.JSONDecodeError:
+        pass
+    try:
+        value = ast.literal_eval(content)
+    except (ValueError, SyntaxError, MemoryError, RecursionError):
+        return None, None
+    return (value, 'python') if isinstance(value, (dict, list)) else (None, None)
+
+
+def clean_text(text, hits, strict=True):
+    """
+    清洗一段文本中的标签内容
+
+    <tool_call> 内容先按原样解析（JSON或Python字面量），解析失败时才去掉引号转义再解析，仍失败时拒绝；
+    JSON 统一格式，Python 字面量保持原样。strict 为False时（system 提示词中的空标签或格式占位）不拒绝
+    """
+    if '<' not in text:
+        return text
+    opened, closed = Counter(OPEN_TAG.findall(text)), Counter(CLOSE_TAG.findall(text))
+    if opened != closed:
+        tag = next(t for t in TAGS if opened[t] != closed[t])
+        raise RejectedSample('unbalanced_tags', f"<{tag}> {opened[tag]}个, </{tag}> {closed[tag]}个")
+
+    def process_tag_content(match):
+        content = match.group(3)
+        stripped = content.strip()
+        if stripped[:1] not in ('{', '['):
+            if match.group(2) == 'tool_call' and strict:
+                raise RejectedSample('tool_call_json', stripped[:50])
+            content, count = ESCAPED_QUOTE.subn(r'\1', content)
+            if count:
+                hits['unescape_quotes'] += 1
+            return match.group(1) + content + match.group(4)
+
+        value, kind = parse_structured(stripped)
+        if kind is None:
+            unescaped = ESCAPED_QUOTE.sub(r'\1', stripped)
+            value, kind = parse_structured(unescaped) if unescaped != stripped else (None, None)
+            if kind is not None:
+                hits['unescape_quotes'] += 1
+                content = stripped = unescaped
+        if kind == 'json':
+            formatted = json.dumps(value, ensure_ascii=False)
+            if formatted != content:
+                hits['tag_json_format'] += 1
+            content = formatted
+        elif kind == 'python':
+            hits['python_literal'] += 1
+        elif match.group(2) == 'tool_call' and strict:
+            raise RejectedSample('tool_call_json', stripped[:50])
+        return match.group(1) + content + match.group(4)
+
+    return TAG_BLOCK.sub(process_tag_content, text)
+
+
+def clean_steps(content, hits):
+    """model 角色的结构化内容（含 steps 列表的JSON）逐步清洗各字段；不是这种格式时返回None"""
+    if not content.lstrip().startswith('{'):
+        return None
+    try:
+        content_dict = json.loads(content)
+    except json.JSONDecodeError:
+        return None
+    if not isinstance(content_dict, dict) or not isinstance(content_dict.get('steps'), list):
+        return None
+    for step in content_dict['steps']:
+        if not isinstance(step, dict):
+            raise RejectedSample('bad_message', "steps 中有非字典的元素")
+        for key in TAGS:
+            if isinstance(step.get(key), str):
+                step[key] = clean_text(step[key], hits)
+    hits['steps_json'] += 1
+    return json.dumps(content_dict, ensure_ascii=False)
+
+
+def clean_record(sample, hits):
+    """
+    校验并清洗一条样本（conversation 或 messages 格式），返回清洗后的样本
+
+    异常:
+        RejectedSample: 样本不符合对话格式
+    """
+    if not isinstance(sample, dict):
+        raise RejectedSample('no_messages', "样本不是JSON对象")
+    key = 'messages' if 'messages' in sample else 'conversation'
+    messages = sample.get(key)
+    if not isinstance(messages, list) or not messages:
+        raise RejectedSample('no_messages', "缺少 conversation/messages 列表")
+
+    cleaned = []
+    for i, message in enumerate(messages):
+        if not isinstance(message, dict) or not isinstance(message.get('content'), str):
+            raise RejectedSample('bad_message', f"第{i}条消息缺少字符串类型的 content")
+        role = message.get('role')
+        if role not in ROLES:
+            raise RejectedSample('bad_role', f"第{i}条消息的角色为 {role!r}")
+        if role == 'system' and i != 0:
+            raise RejectedSample('bad_role', "system 消息不在第一条")
+        content = message['content']
+        if not content.strip() and role != 'system':
+            raise RejectedSample('empty_content', f"第{i}条消息（{role}）内容为空")
+        if role == 'model':
+            steps = clean_steps(content, hits)
+            content = steps if steps is not None else clean_text(content, hits)
+        else:
+            content = clean_text(content, hits, strict=role != 'system')
+        cleaned.append(dict(message, content=content))
+
+    if cleaned[-1]['role'] not in ASSISTANT_ROLES:
+        raise RejectedSample('no_assistant', "最后一条消息不是 assistant")
+    return dict(sample, **{key: cleaned})
+
+
+def clean_chunk(chunk):
+    """
+    清洗一块行（在子进程中执行）
+
+    参数:
+        chunk: (起始行号, 行列表)
+
+    返回:
+        dict: clean（清洗后的行）、rejected（拒绝记录）、hits（规则命中次数）
+    """
+    start, lines = chunk
+    hits = Counter()
+    clean, rejected = [], []
+    for offset, line in enumerate(lines):
+        if not line.strip():
+            continue
+        try:
+            try:
+                sample = json.loads(line)
+            except json.JSONDecodeError as e:
+                raise RejectedSample('invalid_json', str(e))
+            clean.append(json.dumps(clean_record(sample, hits), ensure_ascii=False))
+        except RejectedSample as e:
+            rejected.append({'line': start + offset + 1, 'reason': e.reason, 'detail': e.detail,
+                             'raw': line.rstrip('\r\n')})
+    return {'clean': clean, 'rejected': rejected, 'hits': hits}
+
+
+def read_chunks(input_file, chunk_lines=CHUNK_LINES):
+    """按块读取源文件，避免一次读入整个文件"""
+    with open(input_file, 'r', encoding='utf-8', errors='replace') as f:
+        chunk, start = [], 0
+        for index, line in enumerate(f):
+            chunk.append(line)
+            if len(chunk) >= chunk_lines:
+                yield start, chunk
+                chunk, start = [], index + 1
+        if chunk:
+            yield start, chunk
+
+
+class ShardWriter:
+    """按条数切分写出 {prefix}-00000.jsonl、{prefix}-00001.jsonl ..."""
+
+    def __init__(self, output_dir, prefix, shard_records=SHARD_RECORDS):
+        self.output_dir = output_dir
+        self.prefix = prefix
+        self.shard_records = shard_records
+        self.file = None
+        self.shards = []
+        self.count = 0
+
+    def write(self, line):
+        if self.file is None or self.count % self.shard_records == 0:
+            self.close()
+            path = os.path.join(self.output_dir, f"{self.prefix}-{len(self.shards):05d}.jsonl")
+            self.file = open(path, 'w', encoding='utf-8')
+            self.shards.append(path)
+        self.file.write(line + '\n')
+        self.count += 1
+
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+
+
+def run_cleaning(input_file, output_dir, workers=None, shard_records=SHARD_RECORDS, chunk_lines=CHUNK_LINES):
+    """
+    多进程清洗整个文件，写出 clean-*.jsonl、rejected-*.jsonl 和 clean_report.json
+
+    返回:
+        dict: 条数、各规则命中次数、各拒绝原因条数和处理速度
+    """
+    os.makedirs(output_dir, exist_ok=True)
+    for name in os.listdir(output_dir):
+        if name.startswith(('clean-', 'rejected-')) and name.endswith('.jsonl'):
+            os.remove(os.path.join(output_dir, name))
+
+    workers = workers or os.cpu_count() or 1
+    start_time = time.time()
+    hits, reasons = Counter({rule: 0 for rule in RULES}), Counter()
+    clean_writer = ShardWriter(output_dir, 'clean', shard_records)
+    rejected_writer = ShardWriter(output_dir, 'rejected', shard_records)
+    with Pool(processes=workers) as pool:
+        for result in pool.imap(clean_chunk, read_chunks(input_file, chunk_lines)):
+            for line in result['clean']:
+                clean_writer.write(line)
+            for record in result['rejected']:
+                rejected_writer.write(json.dumps(record, ensure_ascii=False))
+                reasons[record['reason']] += 1
+            hits.update(result['hits'])
+    clean_writer.close()
+    rejected_writer.close()
+
+    elapsed = time.time() - start_time
+    records = clean_writer.count + rejected_writer.count
+    report = {
+        'input_file': input_file,
+        'output_dir': output_dir,
+        'records': records,
+        'clean': clean_writer.count,
+        'rejected': rejected_writer.count,
+        'rule_hits': dict(hits),
+        'reject_reasons': dict(reasons.most_common()),
+        'workers': workers,
+        'seconds': elapsed,
+        'records_per_second': records / elapsed if elapsed > 0 else 0.0,
+        'clean_shards': [os.path.basename(path) for path in clean_writer.shards],
+        'rejected_shards': [os.path.basename(path) for path in rejected_writer.shards],
+    }
+    with open(os.path.join(output_dir, REPORT_FILE), 'w', encoding='utf-8') as f:
+        json.dump(report, f, ensure_ascii=False, indent=2)
+    return report
+
+
+def print_clean_report(report):
+    """打印清洗统计"""
+    print("\n========== 数据清洗 ==========")
+    print(f"源文件: {report['input_file']}, 共 {report['records']} 条")
+    rate = report['clean'] / report['records'] * 100 if report['records'] else 0.0
+    print(f"通过: {report['clean']} 条 ({rate:.1f}%), 拒绝: {report['rejected']} 条")
+    print(f"用时 {report['seconds']:.1f}秒, {report['records_per_second']:.0f} 条/秒 ({report['workers']} 个进程)")
+    print("规则命中次数:")
+    for rule, count in report['rule_hits'].items():
+        print(f"  {rule:<20}{count:>10}")
+    if report['reject_reasons']:
+        print("拒绝原因:")
+        for reason, count in report['reject_reasons'].items():
+            print(f"  {reason:<20}{count:>10}")
+    print(f"输出目录: {report['output_dir']}（{len(report['clean_shards'])} 个clean分片, "
+          f"{len(report['rejected_shards'])} 个rejected分片）")
+
+
+def check_sample_format(sample_file=SAMPLE_FILE):
+    """
+    用真实数据集的样本检查清洗规则：样本应全部通过，含转义引号的合法JSON工具调用应原样保留
+
+    返回:
+        bool: 是否全部通过
+    """
+    hits, failures = Counter(), 0
+    with open(sample_file, 'r', encoding='utf-8') as f:
+        samples = [json.loads(line) for line in f if line.strip()]
+    for index, sample in enumerate(samples, 1):
+        try:
+            clean_record(sample, hits)
+        except RejectedSample as e:
+            failures += 1
+            print(f"样本 {index} 被拒绝: {e}")
+
+    expected = {'name': 'query_location_info', 'arguments': {'q': 'he said "hi"'}}
+    text = f"<tool_call>{json.dumps(expected, ensure_ascii=False)}</tool_call>"
+    try:
+        cleaned = json.loads(TAG_BLOCK.search(clean_text(text, hits)).group(3))
+    except (RejectedSample, json.JSONDecodeError) as e:
+        cleaned = str(e)
+    if cleaned != expected:
+        failures += 1
+        print(f"含转义引号的JSON工具调用被改坏: {cleaned}")
+
+    print(f"检查 {sample_file}: {len(samples)} 条样本 + 1 条转义引号用例, 失败 {failures} 条, 规则命中 {dict(hits)}")
+    return failures == 0
+
+
+def main():
+    parser = argparse.ArgumentParser(description="多进程清洗并校验对话格式的JSONL训练数据")
+    parser.add_argument("--input_file", type=str, default=None,
+                        help="源JSONL文件")
+    parser.add_argument("--output_dir", type=str, default=None,
+                        help="输出目录，写入 clean-*.jsonl、rejected-*.jsonl 和 clean_report.json")
+    parser.add_argument("--workers", type=int, default=None,
+                        help="进程数，默认为CPU核数")
+    parser.add_argument("--shard_records", type=int, default=SHARD_RECORDS,
+                        help="每个输出分片的条数")
+    parser.add_argument("--chunk_lines", type=int, default=CHUNK_LINES,
+                        help="每次交给子进程的行数")
+    parser.add_argument("--check", action="store_true",
+                        help=f"只用真实数据样本（{SAMPLE_FILE}）检查清洗规则，不处理 --input_file")
+    args = parser.parse_args()
+
+    if args.check:
+        raise SystemExit(0 if check_sample_format() else 1)
+    if not args.input_file or not args.output_dir:
+        parser.error("需要 --input_file 和 --output_dir（或使用 --check）")
+
+    print_clean_report(run_cleaning(args.input_file, args.output_dir, args.workers, args.shard_records,
+                                    args.chunk_lines))
+
+
+if __name__ == "__main__":
+    main()
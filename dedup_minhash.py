@@ -0,0 +1,294 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+生成轨迹的近似重复检测与多样性统计
+对 model_response 做字符n-gram分片(shingle)，计算MinHash签名，再用LSH分段(banding)找出候选对，
+只比较落入同一桶的轨迹，整体复杂度近似线性；输出重复簇和多样性指标，并可在评估前去掉重复轨迹
+"""
+
+import os
+import re
+import csv
+import json
+import math
+import zlib
+import argparse
+from collections import Counter
+from multiprocessing import Pool
+
+import numpy as np
+
+SHINGLE_SIZE = 5
+NUM_PERM = 128
+THRESHOLD = 0.8
+SEED = 42
+DIVERSITY_SAMPLE = 2000  # 计算成对相似度和distinct-n时抽样的轨迹数
+
+WHITESPACE = re.compile(r'[\s*#]+')
+DIGITS = re.compile(r'\d')
+
+_MASK_DIGITS = False
+
+
+def normalize(text, mask_digits=False):
+    """去掉空白和markdown符号；mask_digits 为True时把数字统一替换为0，只比较文本结构"""
+    text = WHITESPACE.sub(' ', text or '').strip()
+    if mask_digits:
+        text = DIGITS.sub('0', text)
+    return text
+
+
+def shingle_hashes(text, k=SHINGLE_SIZE):
+    """字符k-gram的32位哈希（去重后）"""
+    if len(text) <= k:
+        return np.array([zlib.crc32(text.encode('utf-8'))], dtype=np.uint64)
+    return np.fromiter({zlib.crc32(text[i:i + k].encode('utf-8')) for i in range(len(text) - k + 1)},
+                       dtype=np.uint64)
+
+
+def make_permutations(num_perm=NUM_PERM, seed=SEED):
+    """multiply-shift 哈希族的参数：h(x) = ((a*x + b) mod 2^64) >> 32"""
+    rng = np.random.default_rng(seed)
+    a = rng.integers(1, 2 ** 63, size=num_perm, dtype=np.uint64) | np.uint64(1)
+    b = rng.integers(0, 2 ** 63, size=num_perm, dtype=np.uint64)
+    return a, b
+
+
+def minhash(hashes, a, b):
+    """一个文档的MinHash签名（uint32数组）"""
+    with np.errstate(over='ignore'):
+        values = (hashes[None, :] * a[:, None] + b[:, None]) >> np.uint64(32)
+    return values.min(axis=1).astype(np.uint32)
+
+
+def _init_worker(mask_digits):
+    global _MASK_DIGITS
+    _MASK_DIGITS = mask_digits
+
+
+def signature_for_file(task):
+    """读取一个对话文件并计算签名（在子进程中执行）；不是对话文件时返回None"""
+    folder, file_name, keep_shingles = task
+    try:
+        with open(os.path.join(folder, file_name), 'r', encoding='utf-8') as f:
+            data = json.load(f)
+    except (OSError, json.JSONDecodeError):
+        return None
+    if not isinstance(data, dict) or 'model_response' not in data:
+        return None
+
+    hashes = shingle_hashes(normalize(data.get('model_response'), _MASK_DIGITS))
+    a, b = make_permutations()
+    return {
+        'file': file_name,
+        'id': data.get('id'),
+        'user_prompt': data.get('user_prompt'),
+        'signature': minhash(hashes, a, b),
+        'shingles': hashes if keep_shingles else None,
+    }
+
+
+def choose_bands(threshold, num_perm=NUM_PERM):
+    """
+    选择分段数b和每段行数r（b*r=num_perm）
+
+    取S曲线转折点 (1/b)^(1/r) 不高于阈值的最大者：宁可多出候选（之后用签名相似度确认），也不漏掉重复
+    """
+    options = [(b, num_perm // b) for b in range(1, num_perm + 1) if num_perm % b == 0]
+    below = [br for br in options if (1 / br[0]) ** (1 / br[1]) <= threshold]
+    return max(below or options[-1:], key=lambda br: (1 / br[0]) ** (1 / br[1]))
+
+
+class UnionFind:
+    def __init__(self, n):
+        self.parent = list(range(n))
+
+    def find(self, x):
+        root = x
+        while self.parent[root] != root:
+            root = self.parent[root]
+        while self.parent[x] != root:
+            self.parent[x], x = root, self.parent[x]
+        return root
+
+    def union(self, x, y):
+        rx, ry = self.find(x), self.find(y)
+        if rx != ry:
+            self.parent[max(rx, ry)] = min(rx, ry)
+
+
+def find_clusters(signatures, threshold=THRESHOLD):
+    """
+    LSH分段找候选，再用签名估计的Jaccard相似度确认
+
+    每个桶内只与桶中第一条比较，候选比较次数与轨迹数近似线性
+
+    返回:
+        tuple: (每条轨迹的簇编号数组, 确认的相似对数量)
+    """
+    n, num_perm = signatures.shape
+    bands, rows = choose_bands(threshold, num_perm)
+    uf = UnionFind(n)
+    confirmed = 0
+    for band in range(bands):
+        chunk = np.ascontiguousarray(signatures[:, band * rows:(band + 1) * rows])
+        keys = chunk.view(np.dtype((np.void, chunk.dtype.itemsize * rows))).ravel()
+        _, inverse, counts = np.unique(keys, return_inverse=True, return_counts=True)
+        order = np.argsort(inverse.ravel(), kind='stable')
+        starts = np.concatenate(([0], np.cumsum(counts)[:-1]))
+        for bucket in np.flatnonzero(counts > 1):
+            members = order[starts[bucket]:starts[bucket] + counts[bucket]]
+            head, rest = members[0], members[1:]
+            similarity = (signatures[rest] == signatures[head]).mean(axis=1)
+            for other in rest[similarity >= threshold]:
+                if uf.find(head) != uf.find(other):
+                    uf.union(head, other)
+                    confirmed += 1
+    roots = np.array([uf.find(i) for i in range(n)])
+    return roots, confirmed
+
+
+def diversity_metrics(docs, roots, sample=DIVERSITY_SAMPLE, seed=SEED):
+    """多样性指标：去重后占比、最大簇、抽样成对相似度、distinct-n 和提示词分布"""
+    n = len(docs)
+    sizes = Counter(roots.tolist())
+    if not n:
+        return {'trajectories': 0, 'clusters': 0, 'unique_ratio': 0.0, 'duplicates': 0, 'duplicate_clusters': 0,
+                'largest_cluster': 0, 'mean_pairwise_similarity': None, 'distinct_shingle_ratio': None,
+                'distinct_prompts': 0, 'prompt_entropy_bits': 0.0}
+    rng = np.random.default_rng(seed)
+    signatures = np.stack([d['signature'] for d in docs])
+
+    pair_count = min(sample * 5, n * (n - 1) // 2) if n > 1 else 0
+    mean_similarity = None
+    if pair_count:
+        left = rng.integers(0, n, size=pair_count)
+        right = rng.integers(0, n, size=pair_count)
+        keep = left != right
+        if keep.any():
+            mean_similarity = float((signatures[left[keep]] == signatures[right[keep]]).mean())
+
+    sampled = [d['shingles'] for d in docs if d['shingles'] is not None]
+    total_shingles = sum(len(s) for s in sampled)
+    distinct_n = len(np.unique(np.concatenate(sampled))) / total_shingles if total_shingles else None
+
+    prompts = Counter(d['user_prompt'] for d in docs)
+    entropy = -sum(c / n * math.log2(c / n) for c in prompts.values()) if n else 0.0
+
+    return {
+        'trajectories': n,
+        'clusters': len(sizes),
+        'unique_ratio': len(sizes) / n if n else 0.0,
+        'duplicates': n - len(sizes),
+        'duplicate_clusters': sum(1 for size in sizes.values() if size > 1),
+        'largest_cluster': max(sizes.values()) if sizes else 0,
+        'mean_pairwise_similarity': mean_similarity,
+        'distinct_shingle_ratio': distinct_n,
+        'distinct_prompts': len(prompts),
+        'prompt_entropy_bits': entropy,
+    }
+
+
+def run_dedup(folder, file_names=None, threshold=THRESHOLD, workers=None, mask_digits=False,
+              prefer=None, sample=DIVERSITY_SAMPLE, seed=SEED):
+    """
+    对目录中的对话文件去重
+
+    参数:
+        prefer (set): 优先作为簇代表保留的文件（如已评估的文件），其余按文件名排序取第一条
+
+    返回:
+        dict: clusters（[代表, 重复文件...] 列表，只含大小>1的簇）、duplicates（{重复文件: 代表}）、
+              assignments（每个文件的簇信息）、metrics（多样性指标）
+    """
+    if file_names is None:
+        file_names = sorted(f for f in os.listdir(folder) if f.endswith('.json'))
+    rng = np.random.default_rng(seed)
+    keep = set(rng.choice(len(file_names), size=min(sample, len(file_names)), replace=False).tolist()) \
+        if file_names else set()
+    tasks = [(folder, name, i in keep) for i, name in enumerate(file_names)]
+
+    workers = workers or os.cpu_count() or 1
+    with Pool(processes=workers, initializer=_init_worker, initargs=(mask_digits,)) as pool:
+        docs = [d for d in pool.imap(signature_for_file, tasks, chunksize=64) if d is not None]
+    if not docs:
+        return {'clusters': [], 'duplicates': {}, 'assignments': [], 'metrics': diversity_metrics([], np.array([]))}
+
+    roots, confirmed = find_clusters(np.stack([d['signature'] for d in docs]), threshold)
+    prefer = prefer or set()
+    members = {}
+    for index, root in enumerate(roots.tolist()):
+        members.setdefault(root, []).append(docs[index]['file'])
+
+    clusters, duplicates, assignments = [], {}, []
+    for cluster_id, files in enumerate(sorted(members.values(), key=lambda f: (-len(f), f[0]))):
+        files.sort(key=lambda f: (f not in prefer, f))
+        representative = files[0]
+        if len(files) > 1:
+            clusters.append(files)
+        for name in files:
+            if name != representative:
+                duplicates[name] = representative
+            assignments.append({'file': name, 'cluster_id': cluster_id, 'cluster_size': len(files),
+                                'representative': representative, 'is_duplicate': name != representative})
+
+    metrics = diversity_metrics(docs, roots, sample, seed)
+    metrics['similar_pairs_confirmed'] = confirmed
+    metrics['threshold'] = threshold
+    return {'clusters': clusters, 'duplicates': duplicates, 'assignments': assignments, 'metrics': metrics}
+
+
+def save_assignments(assignments, output_file):
+    """保存每个文件的簇编号、簇大小、代表文件和是否为重复"""
+    with open(output_file, 'w', newline='', encoding='utf-8') as f:
+        writer = csv.DictWriter(f, fieldnames=['file', 'cluster_id', 'cluster_size', 'representative', 'is_duplicate'])
+        writer.writeheader()
+        writer.writerows(sorted(assignments, key=lambda a: (a['cluster_id'], a['file'])))
+    print(f"Cluster assignments saved to {output_file}")
+
+
+def print_dedup_report(result, top=10):
+    """打印重复簇和多样性指标"""
+    m = result['metrics']
+    print("\n========== 近似重复与多样性 ==========")
+    print(f"轨迹数: {m['trajectories']}, 簇数: {m['clusters']} (去重后占比 {m['unique_ratio'] * 100:.1f}%), "
+          f"重复轨迹: {m['duplicates']}, 重复簇: {m['duplicate_clusters']}, 最大簇: {m['largest_cluster']}")
+    if m['mean_pairwise_similarity'] is not None:
+        print(f"抽样成对Jaccard相似度均值: {m['mean_pairwise_similarity']:.3f}")
+    if m['distinct_shingle_ratio'] is not None:
+        print(f"distinct-{SHINGLE_SIZE}（抽样）: {m['distinct_shingle_ratio']:.3f}")
+    print(f"不同提示词: {m['distinct_prompts']}, 提示词熵: {m['prompt_entropy_bits']:.2f} bits")
+    for files in result['clusters'][:top]:
+        preview = ', '.join(files[:5]) + (' ...' if len(files) > 5 else '')
+        print(f"  簇大小 {len(files)}: {preview}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="MinHash LSH 近似重复检测与多样性统计")
+    parser.add_argument("--input_folder", type=str, default="/root/for_eval",
+                        help="对话JSON文件所在目录")
+    parser.add_argument("--threshold", type=float, default=THRESHOLD,
+                        help="判定为近似重复的Jaccard相似度阈值")
+    parser.add_argument("--workers", type=int, default=None,
+                        help="计算签名的进程数，默认为CPU核数")
+    parser.add_argument("--mask_digits", action="store_true",
+                        help="比较前把数字统一替换，忽略时间和坐标的差异")
+    parser.add_argument("--output", type=str, default=None,
+                        help="保存每个文件簇信息的CSV路径")
+    parser.add_argument("--json", type=str, default=None,
+                        help="将多样性指标和重复簇另存为JSON文件")
+    args = parser.parse_args()
+
+    result = run_dedup(args.input_folder, threshold=args.threshold, workers=args.workers,
+                       mask_digits=args.mask_digits)
+    print_dedup_report(result)
+    if args.output:
+        save_assignments(result['assignments'], args.output)
+    if args.json:
+        with open(args.json, 'w', encoding='utf-8') as f:
+            json.dump({'metrics': result['metrics'], 'clusters': result['clusters']}, f, ensure_ascii=False, indent=2)
+        print(f"报告已保存到: {args.json}")
+
+
+if __name__ == "__main__":
+    main()
@@ -4,7 +4,14 @@ import csv
 import requests
 import time
 import re
+import argparse
 from datetime import datetime
+from usage_report import empty_usage, extract_usage
+from judge_pool import run_pool_sync
+from hedging import HedgedCaller, print_hedging_report
+from api_router import chat_url, load_routes, print_router_report
+from response_cache import ResponseCache, make_key, print_cache_report
+from results_store import ResultsStore, STATUS_DUPLICATE, STATUS_FAILED, STATUS_REJECTED
 
 # API Configuration
 API_URL = "https:XXXXXXXXXXXXXXXX"
@@ -12,7 +19,15 @@ API_KEY = "sk-XXXXXXXXXXXXXXXXXX"
 REQUEST_TIMEOUT = 30  # 设置请求超时时间为30秒
 RETRY_COUNT = 3  # 请求失败时重试次数
 RETRY_DELAY = 5  # 重试间隔秒数
-PROCESSED_FILES_LOG = "/root/for_eval/processed_files.txt"  # 已处理文件的记录
+MAX_WORKERS = 8  # 并发评估的最大请求数
+REQUESTS_PER_SECOND = 4  # 每秒最多发起的评估请求数
+PROCESSED_FILES_LOG = "/root/for_eval/processed_files.txt"  # 旧版已处理文件记录，仅在首次使用数据库时导入
+RESULTS_DB = "/root/for_eval/results.db"  # 评估结果数据库
+JUDGE_HEDGER = None  # 启用对冲请求时的 HedgedCaller（见 enable_hedging）
+RESPONSE_CACHE_DB = "/root/for_eval/response_cache.db"  # 评估响应缓存
+RESPONSE_CACHE = None  # 启用缓存时的 ResponseCache
+JUDGE_ROUTER = None  # 启用多接口/多密钥路由时的 ApiRouter（见 api_router.py）
+JUDGE_TEMPERATURE = 0.6
 
 EVALUATION_PROMPT = """你是一位对上海市陆家嘴地区人群行为活动有深入了解的专业活动链评估专家，擅长识别虚假、杜撰或不符合实际的活动链内容。请严格根据以下四个维度对提供的活动链进行0-10分的评估，特别关注以下问题：时间安排过于规整或不合理、地点经纬度反复使用或与实际情况不符、活动内容明显虚构（如工作人群频繁出现旅游或休闲活动）等。对于存在上述问题的内容，请务必大幅扣分。
 
@@ -70,114 +85,188 @@ def ensure_directory_exists(file_path):
         os.makedirs(directory)
         print(f"Created directory: {directory}")
 
-def get_processed_files():
-    """读取已处理文件列表"""
-    if not os.path.exists(PROCESSED_FILES_LOG):
-        ensure_directory_exists(PROCESSED_FILES_LOG)
-        return set()
-    
-    with open(PROCESSED_FILES_LOG, 'r', encoding='utf-8') as f:
-        return set(line.strip() for line in f.readlines())
-
-def mark_as_processed(file_name):
-    """将文件标记为已处理"""
-    ensure_directory_exists(PROCESSED_FILES_LOG)
-    with open(PROCESSED_FILES_LOG, 'a', encoding='utf-8') as f:
-        f.write(f"{file_name}\n")
-    print(f"Marked {file_name} as processed")
-
-def setup_csv(output_file):
-    """设置CSV文件并添加表头"""
-    fieldnames = ['id', '时间逻辑一致性', '活动目的连贯性', '人物画像匹配度', '活动真实性与丰富度']
-    
-    ensure_directory_exists(output_file)
-    file_exists = os.path.isfile(output_file)
-    
-    with open(output_file, 'a', newline='', encoding='utf-8') as f:
-        writer = csv.DictWriter(f, fieldnames=fieldnames)
-        if not file_exists:
-            writer.writeheader()
-    
-    return fieldnames
-
 def extract_assistant_content(json_data):
     """从模型响应中提取完整的模型响应内容"""
     if 'model_response' in json_data:
         return json_data['model_response']
     return None
 
-def evaluate_activity_chain(activity_chain, model="gpt-4o-mini-2024-07-18"):
-    """发送活动链到API进行评估，包含重试机制"""
-    headers = {
-        'Authorization': f'Bearer {API_KEY}',
-        'Content-Type': 'application/json'
-    }
+def estimate_rubric_tokens(activity_chain, prompt_tokens):
+    """按字符比例估算输入token中评估提示词(rubric)所占的token数"""
+    rubric_chars = len(EVALUATION_PROMPT.replace('{activity_chain}', ''))
+    total_chars = rubric_chars + len(activity_chain)
+    if total_chars == 0:
+        return 0
+    return int(round(prompt_tokens * rubric_chars / total_chars))
+
+def evaluate_activity_chain(activity_chain, model="gpt-4o-mini-2024-07-18", usage_out=None):
+    """发送活动链到API进行评估，包含重试机制
+
+    usage_out 为字典时，会写入本次请求的token用量、耗时和重试次数
+    """
+    prompt = EVALUATION_PROMPT.format(activity_chain=activity_chain)
+    content = send_judge_request(prompt, model, usage_out)
+    if usage_out is not None:
+        usage_out['rubric_tokens_est'] = estimate_rubric_tokens(activity_chain, usage_out['prompt_tokens'])
+    return content
+
+def enable_hedging(budget=0.1, hedge_model=None, hedge_url=None, hedge_key=None):
+    """启用评估请求对冲：超过运行中的p95延迟仍未返回时，向备用模型/接口（默认与主接口相同）再发一次"""
+    global JUDGE_HEDGER
+    
+    def attempt(prompt, model, api_url=None, api_key=None):
+        usage = {}
+        # 缓存已在发起对冲前查询过，这里只写入不再查询
+        # 未指定接口时仍交给 send_judge_request 选择（启用路由时经路由发送）
+        content = send_judge_request(prompt, model, usage, api_url, api_key, use_cache=False, hedge=False)
+        return content, usage
+    
+    JUDGE_HEDGER = HedgedCaller(
+        attempt,
+        lambda prompt, model: attempt(prompt, hedge_model or model, hedge_url, hedge_key),
+        is_success=lambda result: bool(result[0]),
+        budget=budget,
+    )
+    return JUDGE_HEDGER
+
+def send_judge_request(prompt, model="gpt-4o-mini-2024-07-18", usage_out=None, api_url=None, api_key=None,
+                       use_cache=True, hedge=True):
+    """将完整的评估提示词作为system消息发送到API，返回模型回复文本，包含重试机制
+
+    启用响应缓存时，内容完全相同的请求直接返回缓存结果（不消耗tokens）；
+    启用对冲且未指定接口时，由 JUDGE_HEDGER 发送主请求并在必要时对冲；
+    启用路由且未指定接口时，由 JUDGE_ROUTER 为每次尝试选择接口（见 api_router.py）
+    """
+    usage = empty_usage(model)
+    start_time = time.time()
+    if usage_out is not None:
+        usage_out.update(usage)
     
     messages = [
-        {"role": "system", "content": EVALUATION_PROMPT.format(activity_chain=activity_chain)}
+        {"role": "system", "content": prompt}
     ]
     
+    cache_key = None
+    if RESPONSE_CACHE is not None:
+        cache_key = make_key(api_url or API_URL, model, messages, {"temperature": JUDGE_TEMPERATURE})
+        cached = RESPONSE_CACHE.get(cache_key) if use_cache else None
+        if cached is not None:
+            usage['cache_hit'] = True
+            usage['latency'] = time.time() - start_time
+            if usage_out is not None:
+                usage_out.update(usage)
+            print("Evaluation served from response cache")
+            return cached['choices'][0]['message']['content']
+    
+    if JUDGE_HEDGER is not None and api_url is None and hedge:
+        content, usage = JUDGE_HEDGER.call(prompt, model)
+        if usage_out is not None:
+            usage_out.update(usage)
+        return content
+    
     payload = {
         "messages": messages,
         "model": model,
-        "temperature": 0.6,
+        "temperature": JUDGE_TEMPERATURE,
         "stream": False
     }
     
-    for attempt in range(RETRY_COUNT):
-        try:
+    if JUDGE_ROUTER is not None and api_url is None:
+        def routed_attempt(route):
+            usage['attempts'] += 1
+            usage['route'] = route.name
+            usage['model'] = route.model or model
+            print(f"\nEvaluating activity chain via route {route.name}... (Attempt {usage['attempts']})")
+            # 缓存键按请求的模型计算，路由使用其他模型时的回复不写入缓存，避免以后当作该模型的结果命中
+            route_cache_key = cache_key if usage['model'] == model else None
+            return post_judge_request(chat_url(route.api_base), route.api_key, dict(payload, model=usage['model']),
+                                      usage, usage_out, start_time, route_cache_key)
+        
+        # 每次尝试由路由选择接口，失败时换一条路由重试
+        content = JUDGE_ROUTER.call(routed_attempt, is_success=lambda result: result is not None,
+                                    max_attempts=RETRY_COUNT + len(JUDGE_ROUTER.routes) - 1, backoff=RETRY_DELAY,
+                                    tokens=lambda result: usage['total_tokens'])
+        if content is not None:
+            return content
+        attempts = usage['attempts']
+    else:
+        attempts = RETRY_COUNT
+        for attempt in range(RETRY_COUNT):
             print(f"\nEvaluating activity chain... (Attempt {attempt+1}/{RETRY_COUNT})")
-            response = requests.post(API_URL, headers=headers, json=payload, timeout=REQUEST_TIMEOUT)
+            usage['attempts'] = attempt + 1
+            content = post_judge_request(api_url or API_URL, api_key or API_KEY, payload, usage, usage_out,
+                                         start_time, cache_key)
+            if content is not None:
+                return content
             
-            if response.status_code == 200:
-                try:
-                    response_json = response.json()
-                    print(f"Response structure keys: {list(response_json.keys())}")
-                    
-                    # 标准OpenAI API格式
-                    if 'choices' in response_json and len(response_json['choices']) > 0:
-                        if 'message' in response_json['choices'][0]:
-                            content = response_json['choices'][0]['message']['content']
-                            print("Evaluation complete!")
-                            print(f"Content: {content}")
-                            return content
-                    
-                    # 替代格式
-                    if 'model_response' in response_json:
-                        content = response_json['model_response']
-                        if 'assistant\n' in content:
-                            extracted_content = content.split('assistant\n', 1)[1].strip()
-                            print("Evaluation complete!")
-                            print(f"Content: {extracted_content}")
-                            return extracted_content
-                        else:
-                            print("Evaluation complete!")
-                            print(f"Content: {content}")
-                            return content
-                    
-                    print(f"Unexpected response format. Response contains keys: {list(response_json.keys())}")
-                    return ""
-                except Exception as e:
-                    print(f"Error parsing response: {str(e)}")
-                    print(f"Raw response: {response.text}")
-                    return response.text  # 如果JSON解析失败，返回原始文本
-            else:
-                print(f"API returned status code {response.status_code}: {response.text}")
-                
-        except requests.exceptions.Timeout:
-            print(f"Request timed out after {REQUEST_TIMEOUT} seconds")
-        except requests.exceptions.RequestException as e:
-            print(f"Request error: {str(e)}")
-        
-        # 如果不是最后一次尝试，等待后重试
-        if attempt < RETRY_COUNT - 1:
-            retry_wait = RETRY_DELAY * (attempt + 1)  # 渐进式等待时间
-            print(f"Waiting {retry_wait} seconds before retrying...")
-            time.sleep(retry_wait)
+            # 如果不是最后一次尝试，等待后重试
+            if attempt < RETRY_COUNT - 1:
+                retry_wait = RETRY_DELAY * (attempt + 1)  # 渐进式等待时间
+                print(f"Waiting {retry_wait} seconds before retrying...")
+                time.sleep(retry_wait)
     
-    print(f"Failed after {RETRY_COUNT} attempts. Using default scores.")
+    usage['latency'] = time.time() - start_time
+    if usage_out is not None:
+        usage_out.update(usage)
+    print(f"Failed after {attempts} attempts. Using default scores.")
     return ""  # 所有尝试失败后返回空字符串
 
+def post_judge_request(url, api_key, payload, usage, usage_out, start_time, cache_key=None):
+    """发送一次评估请求，返回模型回复文本；请求失败（状态码非200、超时、连接错误）时返回None"""
+    headers = {
+        'Authorization': f'Bearer {api_key}',
+        'Content-Type': 'application/json'
+    }
+    try:
+        response = requests.post(url, headers=headers, json=payload, timeout=REQUEST_TIMEOUT)
+        usage['latency'] = time.time() - start_time
+        
+        if response.status_code == 200:
+            try:
+                response_json = response.json()
+                usage.update(extract_usage(response_json))
+                if usage_out is not None:
+                    usage_out.update(usage)
+                print(f"Response structure keys: {list(response_json.keys())}")
+                
+                # 标准OpenAI API格式
+                if 'choices' in response_json and len(response_json['choices']) > 0:
+                    if 'message' in response_json['choices'][0]:
+                        content = response_json['choices'][0]['message']['content']
+                        if cache_key is not None and content:
+                            RESPONSE_CACHE.put(cache_key, response_json, payload['model'])
+                        print("Evaluation complete!")
+                        print(f"Content: {content}")
+                        return content
+                
+                # 替代格式
+                if 'model_response' in response_json:
+                    content = response_json['model_response']
+                    if 'assistant\n' in content:
+                        extracted_content = content.split('assistant\n', 1)[1].strip()
+                        print("Evaluation complete!")
+                        print(f"Content: {extracted_content}")
+                        return extracted_content
+                    else:
+                        print("Evaluation complete!")
+                        print(f"Content: {content}")
+                        return content
+                
+                print(f"Unexpected response format. Response contains keys: {list(response_json.keys())}")
+                return ""
+            except Exception as e:
+                print(f"Error parsing response: {str(e)}")
+                print(f"Raw response: {response.text}")
+                return response.text  # 如果JSON解析失败，返回原始文本
+        else:
+            print(f"API returned status code {response.status_code}: {response.text}")
+            
+    except requests.exceptions.Timeout:
+        print(f"Request timed out after {REQUEST_TIMEOUT} seconds")
+    except requests.exceptions.RequestException as e:
+        print(f"Request error: {str(e)}")
+    return None
+
 def parse_evaluation_scores(evaluation_text):
     """从评估响应中解析分数，增强稳健性"""
     scores = {}
@@ -247,99 +336,265 @@ def parse_evaluation_scores(evaluation_text):
     print(f"Extracted scores: {scores}")
     return scores
 
-def save_results_to_csv(record_id, scores, output_file, fieldnames):
-    """将评估结果保存到CSV"""
-    row = {'id': record_id}
-    row.update(scores)
+def judge_file(file_path):
+    """读取单个JSON文件并评估，返回包含分数、用量和评估原文的字典
+
+    无活动链时scores为None；评估调用失败（重试用尽仍无回复）时scores为None且failed为True，
+    不能把解析空回复得到的默认分当作真实分数
+    """
+    with open(file_path, 'r', encoding='utf-8') as f:
+        data = json.load(f)
+    
+    record_id = data.get('id')
+    print(f"\n\nProcessing record ID: {record_id}")
     
-    with open(output_file, 'a', newline='', encoding='utf-8') as f:
-        writer = csv.DictWriter(f, fieldnames=fieldnames)
-        writer.writerow(row)
+    # 提取活动链内容
+    activity_chain = extract_assistant_content(data)
+    
+    if not activity_chain:
+        print(f"Warning: Could not extract activity chain from file {file_path}")
+        return {'record_id': record_id, 'scores': None}
+    
+    # 发送评估
+    usage = {}
+    evaluation_response = evaluate_activity_chain(activity_chain, usage_out=usage)
+    if not evaluation_response:
+        print(f"Judge call failed for file {file_path} after {usage.get('attempts', 0)} attempts")
+        return {'record_id': record_id, 'scores': None, 'failed': True, 'usage': usage, 'raw_response': ''}
+    
+    # 解析分数
+    scores = parse_evaluation_scores(evaluation_response)
+    return {'record_id': record_id, 'scores': scores, 'usage': usage, 'raw_response': evaluation_response}
+
+def commit_result(store, file_name, result):
+    """将一条评估结果写入结果库（分数、评估原文、用量和状态在同一条记录中，随批次一起提交）"""
+    if result.get('failed'):
+        # 评估调用失败，记录为 failed，下次运行时重新评估
+        store.add_skipped(file_name, result['record_id'], status=STATUS_FAILED, reason='judge call failed')
+        return
+    if result['scores'] is None:
+        store.add_skipped(file_name, result['record_id'])  # 即使提取失败也标记为已处理
+        return
     
-    print(f"Results for ID {record_id} saved to CSV")
+    store.add_result(file_name, result['record_id'], result['scores'],
+                     result.get('usage'), result.get('raw_response'))
+    print(f"Results for ID {result['record_id']} queued for commit")
 
-def process_json_file(file_path, file_name, output_file, fieldnames, processed_files):
+def process_json_file(file_path, file_name, store):
     """处理单个JSON文件"""
-    # 检查文件是否已处理
-    if file_name in processed_files:
+    # 检查文件是否已处理（主键索引查询）
+    if store.is_processed(file_name):
         print(f"File {file_name} already processed, skipping...")
         return
     
     try:
-        with open(file_path, 'r', encoding='utf-8') as f:
-            data = json.load(f)
-        
-        record_id = data.get('id')
-        print(f"\n\nProcessing record ID: {record_id}")
-        
-        # 提取活动链内容
-        activity_chain = extract_assistant_content(data)
-        
-        if not activity_chain:
-            print(f"Warning: Could not extract activity chain from file {file_path}")
-            mark_as_processed(file_name)  # 即使提取失败也标记为已处理
-            return
-        
-        # 发送评估
-        evaluation_response = evaluate_activity_chain(activity_chain)
-        
-        # 解析分数
-        scores = parse_evaluation_scores(evaluation_response)
-        
-        # 保存结果
-        save_results_to_csv(record_id, scores, output_file, fieldnames)
-        
-        # 标记为已处理
-        mark_as_processed(file_name)
-        
+        commit_result(store, file_name, judge_file(file_path))
     except Exception as e:
         print(f"Error processing file {file_path}: {str(e)}")
         # 不标记为已处理，以便下次重试
 
-def main():
-    """主函数，处理所有JSON文件"""
-    # 设置输入和输出路径
-    input_folder = '/root/for_eval'
-    output_file = '/root/for_eval/result.csv'
+def open_results_store(db_path, output_file, input_folder):
+    """打开结果库；数据库为空时导入旧版 processed_files.txt 和 result.csv
+
+    旧版CSV的 id 无法对应到输入文件夹中的文件时抛出 ValueError，不继续运行
+    """
+    store = ResultsStore(db_path)
+    if not store.processed_files():
+        try:
+            imported = store.import_legacy(PROCESSED_FILES_LOG, output_file, input_folder)
+        except ValueError:
+            store.close()
+            raise
+        if imported:
+            print(f"Imported {imported} records from legacy result files")
+    
+    # 旧版CSV（没有file列）已按 id 导入数据库，导出会覆盖它，先保留一份原文件
+    if os.path.isfile(output_file):
+        with open(output_file, 'r', newline='', encoding='utf-8') as f:
+            header = next(csv.reader(f), None) or []
+        if 'file' not in header:
+            os.replace(output_file, output_file + '.legacy')
+            print(f"Legacy CSV kept as {output_file}.legacy")
+    return store
+
+def apply_rule_filter(store, input_folder, file_names):
+    """对待评估文件运行规则预评估，未通过的直接记为rejected，返回通过的文件列表"""
+    from rule_checks import load_corpus, run_checks, trajectory_report
+    
+    corpus = load_corpus(input_folder, file_names)
+    results = run_checks([text for _, _, text in corpus])
+    rejected = set()
+    for i, (file_name, record_id, _) in enumerate(corpus):
+        if not results['passed'][i]:
+            report = trajectory_report(results, i)
+            store.add_skipped(file_name, record_id, status=STATUS_REJECTED,
+                              reason=json.dumps(report, ensure_ascii=False))
+            rejected.add(file_name)
+    store.flush()
+    print(f"Rule pre-evaluation rejected {len(rejected)} of {len(corpus)} files: {results['failure_counts']}")
+    return [f for f in file_names if f not in rejected]
+
+def apply_dedup_filter(store, input_folder, json_files, file_names):
+    """近似重复检测，待评估文件中的重复轨迹记为duplicate（原因中记录保留的代表文件），返回其余文件
+
+    只在已评分的文件和待评估文件（已通过规则预评估）中检测：被拒绝、跳过或历史导入的文件
+    不会被评分，不能作为簇代表，否则整个簇都得不到评估
+    """
+    from dedup_minhash import print_dedup_report, run_dedup
     
+    # 已评分的文件优先作为簇代表，避免为同一簇再付一次评估费用
+    scored = set(store.scored_results())
+    pending = set(file_names)
+    candidates = [f for f in json_files if f in scored or f in pending]
+    result = run_dedup(input_folder, candidates, prefer=scored)
+    print_dedup_report(result, top=5)
+    dropped = 0
+    for file_name, representative in result['duplicates'].items():
+        if file_name in pending:
+            store.add_skipped(file_name, status=STATUS_DUPLICATE,
+                              reason=json.dumps({'representative': representative}, ensure_ascii=False))
+            dropped += 1
+    store.flush()
+    print(f"Near-duplicate filter dropped {dropped} of {len(file_names)} files")
+    return [f for f in file_names if f not in result['duplicates']]
+
+def main(input_folder='/root/for_eval', output_file='/root/for_eval/result.csv',
+         max_workers=MAX_WORKERS, requests_per_second=REQUESTS_PER_SECOND, pack_size=1,
+         db_path=RESULTS_DB, rule_filter=False, local_model=None, local_batch_size=4,
+         adaptive=False, compare_folder=None, ci_width=0.5, min_samples=30,
+         hedge_budget=None, hedge_model=None, hedge_url=None, cache_path=RESPONSE_CACHE_DB, cache_max_mb=512,
+         dedup=False, routes_file=None):
+    """主函数，并发处理所有JSON文件，结果批量提交到结果库，结束后导出CSV
+
+    pack_size 大于1时，每次请求打包评估多条活动链（见 packed_judge.py）；
+    rule_filter 为True时，先用规则预评估过滤明显有问题的轨迹（见 rule_checks.py）；
+    指定 local_model 时不调用API，使用本地模型的分数token概率评估（见 logprob_judge.py）；
+    adaptive 为True时按随机顺序评估，置信区间足够窄或与 compare_folder 的差异显著时提前停止（见 adaptive_sampling.py）；
+    hedge_budget 不为None时启用对冲请求，对冲请求数不超过总请求数的该比例（见 hedging.py）；
+    cache_path 不为None时缓存评估响应，重新运行时相同的请求不再调用API（见 response_cache.py）；
+    dedup 为True时先去掉近似重复的轨迹，每个重复簇只评估一条（见 dedup_minhash.py）；
+    routes_file 不为None时按路由配置把请求分发到多个接口/密钥（见 api_router.py）
+    """
+    global RESPONSE_CACHE, JUDGE_ROUTER, JUDGE_HEDGER
     # 验证输入文件夹
     if not os.path.exists(input_folder):
         print(f"Error: Folder {input_folder} does not exist.")
         return
     
-    # 获取已处理文件列表
-    processed_files = get_processed_files()
-    print(f"Found {len(processed_files)} already processed files")
-    
-    # 设置CSV文件
-    fieldnames = setup_csv(output_file)
-    
-    # 列出所有JSON文件
-    json_files = [f for f in os.listdir(input_folder) if f.endswith('.json')]
-    
-    if not json_files:
-        print(f"No JSON files found in {input_folder}")
-        return
-    
-    remaining_files = [f for f in json_files if f not in processed_files]
-    print(f"Found {len(json_files)} JSON files, {len(remaining_files)} remaining to process")
-    
-    # 处理每个JSON文件
-    for i, file_name in enumerate(json_files):
-        if file_name in processed_files:
-            continue
+    store = open_results_store(db_path, output_file, input_folder)
+    try:
+        # 列出所有JSON文件
+        json_files = sorted(f for f in os.listdir(input_folder) if f.endswith('.json'))
+        
+        if not json_files:
+            print(f"No JSON files found in {input_folder}")
+            return
+        
+        processed_files = store.processed_files()
+        print(f"Found {len(processed_files)} already processed files")
+        remaining_files = [f for f in json_files if f not in processed_files]
+        print(f"Found {len(json_files)} JSON files, {len(remaining_files)} remaining to process")
+        # 先做规则预评估：被拒绝的文件不会被评分，不能再作为重复簇的代表
+        if rule_filter and remaining_files:
+            remaining_files = apply_rule_filter(store, input_folder, remaining_files)
+        if dedup and remaining_files:
+            remaining_files = apply_dedup_filter(store, input_folder, json_files, remaining_files)
+        print(f"Workers: {max_workers}, rate limit: {requests_per_second} requests/s")
+        if cache_path:
+            RESPONSE_CACHE = ResponseCache(cache_path, cache_max_mb)
+            print(f"Response cache: {cache_path}")
+        if routes_file:
+            JUDGE_ROUTER = load_routes(routes_file)
+            print(f"API routing enabled: {len(JUDGE_ROUTER.routes)} routes from {routes_file}")
+        if hedge_budget:
+            enable_hedging(hedge_budget, hedge_model, hedge_url)
+            print(f"Hedged requests enabled, budget {hedge_budget * 100:.0f}% of calls")
+        
+        def on_result(file_name, result, error):
+            if error is not None:
+                # 不标记为已处理，以便下次重试
+                print(f"Error processing file {file_name}: {str(error)}")
+                return
+            commit_result(store, file_name, result)
+        
+        def on_pack_result(pack, results, error):
+            if error is not None:
+                print(f"Error processing pack {', '.join(pack)}: {str(error)}")
+                return
+            for file_path, result in results:
+                commit_result(store, os.path.basename(file_path), result)
+        
+        if adaptive:
+            from adaptive_sampling import open_arm_store, print_adaptive_report, run_adaptive
+            
+            stores, folders, file_lists = [store], [input_folder], [remaining_files]
+            if compare_folder:
+                compare_store = open_arm_store(compare_folder)
+                compare_files = sorted(f for f in os.listdir(compare_folder) if f.endswith('.json'))
+                compare_files = [f for f in compare_files if not compare_store.is_processed(f)]
+                if rule_filter and compare_files:
+                    compare_files = apply_rule_filter(compare_store, compare_folder, compare_files)
+                stores.append(compare_store)
+                folders.append(compare_folder)
+                file_lists.append(compare_files)
+            try:
+                report = run_adaptive(stores, folders, file_lists, judge_file, commit_result,
+                                      max_workers, requests_per_second, ci_width, min_samples=min_samples)
+            finally:
+                for extra_store in stores[1:]:
+                    extra_store.close()
+            print_adaptive_report(report)
+            stats = {'completed': report['judge_calls'], 'failed': 0, 'elapsed': report['elapsed']}
+        elif local_model:
+            from logprob_judge import LogprobJudge
+            
+            judge = LogprobJudge(local_model, batch_size=local_batch_size)
+            batches = [tuple(remaining_files[i:i + local_batch_size])
+                       for i in range(0, len(remaining_files), local_batch_size)]
+            print(f"Local log-probability judge: {local_model}, {len(batches)} batches of {local_batch_size}")
+            
+            # 本地模型一次只运行一个批次，不需要并发和限速
+            stats = run_pool_sync(batches, lambda batch: judge.judge_files([os.path.join(input_folder, f) for f in batch]),
+                                  on_pack_result, concurrency=1)
+        elif pack_size > 1:
+            from packed_judge import judge_files_packed
             
-        file_path = os.path.join(input_folder, file_name)
-        print(f"\nProcessing file {i+1}/{len(json_files)}: {file_name}")
+            packs = [tuple(remaining_files[i:i + pack_size]) for i in range(0, len(remaining_files), pack_size)]
+            print(f"Packed mode: {pack_size} activity chains per request, {len(packs)} requests")
+            
+            stats = run_pool_sync(packs, lambda pack: judge_files_packed([os.path.join(input_folder, f) for f in pack]),
+                                  on_pack_result, concurrency=max_workers, rate=requests_per_second)
+        else:
+            stats = run_pool_sync(
+                remaining_files,
+                lambda file_name: judge_file(os.path.join(input_folder, file_name)),
+                on_result,
+                concurrency=max_workers,
+                rate=requests_per_second,
+            )
+        print(f"\nCompleted: {stats['completed']}, failed: {stats['failed']}, elapsed: {stats['elapsed']:.1f}s")
+        if JUDGE_HEDGER is not None:
+            print_hedging_report(JUDGE_HEDGER.report(), "评估请求对冲统计")
+        if JUDGE_ROUTER is not None:
+            print_router_report(JUDGE_ROUTER.report(), "评估请求路由统计")
+        if RESPONSE_CACHE is not None:
+            print_cache_report(RESPONSE_CACHE.report(), "评估响应缓存统计")
         
-        try:
-            process_json_file(file_path, file_name, output_file, fieldnames, processed_files)
-            # 添加小延迟以避免API速率限制
-            time.sleep(1)
-        except Exception as e:
-            print(f"Error in main loop processing file {file_path}: {str(e)}")
+        # 提交剩余结果，并按文件名顺序导出CSV
+        store.flush()
+        store.export_csv(output_file)
+    finally:
+        store.close()
+        if RESPONSE_CACHE is not None:
+            RESPONSE_CACHE.close()
+            RESPONSE_CACHE = None
+        if JUDGE_HEDGER is not None:
+            # 出错或再次调用 main 时不能沿用旧的线程池、延迟统计和对冲预算
+            JUDGE_HEDGER.shutdown()
+            JUDGE_HEDGER = None
+        JUDGE_ROUTER = None
     
-    print(f"\nAll files processed. Results saved to {output_file}")
+    print(f"\nAll files processed. Results saved to {db_path} and {output_file}")
 
 if __name__ == "__main__":
     print("Starting Activity Chain Evaluation Script")
@@ -347,4 +602,52 @@ if __name__ == "__main__":
     print("Connecting to gpt-4o-mini-2024-07-18 model via xiaoai.plus API")
     print("-" * 50)
     
-    main()
+    parser = argparse.ArgumentParser(description="Evaluate activity chains with an LLM judge")
+    parser.add_argument("--input_folder", type=str, default="/root/for_eval",
+                        help="Folder containing dialogue JSON files")
+    parser.add_argument("--output_file", type=str, default="/root/for_eval/result.csv",
+                        help="CSV file the results database is exported to")
+    parser.add_argument("--workers", type=int, default=MAX_WORKERS,
+                        help="Maximum number of concurrent judge requests")
+    parser.add_argument("--rps", type=float, default=REQUESTS_PER_SECOND,
+                        help="Maximum judge requests started per second (0 = unlimited)")
+    parser.add_argument("--pack_size", type=int, default=1,
+                        help="Number of activity chains judged per request (1 = single-item mode)")
+    parser.add_argument("--db", type=str, default=RESULTS_DB,
+                        help="SQLite database storing scores, raw judge text and usage")
+    parser.add_argument("--rule_filter", action="store_true",
+                        help="Reject obviously broken trajectories with local rule checks before judging")
+    parser.add_argument("--local_model", type=str, default=None,
+                        help="Score with a local model's score-token probabilities instead of the API")
+    parser.add_argument("--local_batch_size", type=int, default=4,
+                        help="Trajectories per forward pass for the local judge")
+    parser.add_argument("--adaptive", action="store_true",
+                        help="Judge files in random order and stop once the confidence intervals are tight enough")
+    parser.add_argument("--compare_folder", type=str, default=None,
+                        help="Second folder for an adaptive A/B comparison (results kept in its own results.db)")
+    parser.add_argument("--ci_width", type=float, default=0.5,
+                        help="Target bootstrap CI width per dimension for adaptive mode")
+    parser.add_argument("--min_samples", type=int, default=30,
+                        help="Minimum trajectories per group before adaptive mode may stop")
+    parser.add_argument("--hedge_budget", type=float, default=None,
+                        help="Enable hedged requests; at most this fraction of calls may be duplicated (e.g. 0.1)")
+    parser.add_argument("--hedge_model", type=str, default=None,
+                        help="Model used for hedged duplicates (default: same model)")
+    parser.add_argument("--hedge_url", type=str, default=None,
+                        help="Secondary endpoint used for hedged duplicates (default: same endpoint)")
+    parser.add_argument("--cache", type=str, default=RESPONSE_CACHE_DB,
+                        help="On-disk response cache; identical judge requests are answered from it")
+    parser.add_argument("--cache_max_mb", type=float, default=512,
+                        help="Response cache size limit; least recently used entries are evicted")
+    parser.add_argument("--no_cache", action="store_true",
+                        help="Disable the response cache")
+    parser.add_argument("--dedup", action="store_true",
+                        help="Drop near-duplicate trajectories (MinHash LSH) before judging")
+    parser.add_argument("--routes", type=str, default=None,
+                        help="JSON list of API endpoints/keys to load-balance judge requests across")
+    args = parser.parse_args()
+    
+    main(args.input_folder, args.output_file, args.workers, args.rps, args.pack_size, args.db, args.rule_filter,
+         args.local_model, args.local_batch_size, args.adaptive, args.compare_folder, args.ci_width, args.min_samples,
+         args.hedge_budget, args.hedge_model, args.hedge_url,
+         None if args.no_cache else args.cache, args.cache_max_mb, args.dedup, args.routes)
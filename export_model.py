@@ -0,0 +1,261 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+LoRA适配器合并与导出
+把 train.py 保存的适配器（输出目录下的 final_model 或某个 checkpoint-*）合并进基础模型，
+保留新增的特殊标记和聊天模板，按目标精度写出分片的safetensors，得到 finetuned_inference.py 的 --model_path 可直接加载的目录；
+可选再写出一份bitsandbytes量化版本，并对比“基础模型+适配器”和导出模型的加载时间与首token延迟
+
+用法:
+    python export_model.py --adapter_dir output/final_model --output_dir autodl-tmp/ljz_qwen2.5-7b --benchmark
+    python export_model.py --adapter_dir output/final_model --output_dir autodl-tmp/ljz_qwen2.5-7b --quantize nf4
+"""
+
+import os
+import gc
+import json
+import time
+import argparse
+
+import torch
+from peft import PeftModel
+from transformers import AutoModelForCausalLM, AutoTokenizer, set_seed
+
+from train import RUN_CONFIG_FILE, load_model, resolve_dtype
+
+SYSTEM_MESSAGE = "请基于真实世界信息，生成一个在上海市陆家嘴区域内进行活动的人的一天活动轨迹。"
+BENCHMARK_PROMPT = "请生成陆家嘴内一位商务人群的一天活动轨迹。"
+EXPORT_INFO_FILE = 'export_info.json'
+
+
+def find_run_config(adapter_dir):
+    """在适配器目录及其上级目录中查找 train.py 保存的运行配置"""
+    directory = os.path.abspath(adapter_dir)
+    for _ in range(2):
+        path = os.path.join(directory, RUN_CONFIG_FILE)
+        if os.path.exists(path):
+            with open(path, 'r', encoding='utf-8') as f:
+                return json.load(f)
+        directory = os.path.dirname(directory)
+    return None
+
+
+def load_base_model(adapter_dir, tokenizer, dtype, base_model=None, device_map=None):
+    """
+    加载未量化的基础模型并把词表扩展到 tokenizer 的大小
+
+    有运行配置时用 train.py 的 load_model 按训练时的方式构造（包括冒烟测试的随机初始化模型），
+    否则按适配器配置中的 base_model_name_or_path 加载
+    """
+    config = find_run_config(adapter_dir)
+    if config is not None and not base_model:
+        config['quantization'] = None
+        config.setdefault('model', {})['torch_dtype'] = dtype
+        if device_map is not None:
+            config['model']['device_map'] = device_map
+        set_seed(config.get('seed', 42))
+        return load_model(config, tokenizer)
+
+    if not base_model:
+        with open(os.path.join(adapter_dir, 'adapter_config.json'), 'r', encoding='utf-8') as f:
+            base_model = json.load(f)['base_model_name_or_path']
+    kwargs = {'dtype': resolve_dtype(dtype)}
+    if device_map:
+        kwargs['device_map'] = device_map
+    model = AutoModelForCausalLM.from_pretrained(base_model, **kwargs)
+    if len(tokenizer) != model.get_input_embeddings().weight.shape[0]:
+        model.resize_token_embeddings(len(tokenizer))
+    return model
+
+
+def sample_inputs(tokenizer, device):
+    """基准测试和合并校验使用的提示（与推理时的格式一致）"""
+    messages = [{'role': 'user', 'content': SYSTEM_MESSAGE + '\n\n' + BENCHMARK_PROMPT}]
+    prompt = tokenizer.apply_chat_template(messages, tokenize=False, add_generation_prompt=True)
+    return tokenizer(prompt, return_tensors='pt', add_special_tokens=False).to(device)
+
+
+def merge_adapter(adapter_dir, dtype='bfloat16', base_model=None, device_map=None):
+    """
+    加载基础模型和适配器并合并
+
+    返回:
+        (model, tokenizer, max_logit_diff): 合并后的模型、tokenizer，以及合并前后示例提示上logits的最大差异
+    """
+    tokenizer = AutoTokenizer.from_pretrained(adapter_dir)
+    model = load_base_model(adapter_dir, tokenizer, dtype, base_model, device_map)
+    model = PeftModel.from_pretrained(model, adapter_dir)
+    model.eval()
+
+    inputs = sample_inputs(tokenizer, next(model.parameters()).device)
+    with torch.no_grad():
+        before = model(**inputs).logits.float()
+        model = model.merge_and_unload()
+        after = model(**inputs).logits.float()
+    return model, tokenizer, float((before - after).abs().max())
+
+
+def export(model, tokenizer, output_dir, max_shard_size='2GB', info=None):
+    """写出分片的safetensors、tokenizer（含新增标记和聊天模板）和导出信息"""
+    os.makedirs(output_dir, exist_ok=True)
+    model.save_pretrained(output_dir, max_shard_size=max_shard_size)
+    tokenizer.save_pretrained(output_dir)
+    if info is not None:
+        with open(os.path.join(output_dir, EXPORT_INFO_FILE), 'w', encoding='utf-8') as f:
+            json.dump(info, f, ensure_ascii=False, indent=2)
+    files = [name for name in os.listdir(output_dir) if name.endswith('.safetensors')]
+    size = sum(os.path.getsize(os.path.join(output_dir, name)) for name in files)
+    print(f"已导出到 {output_dir}: {len(files)} 个safetensors分片, 共 {size / 2 ** 30:.2f}GB")
+
+
+def build_bnb_config(method, dtype):
+    """量化方式对应的 BitsAndBytesConfig"""
+    try:
+        import bitsandbytes  # noqa: F401
+    except ImportError:
+        raise ImportError("导出量化版本需要bitsandbytes库，可以通过 'pip install bitsandbytes' 安装")
+    from transformers import BitsAndBytesConfig
+
+    if method == 'int8':
+        return BitsAndBytesConfig(load_in_8bit=True)
+    return BitsAndBytesConfig(load_in_4bit=True, bnb_4bit_quant_type='nf4', bnb_4bit_use_double_quant=True,
+                              bnb_4bit_compute_dtype=resolve_dtype(dtype))
+
+
+def export_quantized(merged_dir, method, dtype='bfloat16', max_shard_size='2GB'):
+    """从合并后的目录按bitsandbytes量化加载并另存，返回量化版本的目录"""
+    output_dir = f"{merged_dir.rstrip(os.sep)}-{method}"
+    model = AutoModelForCausalLM.from_pretrained(merged_dir, quantization_config=build_bnb_config(method, dtype),
+                                                 device_map='auto')
+    tokenizer = AutoTokenizer.from_pretrained(merged_dir)
+    export(model, tokenizer, output_dir, max_shard_size, {'source': os.path.abspath(merged_dir), 'quantization': method})
+    del model
+    release_memory()
+    return output_dir
+
+
+def release_memory():
+    gc.collect()
+    if torch.cuda.is_available():
+        torch.cuda.empty_cache()
+
+
+def benchmark_load(load, name, new_tokens=32):
+    """
+    计时加载和首token延迟
+
+    参数:
+        load: 无参函数，返回 (model, tokenizer)
+        new_tokens (int): 另外生成这么多token计算解码速度
+
+    返回:
+        dict: 加载秒数、首token秒数、解码 tokens/秒 和峰值显存
+    """
+    release_memory()
+    if torch.cuda.is_available():
+        torch.cuda.reset_peak_memory_stats()
+    start = time.perf_counter()
+    model, tokenizer = load()
+    model.eval()
+    load_seconds = time.perf_counter() - start
+
+    inputs = sample_inputs(tokenizer, next(model.parameters()).device)
+    generate_kwargs = {'do_sample': False, 'pad_token_id': tokenizer.pad_token_id or tokenizer.eos_token_id}
+    with torch.no_grad():
+        start = time.perf_counter()
+        model.generate(**inputs, max_new_tokens=1, min_new_tokens=1, **generate_kwargs)
+        first_token = time.perf_counter() - start
+        start = time.perf_counter()
+        output = model.generate(**inputs, max_new_tokens=new_tokens, min_new_tokens=new_tokens, **generate_kwargs)
+        generate_seconds = time.perf_counter() - start
+    generated = output.shape[1] - inputs['input_ids'].shape[1]
+    result = {
+        'name': name,
+        'load_seconds': load_seconds,
+        'first_token_seconds': first_token,
+        'decode_tokens_per_second': generated / generate_seconds if generate_seconds > 0 else 0.0,
+    }
+    if torch.cuda.is_available():
+        result['memory_peak_mb'] = torch.cuda.max_memory_allocated() / 2 ** 20
+    del model
+    release_memory()
+    return result
+
+
+def run_benchmarks(adapter_dir, exported, dtype, base_model=None, new_tokens=32):
+    """对比“基础模型+适配器”的加载方式与各导出目录，exported 为 [(目录, 是否量化)]"""
+    device_map = 'auto' if torch.cuda.is_available() else None
+
+    def load_with_adapter():
+        tokenizer = AutoTokenizer.from_pretrained(adapter_dir)
+        model = load_base_model(adapter_dir, tokenizer, dtype, base_model, device_map)
+        return PeftModel.from_pretrained(model, adapter_dir), tokenizer
+
+    def loader(path, quantized):
+        def load():
+            kwargs = {'device_map': device_map} if device_map else {}
+            if not quantized:
+                kwargs['dtype'] = resolve_dtype(dtype)
+            return AutoModelForCausalLM.from_pretrained(path, **kwargs), AutoTokenizer.from_pretrained(path)
+        return load
+
+    results = [benchmark_load(load_with_adapter, '基础模型+适配器', new_tokens)]
+    for path, quantized in exported:
+        results.append(benchmark_load(loader(path, quantized), os.path.basename(path.rstrip(os.sep)), new_tokens))
+    return results
+
+
+def print_benchmark_report(results):
+    """打印加载时间和首token延迟对比"""
+    print("\n========== 加载与首token延迟 ==========")
+    header = f"{'模型':<28}{'加载(秒)':>10}{'首token(秒)':>13}{'解码tokens/秒':>15}"
+    if 'memory_peak_mb' in results[0]:
+        header += f"{'峰值显存(MB)':>14}"
+    print(header)
+    for result in results:
+        line = (f"{result['name']:<28}{result['load_seconds']:>10.2f}{result['first_token_seconds']:>13.3f}"
+                f"{result['decode_tokens_per_second']:>15.1f}")
+        if 'memory_peak_mb' in result:
+            line += f"{result['memory_peak_mb']:>14.0f}"
+        print(line)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="合并LoRA适配器并导出可直接推理的模型目录")
+    parser.add_argument("--adapter_dir", type=str, required=True,
+                        help="train.py 输出目录下的 final_model 或 checkpoint-* 目录")
+    parser.add_argument("--output_dir", type=str, required=True,
+                        help="导出目录")
+    parser.add_argument("--base_model", type=str, default=None,
+                        help="基础模型路径，默认使用训练时的配置或适配器配置中的路径")
+    parser.add_argument("--dtype", type=str, default="bfloat16", choices=["bfloat16", "float16", "float32"],
+                        help="导出权重的精度")
+    parser.add_argument("--max_shard_size", type=str, default="2GB",
+                        help="每个safetensors分片的最大大小")
+    parser.add_argument("--quantize", type=str, default="none", choices=["none", "nf4", "int8"],
+                        help="另外导出bitsandbytes量化版本（目录名加后缀，需要GPU）")
+    parser.add_argument("--benchmark", action="store_true",
+                        help="导出后对比加载时间和首token延迟")
+    parser.add_argument("--new_tokens", type=int, default=32,
+                        help="基准测试中计算解码速度时生成的token数")
+    args = parser.parse_args()
+
+    start = time.time()
+    model, tokenizer, diff = merge_adapter(args.adapter_dir, args.dtype, args.base_model)
+    print(f"合并完成，用时 {time.time() - start:.1f}秒；合并前后logits最大差异: {diff:.2e}")
+    info = {'adapter_dir': os.path.abspath(args.adapter_dir), 'dtype': args.dtype, 'vocab_size': len(tokenizer),
+            'max_logit_diff': diff}
+    export(model, tokenizer, args.output_dir, args.max_shard_size, info)
+    del model
+    release_memory()
+
+    exported = [(args.output_dir, False)]
+    if args.quantize != 'none':
+        exported.append((export_quantized(args.output_dir, args.quantize, args.dtype, args.max_shard_size), True))
+    if args.benchmark:
+        print_benchmark_report(run_benchmarks(args.adapter_dir, exported, args.dtype, args.base_model,
+                                              args.new_tokens))
+
+
+if __name__ == "__main__":
+    main()
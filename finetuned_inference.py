@@ -7,10 +7,13 @@ import signal
 import argparse
 import time
 from datetime import datetime
-from transformers import AutoModelForCausalLM, AutoTokenizer
+from transformers import AutoModelForCausalLM, AutoTokenizer, DynamicCache
 from contextlib import contextmanager
 from tqdm import tqdm
 
+from population import (PopulationTracker, expand_population, group_batches, load_spec, population_fingerprint,
+                        print_population_report)
+
 class TimeoutException(Exception):
     pass
 
@@ -57,9 +60,13 @@ def log_with_timestamp(message):
     timestamp = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
     print(f"[{timestamp}] {message}")
 
-def generate_response(model, tokenizer, system_message, user_prompt, args):
-    """Generate a response from the model."""
+def generate_response(model, tokenizer, system_message, user_prompt, args, usage_out=None):
+    """Generate a response from the model.
+
+    If usage_out is a dict, prompt/completion token counts are written into it.
+    """
     generation_start_time = time.time()
+    usage = {"prompt_tokens": 0, "completion_tokens": 0, "total_tokens": 0, "cached_tokens": 0}
     
     try:
         with time_limit(args.timeout):
@@ -112,6 +119,9 @@ def generate_response(model, tokenizer, system_message, user_prompt, args):
                             repetition_penalty=1.1  # Add slight penalty to avoid repetitions
                         )
                     log_with_timestamp(f"Generation completed in {time.time() - generate_start:.2f}s. Output tokens: {outputs.shape[1]}")
+                    usage["prompt_tokens"] = int(inputs.input_ids.shape[1])
+                    usage["completion_tokens"] = int(outputs.shape[1] - inputs.input_ids.shape[1])
+                    usage["total_tokens"] = int(outputs.shape[1])
                     
                     # Decode
                     decode_start = time.time()
@@ -141,8 +151,176 @@ def generate_response(model, tokenizer, system_message, user_prompt, args):
     generation_time = time.time() - generation_start_time
     log_with_timestamp(f"Total generation time: {generation_time:.2f}s. Response length: {len(model_response)} chars")
     
+    if usage_out is not None:
+        usage["latency"] = generation_time
+        usage_out.update(usage)
+    
     return model_response, generation_time
 
+def generate_batch(model, tokenizer, system_message, user_prompt, num_agents, args):
+    """Generate num_agents responses for one prompt, sharing a single prefill of the prompt.
+
+    The prompt is run through the model once and its KV cache is repeated across the batch,
+    so every row only decodes new tokens. Returns a list of (response, usage) and the batch time.
+    """
+    generation_start_time = time.time()
+    messages = [
+        {"role": "system", "content": system_message},
+        {"role": "user", "content": user_prompt}
+    ]
+    prompt = tokenizer.apply_chat_template(messages, tokenize=False, add_generation_prompt=True)
+    input_ids = tokenizer(prompt, return_tensors="pt").input_ids.to(model.device)
+    prompt_tokens = int(input_ids.shape[1])
+
+    try:
+        with time_limit(args.timeout):
+            with torch.no_grad():
+                # Prefill everything except the last prompt token; generate() feeds that one itself
+                prefix_cache = DynamicCache(config=model.config)
+                model(input_ids=input_ids[:, :-1], past_key_values=prefix_cache, use_cache=True)
+                prefix_cache.batch_repeat_interleave(num_agents)
+                batch_ids = input_ids.expand(num_agents, -1)
+                outputs = model.generate(
+                    input_ids=batch_ids,
+                    attention_mask=torch.ones_like(batch_ids),
+                    past_key_values=prefix_cache,
+                    max_length=args.max_length,
+                    temperature=args.temperature,
+                    do_sample=True,
+                    pad_token_id=tokenizer.pad_token_id,
+                    repetition_penalty=1.1
+                )
+    except TimeoutException:
+        log_with_timestamp(f"Batch generation timed out after {args.timeout} seconds.")
+        error = f"Error: Generation timed out after {args.timeout} seconds."
+        return [(error, None)] * num_agents, time.time() - generation_start_time
+    except Exception as e:
+        log_with_timestamp(f"Error during batch generation: {e}")
+        import traceback
+        traceback.print_exc()
+        return [(f"Error: {str(e)}", None)] * num_agents, time.time() - generation_start_time
+
+    generation_time = time.time() - generation_start_time
+    results = []
+    for row in range(num_agents):
+        new_tokens = outputs[row, prompt_tokens:]
+        completion_tokens = int((new_tokens != tokenizer.pad_token_id).sum())
+        usage = {
+            "prompt_tokens": prompt_tokens,
+            "completion_tokens": completion_tokens,
+            "total_tokens": prompt_tokens + completion_tokens,
+            # Only the first row pays for the prompt prefill
+            "cached_tokens": 0 if row == 0 else prompt_tokens - 1,
+            "latency": generation_time,
+        }
+        results.append((tokenizer.decode(new_tokens, skip_special_tokens=True).strip(), usage))
+    return results, generation_time
+
+def run_population(args, model, tokenizer, system_message, summary_file):
+    """Population synthesis mode: generate one trajectory per agent of a target distribution.
+
+    Agents with identical conditioned prompts are generated together in batches that share the
+    prompt prefill. Completed agents are appended to population_results.jsonl, so an interrupted
+    run resumes where it stopped, and the realised distribution is logged to population_progress.jsonl.
+    The first line of the results file records the spec/size/seed fingerprint; resuming with a
+    different spec, --population_size or --seed is refused, since agent ids would no longer match.
+    """
+    spec = load_spec(args.population)
+    agents = expand_population(spec, args.population_size, args.seed)
+    fingerprint = population_fingerprint(spec, args.population_size, args.seed)
+    results_file = os.path.join(args.output_dir, "population_results.jsonl")
+    progress_file = os.path.join(args.output_dir, "population_progress.jsonl")
+    tracker = PopulationTracker(spec)
+
+    done = set()
+    if os.path.exists(results_file):
+        with open(results_file, "r", encoding="utf-8") as f:
+            records = [json.loads(line) for line in f if line.strip()]
+        if records and "header" in records[0]:
+            header = records.pop(0)["header"]
+            if header.get("fingerprint") != fingerprint:
+                raise ValueError(f"{results_file} was written for size {header.get('population_size')}, seed {header.get('seed')}; "
+                                 f"this run has size {len(agents)}, seed {args.seed} or a changed spec. "
+                                 f"Use a new --output_dir to start over")
+        for record in records:
+            # Files written before the header was added: check each agent against this run's expansion
+            agent_id = record["agent_id"]
+            if agent_id >= len(agents) or record.get("requested") != agents[agent_id]["attributes"]:
+                raise ValueError(f"{results_file} does not match this population (agent {agent_id}); "
+                                 f"use a new --output_dir to start over")
+            done.add(agent_id)
+            tracker.restore(agents[agent_id], record["realised"])
+        log_with_timestamp(f"Resuming population run: {len(done)} agents already completed")
+    else:
+        with open(results_file, "w", encoding="utf-8") as f:
+            f.write(json.dumps({"header": {"fingerprint": fingerprint, "population_size": len(agents),
+                                           "seed": args.seed}}) + "\n")
+
+    batches = group_batches([agent for agent in agents if agent["agent_id"] not in done], args.batch_size, args.seed)
+    log_with_timestamp(f"Population of {len(agents)} agents, {len(agents) - len(done)} remaining in {len(batches)} batches "
+                       f"({len({agent['user_prompt'] for agent in agents})} distinct prompts)")
+
+    progress_bar = tqdm(total=len(agents), initial=len(done), desc="Synthesizing population")
+    total_generation_time = 0
+    next_report = tracker.completed + args.report_every
+    for batch in batches:
+        results, generation_time = generate_batch(model, tokenizer, system_message, batch[0]["user_prompt"],
+                                                  len(batch), args)
+        total_generation_time += generation_time
+        for agent, (model_response, usage) in zip(batch, results):
+            realised = tracker.add(agent, model_response)
+            if realised is None:
+                with open(summary_file, "a", encoding="utf-8") as f:
+                    f.write(f"[agent {agent['agent_id']}] ERROR: {model_response}\n")
+                continue
+            conversation = {
+                "id": agent["agent_id"] + 1,
+                "timestamp": datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
+                "system_message": system_message,
+                "user_prompt": agent["user_prompt"],
+                "model_response": model_response,
+                "generation_time": generation_time,
+                "usage": dict(usage, model=args.model_path),
+                "agent": agent["attributes"]
+            }
+            json_file, txt_file = save_conversation(conversation, args.output_dir, agent["agent_id"] + 1)
+            with open(results_file, "a", encoding="utf-8") as f:
+                f.write(json.dumps({"agent_id": agent["agent_id"], "file": os.path.basename(json_file),
+                                    "requested": agent["attributes"], "realised": realised},
+                                   ensure_ascii=False) + "\n")
+            with open(summary_file, "a", encoding="utf-8") as f:
+                f.write(f"[agent {agent['agent_id']}] Generated response (Time: {generation_time:.2f}s): {txt_file}\n")
+        progress_bar.update(len(batch))
+
+        if tracker.completed >= next_report:
+            snapshot = tracker.snapshot()
+            with open(progress_file, "a", encoding="utf-8") as f:
+                f.write(json.dumps(snapshot, ensure_ascii=False) + "\n")
+            tvd = ", ".join(f"{name}: {stats['tvd']:.3f}" for name, stats in snapshot["attributes"].items())
+            progress_bar.set_postfix({"errors": tracker.errors})
+            log_with_timestamp(f"{tracker.completed} trajectories completed, TVD to target - {tvd}")
+            next_report = tracker.completed + args.report_every
+        clear_gpu_memory()
+    progress_bar.close()
+
+    snapshot = tracker.snapshot()
+    with open(progress_file, "a", encoding="utf-8") as f:
+        f.write(json.dumps(snapshot, ensure_ascii=False) + "\n")
+    print_population_report(snapshot, spec)
+    with open(summary_file, "a", encoding="utf-8") as f:
+        f.write(f"\nPopulation Statistics\n")
+        f.write(f"=====================\n")
+        f.write(f"Completed: {snapshot['completed']}, Errors: {snapshot['errors']}\n")
+        for name, stats in snapshot["attributes"].items():
+            f.write(f"{name}: TVD {stats['tvd']:.3f}, adherence {stats['adherence'] * 100:.1f}%\n")
+    return {
+        "total_count": len(agents),
+        "successful_count": snapshot["completed"],
+        "error_count": snapshot["errors"],
+        "total_generation_time": total_generation_time,
+        "population": snapshot
+    }
+
 def save_conversation(conversation, output_dir, count):
     """Save the conversation to files."""
     save_start_time = time.time()
@@ -152,8 +330,10 @@ def save_conversation(conversation, output_dir, count):
     
     # JSON output
     json_filename = os.path.join(output_dir, f"conversation_{count:04d}_{timestamp}.json")
-    with open(json_filename, "w", encoding="utf-8") as f:
+    # Write to a temp file and rename so directory watchers never see a partial file
+    with open(json_filename + ".tmp", "w", encoding="utf-8") as f:
         json.dump(conversation, f, ensure_ascii=False, indent=2)
+    os.replace(json_filename + ".tmp", json_filename)
     
     # TXT output
     txt_filename = os.path.join(output_dir, f"conversation_{count:04d}_{timestamp}.txt")
@@ -252,10 +432,17 @@ def main(args):
         f.write(f"Max Sequence Length: {args.max_length}\n")
         f.write(f"Temperature: {args.temperature}\n")
         f.write(f"Timeout: {args.timeout}s\n")
-        f.write(f"Target Count: {args.count}\n\n")
+        if args.population:
+            f.write(f"Population Spec: {args.population}\n")
+            f.write(f"Batch Size: {args.batch_size}\n\n")
+        else:
+            f.write(f"Target Count: {args.count}\n\n")
     
     log_with_timestamp(f"Created summary file: {summary_file}")
     
+    if args.population:
+        return run_population(args, model, tokenizer, system_message, summary_file)
+    
     # Main loop for generating responses
     count = 0
     successful_count = 0
@@ -276,7 +463,8 @@ def main(args):
         
         # Generate response
         try:
-            model_response, generation_time = generate_response(model, tokenizer, system_message, selected_prompt, args)
+            usage = {"model": model_path}
+            model_response, generation_time = generate_response(model, tokenizer, system_message, selected_prompt, args, usage_out=usage)
             total_generation_time += generation_time
             
             if model_response.startswith("Error:"):
@@ -292,7 +480,8 @@ def main(args):
                 "system_message": system_message,
                 "user_prompt": selected_prompt,
                 "model_response": model_response,
-                "generation_time": generation_time
+                "generation_time": generation_time,
+                "usage": usage
             }
             
             # Save to files
@@ -375,6 +564,16 @@ if __name__ == "__main__":
                         help="Timeout in seconds for generation")
     parser.add_argument("--count", type=int, default=600,
                         help="Number of conversations to generate (max 600)")
+    parser.add_argument("--population", type=str, default=None,
+                        help="Target distribution JSON (see configs/population_default.json); enables population synthesis mode")
+    parser.add_argument("--population_size", type=int, default=None,
+                        help="Number of agents to synthesize, defaults to the size in the spec")
+    parser.add_argument("--batch_size", type=int, default=8,
+                        help="Agents per batch in population mode (agents in a batch share one prompt)")
+    parser.add_argument("--report_every", type=int, default=100,
+                        help="Log the realised distribution every this many completed trajectories")
+    parser.add_argument("--seed", type=int, default=42,
+                        help="Random seed for expanding the population and ordering batches")
     
     args = parser.parse_args()
     
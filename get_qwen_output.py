@@ -12,10 +12,15 @@ import time
 import random
 import logging
 import traceback
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from datetime import datetime
 import requests
 import hashlib
 import uuid
+from usage_report import empty_usage, extract_usage
+from hedging import HedgedCaller, print_hedging_report
+from response_cache import ResponseCache, make_key, print_cache_report
+from api_router import load_routes, print_router_report
 
 try:
     from tqdm import tqdm  # 进度条显示
@@ -44,6 +49,24 @@ RATE_LIMIT_DELAY = 2      # 增加请求间隔（秒）
 PROGRESSIVE_RETRY = True  # 启用渐进式重试延迟
 MAX_CONCURRENT_REQUESTS = 3  # 最大并发请求数 (如果使用并行处理)
 
+# 对冲请求配置：请求超过运行中的p95延迟仍未返回时，再发送一个重复请求，先成功者胜出
+HEDGE_REQUESTS = False    # 是否启用对冲请求
+HEDGE_BUDGET = 0.1        # 对冲请求最多占总请求数的比例
+HEDGE_API_BASE = None     # 对冲请求使用的备用接口，None表示与主接口相同
+HEDGE_API_KEY = None
+HEDGE_MODEL_NAME = None   # 对冲请求使用的备用模型，None表示与主模型相同
+HEDGER = None
+
+# 响应缓存配置：生成需要每次重新采样，默认跳过缓存；只有需要复现同一批请求时才开启CACHE_GENERATION
+RESPONSE_CACHE_DB = None  # 缓存数据库路径，例如 os.path.join(OUTPUT_DIR, "response_cache.db")，None表示不使用
+CACHE_GENERATION = False  # 是否对生成请求读写缓存
+CACHE_MAX_MB = 512
+GENERATION_CACHE = None
+
+# 多接口/多密钥路由配置
+ROUTES_FILE = None        # 路由配置JSON路径（格式见 api_router.py），None表示只使用 API_BASE/API_KEY
+ROUTER = None             # 启用路由时按 MAX_CONCURRENT_REQUESTS 并发生成
+
 # ==========初始化部分==========
 # 确保输出目录存在
 try:
@@ -167,35 +190,39 @@ def get_request_id():
     """生成唯一的请求ID"""
     return str(uuid.uuid4())
 
-def make_api_request(user_prompt, retry_count=0):
+def make_api_request(user_prompt, retry_count=0, usage_out=None, endpoint=None, max_retries=MAX_RETRIES):
     """
     向API发送请求并获取回复
     
     参数:
         user_prompt (str): 用户提示文本
         retry_count (int): 当前重试次数
+        usage_out (dict): 可选，成功时写入本次请求的token用量
+        endpoint (tuple): 可选，(接口地址, API密钥, 模型名称)，默认使用全局配置
+        max_retries (int): 最多尝试次数，经路由发送时为1（由路由换接口重试）
         
     返回:
         tuple: (成功标志, 回复内容或错误信息)
     """
-    if retry_count >= MAX_RETRIES:
-        return False, f"超过最大重试次数 {MAX_RETRIES}"
+    if retry_count >= max_retries:
+        return False, f"超过最大重试次数 {max_retries}"
     
     request_id = get_request_id()
     retry_delay = calculate_retry_delay(retry_count)
+    api_base, api_key, model_name = endpoint or (API_BASE, API_KEY, MODEL_NAME)
     
     try:
         # 准备请求头
         headers = {
             "Content-Type": "application/json",
-            "Authorization": f"Bearer {API_KEY}",
+            "Authorization": f"Bearer {api_key}",
             "X-Request-ID": request_id,
             "Accept": "application/json"
         }
         
         # 准备请求数据 - 按照官方文档设置格式
         data = {
-            "model": MODEL_NAME,
+            "model": model_name,
             "messages": [
                 {"role": "system", "content": system_message},
                 {"role": "user", "content": user_prompt}
@@ -206,12 +233,27 @@ def make_api_request(user_prompt, retry_count=0):
             "stream": False  # 不使用流式输出
         }
         
+        # 查询响应缓存（仅首次尝试时查询；生成请求默认跳过缓存）
+        cache_key = None
+        if GENERATION_CACHE is not None:
+            if CACHE_GENERATION:
+                params = {key: data[key] for key in ("temperature", "top_p", "max_tokens")}
+                cache_key = make_key(f"{api_base}/chat/completions", model_name, data["messages"], params)
+                cached = GENERATION_CACHE.get(cache_key) if retry_count == 0 else None
+                if cached is not None:
+                    print(f"命中响应缓存，请求ID: {request_id}")
+                    if usage_out is not None:
+                        usage_out['cache_hit'] = True
+                    return True, cached["choices"][0]["message"]["content"]
+            elif retry_count == 0:
+                GENERATION_CACHE.bypass()
+        
         # 发送请求
         logger.debug(f"发送API请求: {user_prompt[:30]}..., 请求ID: {request_id}")
         print(f"发送请求中... (提示: {user_prompt[:30]}..., 请求ID: {request_id})")
         
         response = requests.post(
-            f"{API_BASE}/chat/completions",
+            f"{api_base}/chat/completions",
             headers=headers,
             json=data,
             timeout=REQUEST_TIMEOUT
@@ -227,8 +269,7 @@ def make_api_request(user_prompt, retry_count=0):
             if response.status_code == 429:  # 请求频率限制
                 logger.warning(f"请求频率限制，等待{retry_delay*2}秒后重试...")
                 print(f"请求频率限制，等待{retry_delay*2}秒后重试...")
-                time.sleep(retry_delay * 2)  # 等待更长时间
-                return make_api_request(user_prompt, retry_count + 1)
+                return retry_api_request(user_prompt, retry_count, usage_out, endpoint, max_retries, retry_delay * 2)
             elif response.status_code == 401:  # 认证失败
                 logger.error("API认证失败，请检查API密钥是否正确")
                 print("API认证失败，请检查API密钥是否正确")
@@ -246,12 +287,10 @@ def make_api_request(user_prompt, retry_count=0):
             elif response.status_code >= 500:  # 服务器错误
                 logger.warning(f"服务器错误，等待{retry_delay}秒后重试...")
                 print(f"服务器错误，等待{retry_delay}秒后重试...")
-                time.sleep(retry_delay)
-                return make_api_request(user_prompt, retry_count + 1)
+                return retry_api_request(user_prompt, retry_count, usage_out, endpoint, max_retries, retry_delay)
             
             # 其他错误，等待后重试
-            time.sleep(retry_delay)
-            return make_api_request(user_prompt, retry_count + 1)
+            return retry_api_request(user_prompt, retry_count, usage_out, endpoint, max_retries, retry_delay)
         
         # 解析响应
         try:
@@ -259,41 +298,82 @@ def make_api_request(user_prompt, retry_count=0):
         except json.JSONDecodeError:
             logger.error(f"响应不是有效的JSON格式: {response.text[:200]}...")
             print(f"响应不是有效的JSON格式")
-            time.sleep(retry_delay)
-            return make_api_request(user_prompt, retry_count + 1)
+            return retry_api_request(user_prompt, retry_count, usage_out, endpoint, max_retries, retry_delay)
         
         # 提取助手回复文本
         if "choices" in result and len(result["choices"]) > 0:
             assistant_response = result["choices"][0]["message"]["content"]
             logger.debug(f"收到API回复: {len(assistant_response)} 字符，请求ID: {request_id}")
             print(f"收到回复: {len(assistant_response)} 字符，请求ID: {request_id}")
+            if usage_out is not None:
+                usage_out.update(extract_usage(result))
+                usage_out['attempts'] = retry_count + 1
+            if cache_key is not None:
+                GENERATION_CACHE.put(cache_key, result, model_name)
             return True, assistant_response
         else:
             error_msg = f"无效的API响应格式: {result}, 请求ID: {request_id}"
             logger.error(error_msg)
             print(f"收到无效的响应格式，请求ID: {request_id}")
-            time.sleep(retry_delay)
-            return make_api_request(user_prompt, retry_count + 1)
+            return retry_api_request(user_prompt, retry_count, usage_out, endpoint, max_retries, retry_delay)
             
     except requests.exceptions.Timeout:
         logger.warning(f"请求超时，等待{retry_delay}秒后重试... 请求ID: {request_id}")
         print(f"请求超时，等待{retry_delay}秒后重试... 请求ID: {request_id}")
-        time.sleep(retry_delay)
-        return make_api_request(user_prompt, retry_count + 1)
+        return retry_api_request(user_prompt, retry_count, usage_out, endpoint, max_retries, retry_delay)
         
     except requests.exceptions.ConnectionError:
         logger.warning(f"连接错误，等待{retry_delay}秒后重试... 请求ID: {request_id}")
         print(f"连接错误，等待{retry_delay}秒后重试... 请求ID: {request_id}")
-        time.sleep(retry_delay)
-        return make_api_request(user_prompt, retry_count + 1)
+        return retry_api_request(user_prompt, retry_count, usage_out, endpoint, max_retries, retry_delay)
         
     except Exception as e:
         error_msg = f"请求异常: {str(e)}, 请求ID: {request_id}"
         logger.error(error_msg)
         logger.error(traceback.format_exc())
         print(f"请求出现异常: {str(e)}, 请求ID: {request_id}")
-        time.sleep(retry_delay)
-        return make_api_request(user_prompt, retry_count + 1)
+        return retry_api_request(user_prompt, retry_count, usage_out, endpoint, max_retries, retry_delay)
+
+def retry_api_request(user_prompt, retry_count, usage_out, endpoint, max_retries, retry_delay):
+    """等待后重试；已是最后一次尝试时直接返回失败，不再等待"""
+    if retry_count + 1 >= max_retries:
+        return False, f"超过最大重试次数 {max_retries}"
+    time.sleep(retry_delay)
+    return make_api_request(user_prompt, retry_count + 1, usage_out, endpoint, max_retries)
+
+def request_with_usage(user_prompt, endpoint=None, max_retries=MAX_RETRIES):
+    """发送一次生成请求，返回 (成功标志, 回复内容或错误信息, 用量)"""
+    usage = empty_usage(endpoint[2] if endpoint else MODEL_NAME)
+    success, response = make_api_request(user_prompt, usage_out=usage, endpoint=endpoint, max_retries=max_retries)
+    return success, response, usage
+
+def routed_request(user_prompt):
+    """经 ROUTER 发送生成请求：每次尝试选一条路由，失败时换一条路由重试"""
+    def attempt(route):
+        success, response, usage = request_with_usage(user_prompt, route.endpoint(MODEL_NAME), max_retries=1)
+        usage['route'] = route.name
+        return success, response, usage
+
+    return ROUTER.call(
+        attempt,
+        is_success=lambda result: result[0],
+        max_attempts=MAX_RETRIES + len(ROUTER.routes) - 1,
+        backoff=RETRY_DELAY,
+        tokens=lambda result: result[2]['total_tokens'],
+    )
+
+def create_hedger():
+    """创建生成请求的对冲包装器，对冲请求发往备用接口/模型（未配置时与主接口相同）"""
+    if ROUTER is not None:
+        # 路由模式下对冲请求也经路由发送，按最少未完成请求自然落到另一条路由
+        return HedgedCaller(routed_request, is_success=lambda result: result[0], budget=HEDGE_BUDGET)
+    endpoint = (HEDGE_API_BASE or API_BASE, HEDGE_API_KEY or API_KEY, HEDGE_MODEL_NAME or MODEL_NAME)
+    return HedgedCaller(
+        request_with_usage,
+        lambda user_prompt: request_with_usage(user_prompt, endpoint),
+        is_success=lambda result: result[0],
+        budget=HEDGE_BUDGET,
+    )
 
 def save_dialogue_to_file(index, dialogue):
     """保存对话到文件，有错误重试几次"""
@@ -301,8 +381,11 @@ def save_dialogue_to_file(index, dialogue):
     max_retries = 3
     for attempt in range(max_retries):
         try:
-            with open(filename, 'w', encoding='utf-8') as f:
+            # 先写临时文件再改名，监听输出目录的评估流程只会看到完整的文件
+            tmp_filename = filename + '.tmp'
+            with open(tmp_filename, 'w', encoding='utf-8') as f:
                 json.dump(dialogue, f, ensure_ascii=False, indent=2)
+            os.replace(tmp_filename, filename)
             return True
         except Exception as e:
             logger.error(f"保存对话到文件失败 (尝试 {attempt+1}/{max_retries}): {str(e)}")
@@ -340,7 +423,13 @@ def generate_dialogue(index):
         
         # 发送API请求
         print(f"\n--- 开始生成对话 {index} ---")
-        success, response = make_api_request(user_prompt)
+        if HEDGER is not None:
+            success, response, usage = HEDGER.call(user_prompt)
+        elif ROUTER is not None:
+            success, response, usage = routed_request(user_prompt)
+        else:
+            usage = empty_usage(MODEL_NAME)
+            success, response = make_api_request(user_prompt, usage_out=usage)
         
         if not success:
             logger.error(f"生成对话 {index} 失败: {response}")
@@ -349,6 +438,7 @@ def generate_dialogue(index):
         
         # 计算生成时间
         generation_time = time.time() - start_time
+        usage['latency'] = generation_time
         
         # 提取标识符，用于追踪和错误分析
         dialogue_hash = hashlib.md5(f"{user_prompt}_{timestamp}".encode()).hexdigest()[:8]
@@ -362,12 +452,14 @@ def generate_dialogue(index):
             "model_response": response,
             "generation_time": generation_time,
             "dialogue_hash": dialogue_hash,
-            "model": MODEL_NAME
+            "model": usage.get('model') or MODEL_NAME,  # 对冲请求胜出时为备用模型
+            "usage": usage
         }
         
         # 保存到文件
         if save_dialogue_to_file(index, dialogue):
-            logger.info(f"成功生成对话 {index}: 提示={user_prompt[:20]}..., 时间={generation_time:.2f}秒, 哈希={dialogue_hash}")
+            logger.info(f"成功生成对话 {index}: 提示={user_prompt[:20]}..., 时间={generation_time:.2f}秒, 哈希={dialogue_hash}, "
+                        f"tokens={usage['prompt_tokens']}+{usage['completion_tokens']}")
             print(f"成功生成对话 {index}: 用时 {generation_time:.2f} 秒, 哈希 {dialogue_hash}")
             return True
         else:
@@ -511,14 +603,47 @@ def check_api_model_availability():
         logger.error(f"检查模型可用性时出错: {str(e)}")
         return False
 
+def generate_parallel(progress_bar=None):
+    """
+    路由模式下并发生成所有对话，生成失败的序号在下一轮重试
+    
+    返回:
+        int: 成功数（包括已存在的文件）
+    """
+    pending = list(range(1, NUM_DIALOGUES + 1))
+    successful = 0
+    for round_index in range(MAX_RETRIES):
+        if not pending:
+            break
+        if round_index:
+            logger.warning(f"{len(pending)} 个对话生成失败，{RETRY_DELAY} 秒后重试")
+            print(f"\n{len(pending)} 个对话生成失败，{RETRY_DELAY} 秒后重试...")
+            time.sleep(RETRY_DELAY)
+        failed = []
+        executor = ThreadPoolExecutor(max_workers=MAX_CONCURRENT_REQUESTS)
+        try:
+            futures = {executor.submit(generate_dialogue, index): index for index in pending}
+            for future in as_completed(futures):
+                if future.result():
+                    successful += 1
+                    if progress_bar is not None:
+                        progress_bar.update(1)
+                else:
+                    failed.append(futures[future])
+        finally:
+            executor.shutdown(wait=False, cancel_futures=True)
+        pending = sorted(failed)
+    return successful
+
 def main():
     """主函数：生成所有对话"""
+    global HEDGER, GENERATION_CACHE, ROUTER
     print("\n========== 陆家嘴活动轨迹数据生成 ==========")
     print(f"开始生成 {NUM_DIALOGUES} 个对话，输出目录: {OUTPUT_DIR}")
     print(f"使用模型: {MODEL_NAME}")
     
     # 检查API密钥
-    if not API_KEY or API_KEY == "your_api_key_here" or len(API_KEY) < 10:
+    if not ROUTES_FILE and (not API_KEY or API_KEY == "your_api_key_here" or len(API_KEY) < 10):
         logger.error("API密钥未设置或无效")
         print("⚠️ API密钥未设置或无效，请检查配置")
         return
@@ -549,6 +674,18 @@ def main():
     consecutive_failures = 0
     MAX_CONSECUTIVE_FAILURES = 5
     
+    if RESPONSE_CACHE_DB:
+        GENERATION_CACHE = ResponseCache(RESPONSE_CACHE_DB, CACHE_MAX_MB)
+        print(f"响应缓存: {RESPONSE_CACHE_DB}（生成请求{'读写缓存' if CACHE_GENERATION else '跳过缓存'}）")
+    
+    if ROUTES_FILE:
+        ROUTER = load_routes(ROUTES_FILE)
+        print(f"已启用API路由: {len(ROUTER.routes)} 条路由，并发 {MAX_CONCURRENT_REQUESTS}")
+    
+    if HEDGE_REQUESTS:
+        HEDGER = create_hedger()
+        print(f"已启用对冲请求，预算 {HEDGE_BUDGET * 100:.0f}%")
+    
     # 使用进度条显示处理进度
     if TQDM_AVAILABLE:
         progress_bar = tqdm(total=NUM_DIALOGUES, desc="生成对话")
@@ -556,38 +693,41 @@ def main():
     start_time = time.time()
     
     try:
-        while successful < NUM_DIALOGUES:
-            # 检查连续失败次数
-            if consecutive_failures >= MAX_CONSECUTIVE_FAILURES:
-                logger.warning(f"检测到 {MAX_CONSECUTIVE_FAILURES} 次连续失败，暂停 30 秒后继续...")
-                print(f"\n检测到 {MAX_CONSECUTIVE_FAILURES} 次连续失败，暂停 30 秒后继续...")
-                time.sleep(30)  # 较长暂停以恢复
-                consecutive_failures = 0
+        if ROUTER is not None:
+            successful = generate_parallel(progress_bar if TQDM_AVAILABLE else None)
+        else:
+            while successful < NUM_DIALOGUES:
+                # 检查连续失败次数
+                if consecutive_failures >= MAX_CONSECUTIVE_FAILURES:
+                    logger.warning(f"检测到 {MAX_CONSECUTIVE_FAILURES} 次连续失败，暂停 30 秒后继续...")
+                    print(f"\n检测到 {MAX_CONSECUTIVE_FAILURES} 次连续失败，暂停 30 秒后继续...")
+                    time.sleep(30)  # 较长暂停以恢复
+                    consecutive_failures = 0
             
-            # 尝试生成对话
-            if generate_dialogue(index):
-                successful += 1
-                consecutive_failures = 0  # 重置连续失败计数
-                if TQDM_AVAILABLE:
-                    progress_bar.update(1)
-                index += 1
-            else:
-                consecutive_failures += 1
-                logger.warning(f"对话 {index} 生成失败，这是第 {consecutive_failures} 次连续失败")
-                print(f"对话 {index} 生成失败，这是第 {consecutive_failures} 次连续失败")
-                time.sleep(RETRY_DELAY)
+                # 尝试生成对话
+                if generate_dialogue(index):
+                    successful += 1
+                    consecutive_failures = 0  # 重置连续失败计数
+                    if TQDM_AVAILABLE:
+                        progress_bar.update(1)
+                    index += 1
+                else:
+                    consecutive_failures += 1
+                    logger.warning(f"对话 {index} 生成失败，这是第 {consecutive_failures} 次连续失败")
+                    print(f"对话 {index} 生成失败，这是第 {consecutive_failures} 次连续失败")
+                    time.sleep(RETRY_DELAY)
             
-            # 为避免请求频率限制，添加延迟
-            time.sleep(RATE_LIMIT_DELAY)
+                # 为避免请求频率限制，添加延迟
+                time.sleep(RATE_LIMIT_DELAY)
             
-            # 显示进度
-            if not TQDM_AVAILABLE and successful > 0 and successful % 5 == 0:
-                elapsed = time.time() - start_time
-                rate = successful / elapsed if elapsed > 0 else 0
-                estimated_total = elapsed / successful * NUM_DIALOGUES if successful > 0 else 0
-                remaining = estimated_total - elapsed
-                print(f"进度: {successful}/{NUM_DIALOGUES} ({successful/NUM_DIALOGUES*100:.1f}%), "
-                      f"速率: {rate*60:.2f}个/分钟, 预计剩余时间: {remaining/60:.1f}分钟")
+                # 显示进度
+                if not TQDM_AVAILABLE and successful > 0 and successful % 5 == 0:
+                    elapsed = time.time() - start_time
+                    rate = successful / elapsed if elapsed > 0 else 0
+                    estimated_total = elapsed / successful * NUM_DIALOGUES if successful > 0 else 0
+                    remaining = estimated_total - elapsed
+                    print(f"进度: {successful}/{NUM_DIALOGUES} ({successful/NUM_DIALOGUES*100:.1f}%), "
+                          f"速率: {rate*60:.2f}个/分钟, 预计剩余时间: {remaining/60:.1f}分钟")
     
     except KeyboardInterrupt:
         print("\n用户中断，程序已停止")
@@ -608,6 +748,15 @@ def main():
         logger.info(f"示例文件: {', '.join(sample_files)}")
         print(f"示例文件: {', '.join(sample_files)}")
     
+    if HEDGER is not None:
+        print_hedging_report(HEDGER.report(), "生成请求对冲统计")
+        HEDGER.shutdown()
+    if ROUTER is not None:
+        print_router_report(ROUTER.report(), "生成请求路由统计")
+    if GENERATION_CACHE is not None:
+        print_cache_report(GENERATION_CACHE.report(), "生成响应缓存统计")
+        GENERATION_CACHE.close()
+    
     # 统计运行时间
     total_time = time.time() - start_time
     logger.info(f"总运行时间: {total_time/60:.2f} 分钟")
@@ -0,0 +1,166 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+对冲请求（hedged requests）
+一次调用在运行中的p95延迟内仍未返回时，再发送一个重复请求（可以发往备用模型或接口），
+先成功返回的结果胜出；对冲次数受预算比例限制，并统计开启/不开启对冲时的p99延迟
+"""
+
+import math
+import time
+import threading
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+DEFAULT_QUANTILE = 0.95
+DEFAULT_BUDGET = 0.1   # 对冲请求最多占总调用数的比例
+MIN_SAMPLES = 20       # 积累足够的延迟样本后才开始对冲
+WINDOW = 500           # 计算分位数的滑动窗口大小
+
+
+def percentile(values, q):
+    """最近秩法分位数，q取0-1"""
+    if not values:
+        return None
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, max(0, math.ceil(q * len(ordered)) - 1))]
+
+
+class LatencyTracker:
+    """滑动窗口内的延迟分位数"""
+
+    def __init__(self, window=WINDOW, min_samples=MIN_SAMPLES):
+        self.samples = deque(maxlen=window)
+        self.min_samples = min_samples
+        self.lock = threading.Lock()
+
+    def record(self, latency):
+        with self.lock:
+            self.samples.append(latency)
+
+    def quantile(self, q):
+        """样本不足时返回None"""
+        with self.lock:
+            if len(self.samples) < self.min_samples:
+                return None
+            return percentile(list(self.samples), q)
+
+
+class HedgedCaller:
+    """
+    对冲调用包装器
+
+    参数:
+        primary (callable): 主调用
+        secondary (callable): 对冲时使用的调用（如发往备用模型或接口），默认与主调用相同
+        is_success (callable): 判断结果是否可用，不可用的结果不会胜出（除非两次调用都不可用）
+        quantile (float): 等待主调用多久后对冲，取主调用延迟的该分位数
+        budget (float): 对冲请求数占总调用数的上限
+    """
+
+    def __init__(self, primary, secondary=None, is_success=bool, quantile=DEFAULT_QUANTILE,
+                 budget=DEFAULT_BUDGET, min_samples=MIN_SAMPLES, max_workers=32):
+        self.primary = primary
+        self.secondary = secondary or primary
+        self.is_success = is_success
+        self.quantile = quantile
+        self.budget = budget
+        self.tracker = LatencyTracker(min_samples=min_samples)
+        self.executor = ThreadPoolExecutor(max_workers=max_workers)
+        self.lock = threading.Lock()
+        self.calls = 0
+        self.hedges = 0
+        self.hedge_wins = 0
+        self.latencies = []          # 开启对冲后调用方实际等待的时间
+        self.primary_latencies = []  # 主调用本身的完成时间，即不开启对冲时的延迟
+
+    def _can_hedge(self):
+        with self.lock:
+            return self.hedges + 1 <= self.budget * self.calls
+
+    def _record_primary(self, start):
+        def callback(future):
+            latency = time.time() - start
+            self.tracker.record(latency)
+            with self.lock:
+                self.primary_latencies.append(latency)
+        return callback
+
+    def call(self, *args, **kwargs):
+        """执行一次调用，必要时对冲，返回先成功的结果"""
+        start = time.time()
+        with self.lock:
+            self.calls += 1
+        primary = self.executor.submit(self.primary, *args, **kwargs)
+        primary.add_done_callback(self._record_primary(start))
+
+        threshold = self.tracker.quantile(self.quantile)
+        pending = {primary}
+        if threshold is not None:
+            done, _ = wait(pending, timeout=threshold)
+            if not done and self._can_hedge():
+                with self.lock:
+                    self.hedges += 1
+                print(f"Call still running after {threshold:.1f}s (p{self.quantile * 100:.0f}), sending hedged request")
+                pending.add(self.executor.submit(self.secondary, *args, **kwargs))
+
+        result, winner, fallback = None, None, None
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                try:
+                    value = future.result()
+                except Exception as e:
+                    fallback = fallback or e
+                    continue
+                if self.is_success(value):
+                    result, winner = value, future
+                    break
+                if fallback is None:
+                    fallback = value
+            if winner is not None:
+                break
+
+        with self.lock:
+            self.latencies.append(time.time() - start)
+            if winner is not None and winner is not primary:
+                self.hedge_wins += 1
+        if winner is None:
+            if isinstance(fallback, Exception):
+                raise fallback
+            return fallback
+        # 落败的请求无法取消，在后台线程中自然结束，其延迟仍计入不对冲时的统计
+        return result
+
+    def report(self):
+        """对冲统计：调用数、对冲数、胜出次数和两种情况下的延迟分位数"""
+        with self.lock:
+            latencies = list(self.latencies)
+            primary = list(self.primary_latencies)
+            report = {
+                'calls': self.calls,
+                'hedges': self.hedges,
+                'hedge_rate': self.hedges / self.calls if self.calls else 0.0,
+                'hedge_wins': self.hedge_wins,
+                'budget': self.budget,
+            }
+        for name, values in (('hedged', latencies), ('unhedged', primary)):
+            for q in (0.5, 0.95, 0.99):
+                report[f'{name}_p{int(q * 100)}'] = percentile(values, q)
+        return report
+
+    def shutdown(self, wait_pending=False):
+        self.executor.shutdown(wait=wait_pending)
+
+
+def print_hedging_report(report, title="对冲请求统计"):
+    """打印对冲统计"""
+    def fmt(value):
+        return f"{value:.2f}秒" if value is not None else "-"
+
+    print(f"\n========== {title} ==========")
+    print(f"调用数: {report['calls']}, 对冲请求: {report['hedges']} ({report['hedge_rate'] * 100:.1f}%, "
+          f"预算 {report['budget'] * 100:.0f}%), 对冲请求胜出: {report['hedge_wins']}")
+    for name, label in (('unhedged', '不对冲'), ('hedged', '对冲后')):
+        print(f"{label}: p50 {fmt(report[f'{name}_p50'])}, p95 {fmt(report[f'{name}_p95'])}, "
+              f"p99 {fmt(report[f'{name}_p99'])}")
@@ -0,0 +1,106 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+异步评估工作池
+以有界并发和速率限制调用同步的评估函数（如 eval.evaluate_activity_chain），
+每完成一个任务就在事件循环线程中回调一次，由单一写入方提交结果
+"""
+
+import time
+import queue
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+
+STOP = object()  # 流式任务队列的结束标记
+
+
+class RateLimiter:
+    """令牌桶速率限制器：平均每秒最多 rate 个请求，允许 burst 个突发"""
+
+    def __init__(self, rate, burst=1):
+        self.rate = rate
+        self.capacity = max(1, burst)
+        self.tokens = float(self.capacity)
+        self.updated = time.monotonic()
+        self.lock = asyncio.Lock()
+
+    async def acquire(self):
+        """获取一个令牌，不足时等待"""
+        if not self.rate:
+            return
+        async with self.lock:
+            while True:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                await asyncio.sleep((1 - self.tokens) / self.rate)
+
+
+async def run_pool(items, work_fn, on_result, concurrency=8, rate=None, burst=None):
+    """
+    并发执行任务并在完成时回调
+
+    参数:
+        items (list | queue.Queue): 任务列表，按顺序提交；也可以是线程安全队列，
+            此时持续从队列中取任务直到取到 STOP，队列有界时生产方会被反压
+        work_fn (callable): 同步函数 work_fn(item) -> result，在线程池中执行
+        on_result (callable): on_result(item, result, error)，在事件循环线程中串行调用
+        concurrency (int): 最大并发数
+        rate (float): 每秒最多发起的任务数，None表示不限速
+        burst (int): 令牌桶容量，默认等于并发数
+
+    返回:
+        dict: 完成数、失败数和总耗时
+    """
+    loop = asyncio.get_running_loop()
+    if isinstance(items, queue.Queue):
+        source = items
+    else:
+        source = queue.Queue()
+        for item in items:
+            source.put_nowait(item)
+        source.put_nowait(STOP)
+
+    limiter = RateLimiter(rate, burst or concurrency)
+    stats = {'completed': 0, 'failed': 0}
+    start_time = time.time()
+
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        async def next_item():
+            try:
+                return source.get_nowait()
+            except queue.Empty:
+                # 队列暂时为空时在默认线程池中阻塞等待，不占用评估线程
+                return await loop.run_in_executor(None, source.get)
+
+        async def worker():
+            while True:
+                item = await next_item()
+                if item is STOP:
+                    source.put_nowait(STOP)  # 放回结束标记，让其他工作协程也能退出
+                    return
+                await limiter.acquire()
+                try:
+                    result = await loop.run_in_executor(executor, work_fn, item)
+                    error = None
+                except Exception as e:
+                    result, error = None, e
+                # 回调在事件循环中串行执行，保证结果写入不交错
+                try:
+                    on_result(item, result, error)
+                finally:
+                    stats['failed' if error else 'completed'] += 1
+
+        workers = [asyncio.ensure_future(worker()) for _ in range(max(1, concurrency))]
+        await asyncio.gather(*workers)
+
+    stats['elapsed'] = time.time() - start_time
+    return stats
+
+
+def run_pool_sync(items, work_fn, on_result, concurrency=8, rate=None, burst=None):
+    """run_pool 的同步入口"""
+    return asyncio.run(run_pool(items, work_fn, on_result, concurrency, rate, burst))
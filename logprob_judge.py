@@ -0,0 +1,254 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+本地对数概率评估
+加载本地因果语言模型，不做自由生成：在评估提示词后为每个维度拼接 "- 维度：" 槽位，
+一次批量前向计算读取槽位后分数token(0-10)的概率分布，得到期望分数和置信度。
+四个槽位通过自定义注意力掩码只看到提示词和自身，互不影响，因此一条轨迹只需一次预填充
+"""
+
+import os
+import json
+import time
+import argparse
+
+import torch
+from transformers import AutoModelForCausalLM, AutoTokenizer
+
+from eval import EVALUATION_PROMPT, extract_assistant_content
+from results_store import DIMENSIONS
+
+SCORES = list(range(11))
+DEFAULT_BATCH_SIZE = 4
+
+
+class LogprobJudge:
+    """基于分数token概率分布的本地评估器"""
+
+    def __init__(self, model_path, batch_size=DEFAULT_BATCH_SIZE, device=None, dtype=None):
+        if device is None:
+            device = 'cuda' if torch.cuda.is_available() else 'cpu'
+        if dtype is None:
+            dtype = torch.bfloat16 if device != 'cpu' else torch.float32
+        self.model_name = os.path.basename(os.path.normpath(model_path))
+        self.batch_size = batch_size
+        self.device = device
+
+        self.tokenizer = AutoTokenizer.from_pretrained(model_path, trust_remote_code=True)
+        self.model = AutoModelForCausalLM.from_pretrained(model_path, trust_remote_code=True, dtype=dtype)
+        self.model.to(device)
+        self.model.eval()
+
+        self.slot_ids = [self.encode(f"- {dim}：") for dim in DIMENSIONS]
+        self.digit_ids = [self.score_token(str(d)) for d in range(10)]
+        ten = self.encode("10")
+        # 分词器把10拆成"1"+"0"时，在槽位后追加"1"，再读取下一个token是否为"0"
+        self.ten_id = ten[0] if len(ten) == 1 else None
+
+    def encode(self, text):
+        return self.tokenizer(text, add_special_tokens=False).input_ids
+
+    def score_token(self, text):
+        """单个分数对应的token id（部分分词器会在数字前加空白前缀）"""
+        ids = self.encode(text)
+        if len(ids) == 1:
+            return ids[0]
+        return self.tokenizer.convert_tokens_to_ids(text)
+
+    def build_row(self, activity_chain):
+        """
+        构造一条轨迹的输入
+
+        返回:
+            tuple: (token ids, 位置编号, 段编号, 每个维度需要读取的位置)
+                   段编号0为提示词，i+1为第i个维度的槽位
+        """
+        prompt = EVALUATION_PROMPT.format(activity_chain=activity_chain)
+        text = self.tokenizer.apply_chat_template(
+            [{"role": "system", "content": prompt}], tokenize=False, add_generation_prompt=True
+        )
+        ids = self.encode(text)
+        prompt_len = len(ids)
+        positions = list(range(prompt_len))
+        segments = [0] * prompt_len
+        reads = []
+        for i, slot in enumerate(self.slot_ids):
+            suffix = slot if self.ten_id is not None else slot + [self.digit_ids[1]]
+            start = len(ids)
+            ids.extend(suffix)
+            positions.extend(range(prompt_len, prompt_len + len(suffix)))
+            segments.extend([i + 1] * len(suffix))
+            slot_end = start + len(slot) - 1
+            reads.append((slot_end, None if self.ten_id is not None else slot_end + 1))
+        return ids, positions, segments, reads
+
+    def attention_mask(self, segments, lengths, dtype):
+        """
+        槽位之间相互屏蔽的4D加性注意力掩码
+
+        提示词内部为普通因果注意力；每个槽位可以看到完整提示词和自身之前的token
+        """
+        seg = torch.tensor(segments, device=self.device)
+        length = seg.shape[1]
+        index = torch.arange(length, device=self.device)
+        valid = index.unsqueeze(0) < torch.tensor(lengths, device=self.device).unsqueeze(1)
+        causal = index.unsqueeze(1) >= index.unsqueeze(0)
+        same_or_prompt = (seg.unsqueeze(2) == seg.unsqueeze(1)) | (seg.unsqueeze(1) == 0)
+        allowed = causal.unsqueeze(0) & same_or_prompt & valid.unsqueeze(1)
+        # 填充位置只看自己，避免整行被屏蔽
+        allowed |= torch.eye(length, dtype=torch.bool, device=self.device).unsqueeze(0)
+        mask = torch.zeros(allowed.shape, dtype=dtype, device=self.device)
+        mask.masked_fill_(~allowed, torch.finfo(dtype).min)
+        return mask.unsqueeze(1)
+
+    def score_distribution(self, first_logits, second_logits=None):
+        """由槽位处的logits计算0-10分的概率分布，返回 (分布, 分数token总概率)"""
+        probs = torch.softmax(first_logits.float(), dim=-1)
+        digits = probs[self.digit_ids]
+        if self.ten_id is not None:
+            dist = torch.cat([digits, probs[self.ten_id].unsqueeze(0)])
+        else:
+            p_zero = torch.softmax(second_logits.float(), dim=-1)[self.digit_ids[0]]
+            dist = torch.cat([digits, (digits[1] * p_zero).unsqueeze(0)])
+            dist[1] = digits[1] * (1 - p_zero)
+        mass = float(dist.sum())
+        return dist / max(mass, 1e-12), mass
+
+    @torch.no_grad()
+    def score_batch(self, chains):
+        """
+        一次前向计算评估一批活动链
+
+        返回:
+            list: 每条活动链的 {'scores', 'details', 'prompt_tokens'}
+        """
+        rows = [self.build_row(chain) for chain in chains]
+        lengths = [len(ids) for ids, _, _, _ in rows]
+        max_len = max(lengths)
+        pad_id = self.tokenizer.pad_token_id if self.tokenizer.pad_token_id is not None else 0
+
+        input_ids = torch.full((len(rows), max_len), pad_id, dtype=torch.long)
+        position_ids = torch.zeros((len(rows), max_len), dtype=torch.long)
+        segments = []
+        for b, (ids, positions, segs, _) in enumerate(rows):
+            input_ids[b, :len(ids)] = torch.tensor(ids)
+            position_ids[b, :len(positions)] = torch.tensor(positions)
+            segments.append(segs + [-1] * (max_len - len(segs)))
+
+        dtype = next(self.model.parameters()).dtype
+        mask = self.attention_mask(segments, lengths, dtype)
+        # 只对需要读取的位置计算词表logits，避免生成 batch×长度×词表 的大张量
+        outputs = self.model.base_model(input_ids=input_ids.to(self.device), attention_mask=mask,
+                                        position_ids=position_ids.to(self.device))
+        hidden = outputs[0]
+        lm_head = self.model.get_output_embeddings()
+
+        results = []
+        for b, (_, _, _, reads) in enumerate(rows):
+            read_positions = [p for pair in reads for p in pair if p is not None]
+            logits = dict(zip(read_positions, lm_head(hidden[b, read_positions])))
+            scores, details = {}, {}
+            for dim, (first, second) in zip(DIMENSIONS, reads):
+                dist, mass = self.score_distribution(logits[first], logits.get(second))
+                values = torch.tensor(SCORES, dtype=dist.dtype, device=dist.device)
+                expected = float((dist * values).sum())
+                std = float(((values - expected) ** 2 * dist).sum().sqrt())
+                mode = int(dist.argmax())
+                scores[dim] = round(expected, 2)
+                details[dim] = {
+                    'expected': round(expected, 3),
+                    'mode': mode,
+                    'confidence': round(float(dist[mode]), 4),
+                    'std': round(std, 3),
+                    'score_mass': round(mass, 4),
+                    'distribution': [round(float(p), 4) for p in dist],
+                }
+            results.append({'scores': scores, 'details': details, 'prompt_tokens': lengths[b]})
+        return results
+
+    def judge_files(self, file_paths):
+        """
+        评估一组JSON文件
+
+        返回:
+            list: [(file_path, result)]，result 与 eval.judge_file 的返回值格式相同，
+                  分数为期望分数，各维度的分布和置信度以JSON保存在 raw_response 中
+        """
+        results = []
+        items = []
+        for file_path in file_paths:
+            with open(file_path, 'r', encoding='utf-8') as f:
+                data = json.load(f)
+            activity_chain = extract_assistant_content(data)
+            if not activity_chain:
+                print(f"Warning: Could not extract activity chain from file {file_path}")
+                results.append((file_path, {'record_id': data.get('id'), 'scores': None}))
+                continue
+            items.append((file_path, data.get('id'), activity_chain))
+
+        for start in range(0, len(items), self.batch_size):
+            batch = items[start:start + self.batch_size]
+            batch_start = time.time()
+            scored = self.score_batch([chain for _, _, chain in batch])
+            latency = (time.time() - batch_start) / len(batch)
+            for (file_path, record_id, _), result in zip(batch, scored):
+                usage = {
+                    'model': self.model_name,
+                    'prompt_tokens': result['prompt_tokens'],
+                    'completion_tokens': 0,
+                    'total_tokens': result['prompt_tokens'],
+                    'cached_tokens': 0,
+                    'latency': latency,
+                    'pack_size': len(batch),
+                }
+                results.append((file_path, {'record_id': record_id, 'scores': result['scores'], 'usage': usage,
+                                            'raw_response': json.dumps(result['details'], ensure_ascii=False)}))
+        return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description="使用本地模型的分数token概率评估活动链")
+    parser.add_argument("--model_path", type=str, required=True,
+                        help="本地模型路径")
+    parser.add_argument("--input_folder", type=str, default="/root/for_eval",
+                        help="对话JSON文件所在目录")
+    parser.add_argument("--batch_size", type=int, default=DEFAULT_BATCH_SIZE,
+                        help="每次前向计算的轨迹数")
+    parser.add_argument("--limit", type=int, default=None,
+                        help="最多评估的文件数量")
+    parser.add_argument("--device", type=str, default=None,
+                        help="运行设备，默认有GPU时使用cuda")
+    parser.add_argument("--output", type=str, default=None,
+                        help="将分数和分布另存为JSON文件")
+    args = parser.parse_args()
+
+    json_files = sorted(f for f in os.listdir(args.input_folder) if f.endswith('.json'))[:args.limit]
+    judge = LogprobJudge(args.model_path, batch_size=args.batch_size, device=args.device)
+
+    start = time.time()
+    results = judge.judge_files([os.path.join(args.input_folder, f) for f in json_files])
+    elapsed = time.time() - start
+
+    report = {}
+    tokens = 0
+    for file_path, result in results:
+        file_name = os.path.basename(file_path)
+        if result['scores'] is None:
+            continue
+        tokens += result['usage']['prompt_tokens']
+        details = json.loads(result['raw_response'])
+        report[file_name] = {'id': result['record_id'], 'details': details}
+        summary = ', '.join(f"{dim} {d['expected']:.2f}(置信度 {d['confidence']:.2f})" for dim, d in details.items())
+        print(f"{file_name}: {summary}")
+
+    print(f"\n评估 {len(report)} 条轨迹，耗时 {elapsed:.1f}秒，"
+          f"{len(report) / max(elapsed, 1e-9):.2f} 条/秒，预填充 {tokens / max(elapsed, 1e-9):.0f} tokens/秒")
+
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+        print(f"结果已保存到: {args.output}")
+
+
+if __name__ == "__main__":
+    main()
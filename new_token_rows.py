@@ -0,0 +1,167 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+新增特殊标记的嵌入行训练
+train.py 给 tokenizer 添加了 ChatmlSpecialTokens 并扩展了词表，这些新行需要训练，模型才会使用这些标记。
+配置项 new_token_rows 决定新行的训练方式（与注意力/MLP上的LoRA同时使用）:
+    none: 不训练嵌入和输出层（新行保持扩展词表时的初始值）
+    lean: 冻结 embed_tokens 和 lm_head 的原有行，只训练新增标记的行（peft 的 trainable_token_indices）
+    full: embed_tokens 和 lm_head 整体可训练（peft 的 modules_to_save），可训练参数和优化器状态都按整个词表计算
+
+直接运行时在同一配置下对比各方式的可训练参数量、优化器状态内存和每步耗时:
+    python new_token_rows.py --config configs/train_smoke_cpu.json --steps 10
+"""
+
+import time
+import argparse
+
+import torch
+
+MODES = ('none', 'lean', 'full')
+
+
+def new_token_ids(tokenizer):
+    """train.py 添加的特殊标记的id"""
+    from train import ChatmlSpecialTokens
+
+    ids = tokenizer.convert_tokens_to_ids(ChatmlSpecialTokens.list())
+    return sorted({i for i in ids if i is not None and i != tokenizer.unk_token_id})
+
+
+def embedding_module_names(model):
+    """输入嵌入和输出层的模块名（最后一级），权重共享时输出层为None"""
+    input_embeddings = model.get_input_embeddings()
+    output_embeddings = model.get_output_embeddings()
+    names = {module: name.split('.')[-1] for name, module in model.named_modules()}
+    tied = output_embeddings is None or output_embeddings.weight is input_embeddings.weight
+    return names[input_embeddings], None if tied else names[output_embeddings]
+
+
+def token_row_kwargs(mode, model, tokenizer):
+    """按训练方式返回需要加入 LoraConfig 的参数"""
+    if mode in (None, 'none'):
+        return {}
+    input_name, output_name = embedding_module_names(model)
+    if mode == 'lean':
+        ids = new_token_ids(tokenizer)
+        if not ids:
+            print("tokenizer中没有新增的特殊标记（special_tokens 为 false？），不训练嵌入行")
+            return {}
+        # 共享权重时 peft 会让输出层跟随输入嵌入的新行
+        indices = {input_name: ids}
+        if output_name:
+            indices[output_name] = ids
+        return {'trainable_token_indices': indices}
+    if mode == 'full':
+        return {'modules_to_save': [name for name in (input_name, output_name) if name]}
+    raise ValueError(f"未知的 new_token_rows: {mode}，可选 {', '.join(MODES)}")
+
+
+def expose_output_bias(model):
+    """
+    peft 包装只训练部分行的输出层后只转发 weight（返回合并了新行的权重），trl 的融合输出层还会读取 bias；
+    在包装上补上原输出层的 bias，使融合输出层也使用合并后的权重
+    """
+    output_embeddings = model.get_output_embeddings()
+    original = getattr(output_embeddings, 'original_module', None)
+    if original is not None and 'bias' not in vars(output_embeddings):
+        output_embeddings.bias = original.bias
+
+
+def optimizer_state_bytes(optimizer):
+    """优化器状态（如AdamW的一阶、二阶矩）占用的字节数"""
+    return sum(value.numel() * value.element_size()
+               for state in optimizer.state.values() for value in state.values() if torch.is_tensor(value))
+
+
+def benchmark_mode(config, mode, steps, warmup=1):
+    """
+    按指定方式构造 LoRA 模型并用训练集的前几批训练若干步
+
+    返回:
+        dict: 可训练参数量、优化器状态内存、每步耗时和峰值显存
+    """
+    from peft import get_peft_model
+    from train import build_dataset, build_peft_config, load_model, load_tokenizer
+
+    config = dict(config, new_token_rows=mode)
+    torch.manual_seed(config.get('seed', 42))
+    tokenizer = load_tokenizer(config)
+    texts = build_dataset(config, tokenizer)['train']['text']
+    model = load_model(config, tokenizer)
+    model = get_peft_model(model, build_peft_config(config, model, tokenizer))
+    model.train()
+    trainable = sum(p.numel() for p in model.parameters() if p.requires_grad)
+    total = sum(p.numel() for p in model.parameters())
+    optimizer = torch.optim.AdamW([p for p in model.parameters() if p.requires_grad],
+                                  lr=config['sft'].get('learning_rate', 1e-4))
+
+    sft = config['sft']
+    batch_size = sft.get('per_device_train_batch_size', 1)
+    device = next(model.parameters()).device
+    if torch.cuda.is_available():
+        torch.cuda.reset_peak_memory_stats()
+    elapsed = 0.0
+    for step in range(steps + warmup):
+        start = step * batch_size % max(len(texts), 1)
+        batch = tokenizer(texts[start:start + batch_size], return_tensors='pt', padding=True, truncation=True,
+                          max_length=sft.get('max_length') or 1024, add_special_tokens=False).to(device)
+        labels = batch['input_ids'].masked_fill(batch['attention_mask'] == 0, -100)
+        if torch.cuda.is_available():
+            torch.cuda.synchronize()
+        start_time = time.perf_counter()
+        loss = model(**batch, labels=labels, use_cache=False).loss
+        loss.backward()
+        optimizer.step()
+        optimizer.zero_grad()
+        if torch.cuda.is_available():
+            torch.cuda.synchronize()
+        if step >= warmup:
+            elapsed += time.perf_counter() - start_time
+
+    result = {
+        'mode': mode,
+        'trainable_params': trainable,
+        'trainable_share': trainable / total if total else 0.0,
+        'optimizer_state_mb': optimizer_state_bytes(optimizer) / 2 ** 20,
+        'seconds_per_step': elapsed / steps if steps else 0.0,
+    }
+    if torch.cuda.is_available():
+        result['memory_peak_mb'] = torch.cuda.max_memory_allocated() / 2 ** 20
+    return result
+
+
+def print_benchmark_report(results):
+    """打印各训练方式的对比"""
+    print("\n========== 新增标记嵌入行的训练方式对比 ==========")
+    header = f"{'方式':<8}{'可训练参数':>14}{'占比':>9}{'优化器状态(MB)':>16}{'秒/步':>10}"
+    if 'memory_peak_mb' in results[0]:
+        header += f"{'峰值显存(MB)':>14}"
+    print(header)
+    for result in results:
+        line = (f"{result['mode']:<8}{result['trainable_params']:>14,}{result['trainable_share'] * 100:>8.2f}%"
+                f"{result['optimizer_state_mb']:>16.1f}{result['seconds_per_step']:>10.3f}")
+        if 'memory_peak_mb' in result:
+            line += f"{result['memory_peak_mb']:>14.0f}"
+        print(line)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="对比新增特殊标记嵌入行的几种训练方式")
+    parser.add_argument("--config", type=str, default="configs/train_default.json",
+                        help="train.py 使用的JSON配置文件")
+    parser.add_argument("--set", type=str, nargs='*', default=[], dest="overrides",
+                        help="覆盖配置项，例如 model_path=/path/to/model")
+    parser.add_argument("--modes", type=str, nargs='+', default=list(MODES), choices=MODES,
+                        help="要对比的训练方式")
+    parser.add_argument("--steps", type=int, default=10,
+                        help="每种方式计时的训练步数")
+    args = parser.parse_args()
+
+    from train import load_config
+    config = load_config(args.config, args.overrides)
+    print_benchmark_report([benchmark_mode(config, mode, args.steps) for mode in args.modes])
+
+
+if __name__ == "__main__":
+    main()
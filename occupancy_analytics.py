@@ -0,0 +1,372 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+人群时空占用与OD矩阵统计
+读取 trajectory_store.py 的列式存储，把活动按 时段 × 网格 × 人群画像 累加为占用立方体，
+把出行按 画像 × 出发时段 × 起点网格 × 终点网格 累加为稀疏OD矩阵；
+统计结果保存在 .npz 文件中，新轨迹入库后只处理新增的人，可增量更新
+"""
+
+import os
+import csv
+import json
+import time
+import argparse
+
+import numpy as np
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.parquet as pq
+
+from rule_checks import LUJIAZUI_BBOX
+from spatial_index import EARTH_RADIUS, ORIGIN, project
+from trajectory_parser import SEGMENT_ACTIVITY, SEGMENT_TRIP
+from trajectory_store import ACTIVITIES_DIR, PERSONS_DIR, ingest
+
+CELL_SIZE = 250.0    # 网格边长（米）
+BIN_MINUTES = 60     # 时段长度（分钟）
+UNKNOWN_PERSONA = '未知'
+DEFAULT_STATE = '/root/trajectory_store/occupancy.npz'
+
+ACTIVITY_COLUMNS = ['person_id', 'kind', 'start', 'end', 'lon', 'lat', 'origin_lon', 'origin_lat']
+
+
+class OccupancyCube:
+    """
+    时空占用立方体与OD矩阵
+
+    occupancy[t, c, p]：时段 t 内网格 c 中画像 p 的平均在场人数（停留分钟数 / 时段长度）
+    OD以稀疏的 (key, count) 形式保存，key = ((画像 * (T+1) + 出发时段) * Z + 起点) * Z + 终点，
+    其中 Z = 网格数 + 1，最后一个区域表示陆家嘴范围外；出发时间未知的出行记在第 T 个时段
+    """
+
+    def __init__(self, cell_size=CELL_SIZE, bin_minutes=BIN_MINUTES, bbox=LUJIAZUI_BBOX):
+        # 跨午夜的时间按时段序号取模折回，时段长度必须整除一天，否则折回后的时段与钟点对不上
+        if int(bin_minutes) <= 0 or 24 * 60 % int(bin_minutes):
+            raise ValueError(f"bin_minutes 须能整除1440（一天的分钟数），当前为 {bin_minutes}")
+        self.cell_size = float(cell_size)
+        self.bin_minutes = int(bin_minutes)
+        self.bbox = tuple(bbox)
+        self.bins = 24 * 60 // self.bin_minutes
+        self.x0, self.y0 = (float(v) for v in project(self.bbox[0], self.bbox[1]))
+        x1, y1 = project(self.bbox[2], self.bbox[3])
+        self.cols = int(np.ceil((x1 - self.x0) / self.cell_size))
+        self.rows = int(np.ceil((y1 - self.y0) / self.cell_size))
+        self.cells = self.rows * self.cols
+        self.zones = self.cells + 1
+        self.personas = []
+        self.occupancy = np.zeros((self.bins, self.cells, 0))
+        self.od_keys = np.zeros(0, dtype=np.int64)
+        self.od_counts = np.zeros(0)
+        self.last_person_id = -1
+        self.stats = {'persons': 0, 'activities': 0, 'activities_outside': 0, 'activities_untimed': 0,
+                      'trips': 0, 'trips_untimed': 0}
+
+    # ---------- 网格与画像 ----------
+
+    def cell_of(self, lon, lat):
+        """经纬度 -> 网格编号，范围外或缺失时为-1"""
+        x, y = project(lon, lat)
+        with np.errstate(invalid='ignore'):
+            col = np.floor((x - self.x0) / self.cell_size)
+            row = np.floor((y - self.y0) / self.cell_size)
+            inside = (col >= 0) & (col < self.cols) & (row >= 0) & (row < self.rows)
+        return np.where(inside, np.nan_to_num(row) * self.cols + np.nan_to_num(col), -1).astype(np.int64)
+
+    def cell_center(self, cell):
+        """网格中心的经纬度"""
+        row, col = divmod(int(cell), self.cols)
+        x = self.x0 + (col + 0.5) * self.cell_size
+        y = self.y0 + (row + 0.5) * self.cell_size
+        lat = ORIGIN[1] + np.degrees(y / EARTH_RADIUS)
+        lon = ORIGIN[0] + np.degrees(x / (EARTH_RADIUS * np.cos(np.radians(ORIGIN[1]))))
+        return float(lon), float(lat)
+
+    def persona_ids(self, names):
+        """画像名称 -> 画像编号，遇到新画像时扩展占用立方体"""
+        known = {name: i for i, name in enumerate(self.personas)}
+        ids = []
+        for name in names:
+            name = name or UNKNOWN_PERSONA
+            if name not in known:
+                known[name] = len(self.personas)
+                self.personas.append(name)
+            ids.append(known[name])
+        grow = len(self.personas) - self.occupancy.shape[2]
+        if grow > 0:
+            self.occupancy = np.concatenate([self.occupancy, np.zeros((self.bins, self.cells, grow))], axis=2)
+        return np.asarray(ids, dtype=np.int64)
+
+    # ---------- 累加 ----------
+
+    def add_activities(self, persona, start, end, lon, lat):
+        """把一批活动的停留时间按时段拆分后累加到占用立方体"""
+        cell = self.cell_of(lon, lat)
+        timed = ~np.isnan(start) & ~np.isnan(end) & (end > start)
+        self.stats['activities'] += len(cell)
+        self.stats['activities_outside'] += int((cell < 0).sum())
+        self.stats['activities_untimed'] += int((~timed).sum())
+        keep = timed & (cell >= 0)
+        persona, start, end, cell = persona[keep], start[keep], end[keep], cell[keep]
+        if not len(cell):
+            return
+
+        # 每条活动展开为它覆盖的每个时段，计算在该时段内停留的分钟数
+        width = self.bin_minutes
+        first = np.floor(start / width).astype(np.int64)
+        last = np.floor((end - 1e-9) / width).astype(np.int64)
+        counts = last - first + 1
+        row = np.repeat(np.arange(len(cell)), counts)
+        absolute = np.repeat(first, counts) + np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+        overlap = (np.minimum(end[row], (absolute + 1) * width) - np.maximum(start[row], absolute * width)) / width
+        # 跨午夜的活动折回到当天对应的时段
+        time_bin = absolute % self.bins
+
+        n_personas = len(self.personas)
+        flat = (time_bin * self.cells + cell[row]) * n_personas + persona[row]
+        self.occupancy += np.bincount(flat, weights=overlap, minlength=self.occupancy.size).reshape(
+            self.occupancy.shape)
+
+    def add_trips(self, persona, start, origin_lon, origin_lat, lon, lat):
+        """把一批出行累加到稀疏OD矩阵；范围外的起终点记为外部区域"""
+        located = ~np.isnan(origin_lon) & ~np.isnan(lon)
+        persona, start = persona[located], start[located]
+        origin = self.cell_of(origin_lon[located], origin_lat[located])
+        destination = self.cell_of(lon[located], lat[located])
+        origin[origin < 0] = self.cells
+        destination[destination < 0] = self.cells
+        with np.errstate(invalid='ignore'):
+            time_bin = np.where(np.isnan(start), self.bins,
+                                np.floor(np.nan_to_num(start) / self.bin_minutes) % self.bins).astype(np.int64)
+        self.stats['trips'] += len(origin)
+        self.stats['trips_untimed'] += int((time_bin == self.bins).sum())
+
+        keys = ((persona * (self.bins + 1) + time_bin) * self.zones + origin) * self.zones + destination
+        keys = np.concatenate([self.od_keys, keys])
+        counts = np.concatenate([self.od_counts, np.ones(len(keys) - len(self.od_keys))])
+        self.od_keys, inverse = np.unique(keys, return_inverse=True)
+        self.od_counts = np.bincount(inverse.ravel(), weights=counts, minlength=len(self.od_keys))
+
+    def update_from_store(self, store_dir):
+        """读取存储中 person_id 大于上次处理位置的新增人员并累加，返回新增人数"""
+        start_time = time.time()
+        persons_dir = os.path.join(store_dir, PERSONS_DIR)
+        if not os.path.isdir(persons_dir):
+            return 0
+        watermark = [('person_id', '>', self.last_person_id)]
+        persons = pq.read_table(persons_dir, columns=['person_id', 'persona_type'], filters=watermark,
+                                memory_map=True)
+        if persons.num_rows == 0:
+            return 0
+        activities = pq.read_table(os.path.join(store_dir, ACTIVITIES_DIR), columns=ACTIVITY_COLUMNS,
+                                   filters=watermark, memory_map=True)
+
+        # 画像只对不同取值做一次映射
+        persona_type = pc.fill_null(persons['persona_type'].cast(pa.string()), UNKNOWN_PERSONA)
+        unique = pc.unique(persona_type)
+        person_persona = self.persona_ids(unique.to_pylist())[
+            pc.index_in(persona_type, value_set=unique).to_numpy(zero_copy_only=False)]
+
+        person_ids = persons['person_id'].to_numpy()
+        order = np.argsort(person_ids, kind='stable')
+        persona = person_persona[order[np.searchsorted(person_ids, activities['person_id'].to_numpy(), sorter=order)]]
+
+        def column(name):
+            return activities[name].to_numpy(zero_copy_only=False).astype(np.float64)
+
+        kind = activities['kind'].cast(pa.string())
+        is_activity = pc.equal(kind, SEGMENT_ACTIVITY).to_numpy(zero_copy_only=False)
+        is_trip = pc.equal(kind, SEGMENT_TRIP).to_numpy(zero_copy_only=False)
+        start, end, lon, lat = column('start'), column('end'), column('lon'), column('lat')
+        self.add_activities(persona[is_activity], start[is_activity], end[is_activity],
+                            lon[is_activity], lat[is_activity])
+        self.add_trips(persona[is_trip], start[is_trip], column('origin_lon')[is_trip],
+                       column('origin_lat')[is_trip], lon[is_trip], lat[is_trip])
+
+        self.last_person_id = int(person_ids.max())
+        self.stats['persons'] += persons.num_rows
+        print(f"Added {persons.num_rows} persons, {activities.num_rows} records in {time.time() - start_time:.2f}s")
+        return persons.num_rows
+
+    # ---------- 查询 ----------
+
+    def _persona_index(self, persona):
+        if persona is None:
+            return slice(None)
+        return self.personas.index(persona)
+
+    def occupancy_grid(self, time_bin, persona=None):
+        """某个时段的在场人数网格（rows × cols）"""
+        values = self.occupancy[time_bin][:, self._persona_index(persona)]
+        if values.ndim == 2:
+            values = values.sum(axis=1)
+        return values.reshape(self.rows, self.cols)
+
+    def hourly_totals(self, persona=None):
+        """各时段陆家嘴范围内的在场人数"""
+        values = self.occupancy[:, :, self._persona_index(persona)]
+        return values.reshape(self.bins, -1).sum(axis=1)
+
+    def decode_od(self):
+        """稀疏OD的键拆分为 (画像, 出发时段, 起点, 终点)"""
+        keys = self.od_keys
+        destination = keys % self.zones
+        origin = keys // self.zones % self.zones
+        rest = keys // (self.zones * self.zones)
+        return rest // (self.bins + 1), rest % (self.bins + 1), origin, destination
+
+    def od_matrix(self, persona=None, time_bins=None):
+        """按画像和出发时段筛选后的OD矩阵（Z × Z 稠密数组，最后一行/列为范围外）"""
+        persona_id, time_bin, origin, destination = self.decode_od()
+        mask = np.ones(len(self.od_keys), dtype=bool)
+        if persona is not None:
+            mask &= persona_id == self.personas.index(persona)
+        if time_bins is not None:
+            mask &= np.isin(time_bin, list(time_bins))
+        matrix = np.bincount(origin[mask] * self.zones + destination[mask], weights=self.od_counts[mask],
+                             minlength=self.zones * self.zones)
+        return matrix.reshape(self.zones, self.zones)
+
+    def top_flows(self, k=10, persona=None):
+        """出行次数最多的OD对（不区分出发时段）"""
+        matrix = self.od_matrix(persona)
+        flat = np.argsort(matrix, axis=None)[::-1][:k]
+        return [(int(i // self.zones), int(i % self.zones), float(matrix.flat[i])) for i in flat if matrix.flat[i] > 0]
+
+    def zone_label(self, zone):
+        if zone == self.cells:
+            return '范围外'
+        row, col = divmod(int(zone), self.cols)
+        return f"({row},{col})"
+
+    # ---------- 保存与读取 ----------
+
+    def meta(self):
+        return {'cell_size': self.cell_size, 'bin_minutes': self.bin_minutes, 'bbox': list(self.bbox),
+                'personas': self.personas, 'last_person_id': self.last_person_id, 'stats': self.stats}
+
+    def save(self, path):
+        """原子写入 .npz 状态文件"""
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        tmp_path = path + '.tmp.npz'
+        np.savez_compressed(tmp_path, occupancy=self.occupancy, od_keys=self.od_keys, od_counts=self.od_counts,
+                            meta=np.array(json.dumps(self.meta(), ensure_ascii=False)))
+        os.replace(tmp_path, path)
+
+    @classmethod
+    def load(cls, path):
+        with np.load(path) as data:
+            meta = json.loads(str(data['meta']))
+            cube = cls(meta['cell_size'], meta['bin_minutes'], meta['bbox'])
+            cube.occupancy = data['occupancy']
+            cube.od_keys = data['od_keys']
+            cube.od_counts = data['od_counts']
+        cube.personas = meta['personas']
+        cube.last_person_id = meta['last_person_id']
+        cube.stats = meta['stats']
+        return cube
+
+
+def open_cube(state_path, cell_size=CELL_SIZE, bin_minutes=BIN_MINUTES, rebuild=False):
+    """读取已有的统计状态；网格或时段设置变化、或要求重建时重新开始"""
+    if state_path and os.path.exists(state_path) and not rebuild:
+        cube = OccupancyCube.load(state_path)
+        if cube.cell_size == float(cell_size) and cube.bin_minutes == int(bin_minutes):
+            return cube
+        print("Grid or time-bin settings changed, rebuilding from scratch")
+    return OccupancyCube(cell_size, bin_minutes)
+
+
+def export_csv(cube, export_dir):
+    """导出非零的占用格和OD对"""
+    os.makedirs(export_dir, exist_ok=True)
+    occupancy_file = os.path.join(export_dir, 'occupancy.csv')
+    with open(occupancy_file, 'w', newline='', encoding='utf-8') as f:
+        writer = csv.writer(f)
+        writer.writerow(['time_bin', 'start_minute', 'cell', 'row', 'col', 'lon', 'lat', 'persona', 'people'])
+        centers = {}
+        for t, c, p in zip(*np.nonzero(cube.occupancy)):
+            if c not in centers:
+                centers[c] = cube.cell_center(c)
+            row, col = divmod(int(c), cube.cols)
+            writer.writerow([int(t), int(t) * cube.bin_minutes, int(c), row, col, round(centers[c][0], 6),
+                             round(centers[c][1], 6), cube.personas[p], round(float(cube.occupancy[t, c, p]), 4)])
+
+    od_file = os.path.join(export_dir, 'od.csv')
+    persona_id, time_bin, origin, destination = cube.decode_od()
+    with open(od_file, 'w', newline='', encoding='utf-8') as f:
+        writer = csv.writer(f)
+        writer.writerow(['persona', 'time_bin', 'origin', 'destination', 'trips'])
+        for p, t, o, d, count in zip(persona_id, time_bin, origin, destination, cube.od_counts):
+            writer.writerow([cube.personas[p], int(t) if t < cube.bins else '', cube.zone_label(o),
+                             cube.zone_label(d), int(count)])
+    print(f"Exported {occupancy_file} and {od_file}")
+
+
+def print_analytics_report(cube, top=5):
+    """打印占用和OD概况"""
+    s = cube.stats
+    print("\n========== 时空占用与OD统计 ==========")
+    print(f"网格: {cube.rows}×{cube.cols}（{cube.cell_size:.0f}米）, 时段: {cube.bins}×{cube.bin_minutes}分钟, "
+          f"画像: {len(cube.personas)}")
+    print(f"人数: {s['persons']}, 活动: {s['activities']}（范围外 {s['activities_outside']}, 无时间 "
+          f"{s['activities_untimed']}）, 出行: {s['trips']}（无时间 {s['trips_untimed']}）")
+    if not cube.personas:
+        return
+    totals = cube.hourly_totals()
+    peak = int(np.argmax(totals))
+    print(f"高峰时段: {peak * cube.bin_minutes // 60:02d}:{peak * cube.bin_minutes % 60:02d} 起，"
+          f"平均在场 {totals[peak]:.1f} 人")
+    grid = cube.occupancy_grid(peak).ravel()
+    print("高峰时段在场人数最多的网格:")
+    for cell in np.argsort(grid)[::-1][:top]:
+        if grid[cell] > 0:
+            lon, lat = cube.cell_center(cell)
+            print(f"  {cube.zone_label(cell)} ({lon:.5f}, {lat:.5f}): {grid[cell]:.1f} 人")
+    print("各画像全天在场人时:")
+    person_hours = cube.occupancy.sum(axis=(0, 1)) * cube.bin_minutes / 60
+    for p in np.argsort(person_hours)[::-1]:
+        print(f"  {cube.personas[p]}: {person_hours[p]:.1f}")
+    print("出行次数最多的OD对:")
+    for origin, destination, count in cube.top_flows(top):
+        print(f"  {cube.zone_label(origin)} -> {cube.zone_label(destination)}: {count:.0f}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="从轨迹存储计算人群时空占用和OD矩阵")
+    parser.add_argument("--store_dir", type=str, default="/root/trajectory_store",
+                        help="trajectory_store.py 生成的Parquet存储目录")
+    parser.add_argument("--ingest", type=str, nargs='*', default=None,
+                        help="先把这些目录中的新对话文件增量写入存储")
+    parser.add_argument("--state", type=str, default=DEFAULT_STATE,
+                        help="统计状态文件(.npz)，再次运行时只处理新增的人")
+    parser.add_argument("--cell_size", type=float, default=CELL_SIZE,
+                        help="网格边长（米）")
+    parser.add_argument("--bin_minutes", type=int, default=BIN_MINUTES,
+                        help="时段长度（分钟），须能整除1440")
+    parser.add_argument("--rebuild", action="store_true",
+                        help="忽略已有状态，从头统计")
+    parser.add_argument("--export_dir", type=str, default=None,
+                        help="导出占用和OD的CSV文件目录")
+    args = parser.parse_args()
+    if args.bin_minutes <= 0 or 24 * 60 % args.bin_minutes:
+        parser.error("--bin_minutes 须能整除1440（一天的分钟数）")
+
+    if args.ingest:
+        ingest(args.ingest, args.store_dir)
+    cube = open_cube(args.state, args.cell_size, args.bin_minutes, args.rebuild)
+    added = cube.update_from_store(args.store_dir)
+    if added:
+        cube.save(args.state)
+        print(f"State saved to {args.state}")
+    else:
+        print("No new persons since last update")
+    print_analytics_report(cube)
+    if args.export_dir:
+        export_csv(cube, args.export_dir)
+
+
+if __name__ == "__main__":
+    main()
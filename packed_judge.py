@@ -0,0 +1,284 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+打包评估：在一次请求中用同一份评分标准(rubric)评估K条活动链
+评分标准放在提示词最前面，作为各请求共享的固定前缀；每条活动链带编号，
+回复中按编号解析出K个评分块，缺失或不完整的条目退回单条评估
+"""
+
+import os
+import re
+import json
+import time
+import random
+import argparse
+
+from eval import (
+    EVALUATION_PROMPT,
+    extract_assistant_content,
+    evaluate_activity_chain,
+    judge_file,
+    parse_evaluation_scores,
+    send_judge_request,
+)
+from results_store import DIMENSIONS
+
+DEFAULT_PACK_SIZE = 5
+
+# 复用单条评估的评分标准部分，只替换输出格式要求
+RUBRIC = EVALUATION_PROMPT.split('## 输出格式要求')[0]
+
+PACKED_EVALUATION_PROMPT = RUBRIC + """## 输出格式要求
+本次提供多条相互独立的活动链，每条以 <活动链 编号="ID"> 开始、以 </活动链> 结束。请逐条独立评估，不要相互比较，并严格按照以下结构为每条活动链输出一个评分块：
+### 编号：ID
+- 时间逻辑一致性：X分
+- 活动目的连贯性：X分
+- 人物画像匹配度：X分
+- 活动真实性与丰富度：X分
+
+其中ID为活动链的编号，X为0到10之间的整数。请按编号顺序输出全部评分块，请勿添加任何额外文字或解释。
+
+请评估以下{count}条活动链内容：
+{items}"""
+
+# 评分块标题在行首，模型有时省略 ### 或改用加粗（**编号：A1**），都按标题处理
+BLOCK_HEADER = re.compile(r'^[ \t]*(?:#+\s*|\*\*)?编号\s*[：:]\s*([A-Za-z0-9_\-]+)', re.MULTILINE)
+SCORE_PATTERNS = {dim: re.compile(re.escape(dim) + r'\s*\**\s*[：:]\s*\**\s*(\d+)') for dim in DIMENSIONS}
+
+
+def build_packed_prompt(items):
+    """
+    构造打包评估提示词
+
+    参数:
+        items (list): [(item_id, activity_chain), ...]
+
+    返回:
+        str: 完整提示词
+    """
+    blocks = [f'<活动链 编号="{item_id}">\n{chain}\n</活动链>' for item_id, chain in items]
+    return PACKED_EVALUATION_PROMPT.format(count=len(items), items='\n\n'.join(blocks))
+
+
+def parse_packed_scores(evaluation_text, item_ids):
+    """
+    从打包评估的回复中解析每个编号的分数
+
+    只返回四个维度都能解析出的条目，缺失或不完整的条目由调用方单独重新评估
+
+    返回:
+        dict: {item_id: {维度: 分数}}
+    """
+    results = {}
+    if not evaluation_text:
+        return results
+
+    wanted = set(item_ids)
+    headers = list(BLOCK_HEADER.finditer(evaluation_text))
+    for i, header in enumerate(headers):
+        item_id = header.group(1)
+        if item_id not in wanted or item_id in results:
+            continue
+        end = headers[i + 1].start() if i + 1 < len(headers) else len(evaluation_text)
+        block = evaluation_text[header.end():end]
+
+        scores = {}
+        for dim, pattern in SCORE_PATTERNS.items():
+            match = pattern.search(block)
+            if match:
+                scores[dim] = max(0, min(10, int(match.group(1))))
+        if len(scores) == len(DIMENSIONS):
+            results[item_id] = scores
+    return results
+
+
+def split_usage(usage, count, pack_size):
+    """将一次打包请求的用量平均分摊到每条活动链"""
+    share = {'model': usage.get('model'), 'pack_size': pack_size,
+             'attempts': usage.get('attempts', 0), 'latency': usage.get('latency', 0.0) / max(count, 1)}
+    for key in ('prompt_tokens', 'completion_tokens', 'total_tokens', 'cached_tokens', 'rubric_tokens_est'):
+        share[key] = int(round(usage.get(key, 0) / max(count, 1)))
+    return share
+
+
+def evaluate_packed(items, model="gpt-4o-mini-2024-07-18", usage_out=None):
+    """
+    一次请求评估多条活动链
+
+    参数:
+        items (list): [(item_id, activity_chain), ...]
+
+    返回:
+        dict: {item_id: {维度: 分数}}，只包含成功解析的条目
+    """
+    prompt = build_packed_prompt(items)
+    usage = {}
+    evaluation_text = send_judge_request(prompt, model, usage)
+
+    total_chars = len(prompt)
+    rubric_chars = len(RUBRIC)
+    usage['rubric_tokens_est'] = int(round(usage.get('prompt_tokens', 0) * rubric_chars / total_chars)) if total_chars else 0
+    if usage_out is not None:
+        usage_out.update(usage)
+        usage_out['raw_response'] = evaluation_text
+
+    return parse_packed_scores(evaluation_text, [item_id for item_id, _ in items])
+
+
+def judge_files_packed(file_paths, model="gpt-4o-mini-2024-07-18"):
+    """
+    打包评估一组JSON文件，解析失败的条目退回单条评估
+
+    返回:
+        list: [(file_path, result)]，result 与 eval.judge_file 的返回值格式相同
+    """
+    results = []
+    items = []
+    records = {}
+    for i, file_path in enumerate(file_paths):
+        with open(file_path, 'r', encoding='utf-8') as f:
+            data = json.load(f)
+        activity_chain = extract_assistant_content(data)
+        if not activity_chain:
+            print(f"Warning: Could not extract activity chain from file {file_path}")
+            results.append((file_path, {'record_id': data.get('id'), 'scores': None}))
+            continue
+        item_id = f"T{i + 1}"
+        items.append((item_id, activity_chain))
+        records[item_id] = (file_path, data.get('id'))
+
+    if not items:
+        return results
+    if len(items) == 1:
+        # 只剩一条时直接使用单条评估的提示词
+        file_path, _ = records[items[0][0]]
+        results.append((file_path, judge_file(file_path)))
+        return results
+
+    print(f"\nEvaluating {len(items)} activity chains in one packed request...")
+    usage = {}
+    scores_by_id = evaluate_packed(items, model, usage)
+    share = split_usage(usage, len(items), len(items))
+
+    for item_id, _ in items:
+        file_path, record_id = records[item_id]
+        if item_id in scores_by_id:
+            results.append((file_path, {'record_id': record_id, 'scores': scores_by_id[item_id],
+                                        'usage': share, 'raw_response': usage.get('raw_response')}))
+        else:
+            # 打包回复中缺失该条目，单独重新评估
+            print(f"Item {item_id} ({os.path.basename(file_path)}) missing from packed response, re-evaluating alone")
+            results.append((file_path, judge_file(file_path)))
+    return results
+
+
+def compare_modes(file_paths, pack_size, model="gpt-4o-mini-2024-07-18"):
+    """对同一批活动链分别进行单条评估和打包评估，比较每条轨迹的tokens、耗时和分数一致性"""
+    chains = []
+    for file_path in file_paths:
+        with open(file_path, 'r', encoding='utf-8') as f:
+            chain = extract_assistant_content(json.load(f))
+        if chain:
+            chains.append((f"T{len(chains) + 1}", chain))
+
+    single = {'tokens': 0, 'prompt_tokens': 0, 'time': 0.0, 'scored': 0, 'scores': {}}
+    for item_id, chain in chains:
+        usage = {}
+        start = time.time()
+        text = evaluate_activity_chain(chain, model, usage)
+        single['time'] += time.time() - start
+        single['tokens'] += usage.get('prompt_tokens', 0) + usage.get('completion_tokens', 0)
+        single['prompt_tokens'] += usage.get('prompt_tokens', 0)
+        if text:
+            single['scores'][item_id] = parse_evaluation_scores(text)
+            single['scored'] += 1
+
+    packed = {'tokens': 0, 'prompt_tokens': 0, 'time': 0.0, 'scored': 0, 'requeued': 0, 'scores': {}}
+    for start_index in range(0, len(chains), pack_size):
+        pack = chains[start_index:start_index + pack_size]
+        usage = {}
+        start = time.time()
+        parsed = evaluate_packed(pack, model, usage)
+        packed['tokens'] += usage.get('prompt_tokens', 0) + usage.get('completion_tokens', 0)
+        packed['prompt_tokens'] += usage.get('prompt_tokens', 0)
+        for item_id, chain in pack:
+            if item_id not in parsed:
+                # 与正式流程一致：缺失条目单独重新评估，并计入打包模式的成本
+                packed['requeued'] += 1
+                retry_usage = {}
+                text = evaluate_activity_chain(chain, model, retry_usage)
+                packed['tokens'] += retry_usage.get('prompt_tokens', 0) + retry_usage.get('completion_tokens', 0)
+                packed['prompt_tokens'] += retry_usage.get('prompt_tokens', 0)
+                if text:
+                    parsed[item_id] = parse_evaluation_scores(text)
+        packed['time'] += time.time() - start
+        packed['scores'].update(parsed)
+        packed['scored'] += sum(1 for item_id, _ in pack if item_id in parsed)
+
+    agreement = {}
+    common = [item_id for item_id in single['scores'] if item_id in packed['scores']]
+    for dim in DIMENSIONS:
+        diffs = [abs(single['scores'][i][dim] - packed['scores'][i][dim]) for i in common]
+        agreement[dim] = {
+            'mean_abs_diff': sum(diffs) / len(diffs) if diffs else 0.0,
+            'exact_match': sum(1 for d in diffs if d == 0) / len(diffs) if diffs else 0.0,
+            'within_1': sum(1 for d in diffs if d <= 1) / len(diffs) if diffs else 0.0,
+        }
+
+    report = {'pack_size': pack_size, 'trajectories': len(chains), 'compared': len(common), 'agreement': agreement}
+    for name, stats in (('single', single), ('packed', packed)):
+        scored = max(stats['scored'], 1)
+        report[name] = {
+            'scored': stats['scored'],
+            'tokens_per_trajectory': stats['tokens'] / scored,
+            'prompt_tokens_per_trajectory': stats['prompt_tokens'] / scored,
+            'seconds_per_trajectory': stats['time'] / scored,
+        }
+    report['packed']['requeued'] = packed['requeued']
+    return report
+
+
+def print_comparison(report):
+    """打印单条评估与打包评估的对比结果"""
+    print("\n========== 单条评估 vs 打包评估 ==========")
+    print(f"轨迹数: {report['trajectories']}, 打包大小: {report['pack_size']}, 可比较条目: {report['compared']}")
+    for name, title in (('single', '单条'), ('packed', '打包')):
+        s = report[name]
+        print(f"[{title}] 成功评分: {s['scored']}, 每条tokens: {s['tokens_per_trajectory']:.1f} "
+              f"(输入 {s['prompt_tokens_per_trajectory']:.1f}), 每条耗时: {s['seconds_per_trajectory']:.2f}秒")
+    print(f"打包模式中单独重新评估的条目: {report['packed']['requeued']}")
+    print("\n分数一致性:")
+    for dim, a in report['agreement'].items():
+        print(f"  {dim}: 平均绝对差 {a['mean_abs_diff']:.2f}, 完全一致 {a['exact_match'] * 100:.1f}%, "
+              f"相差≤1分 {a['within_1'] * 100:.1f}%")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="比较单条评估与打包评估的成本、耗时和分数一致性")
+    parser.add_argument("--input_folder", type=str, default="/root/for_eval",
+                        help="对话JSON文件所在目录")
+    parser.add_argument("--sample", type=int, default=40,
+                        help="随机抽取用于比较的文件数量")
+    parser.add_argument("--pack_size", type=int, default=DEFAULT_PACK_SIZE,
+                        help="每次请求打包的活动链数量")
+    parser.add_argument("--seed", type=int, default=42,
+                        help="抽样随机种子")
+    parser.add_argument("--json", type=str, default=None,
+                        help="将对比报告另存为JSON文件")
+    args = parser.parse_args()
+
+    json_files = sorted(f for f in os.listdir(args.input_folder) if f.endswith('.json'))
+    random.Random(args.seed).shuffle(json_files)
+    file_paths = [os.path.join(args.input_folder, f) for f in json_files[:args.sample]]
+
+    report = compare_modes(file_paths, args.pack_size)
+    print_comparison(report)
+
+    if args.json:
+        with open(args.json, 'w', encoding='utf-8') as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+        print(f"\n报告已保存到: {args.json}")
+
+
+if __name__ == "__main__":
+    main()
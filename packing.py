@@ -0,0 +1,218 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+SFT 的序列打包与按长度分桶
+打包：按长度把多条样本装进不超过 max_length 的行（best-fit decreasing），每条样本的 position_ids 从0开始，
+不传 attention_mask，transformers 据此为 sdpa/eager 生成按样本分块的因果掩码（flash attention 则按 position_ids 走变长路径），
+样本之间互不可见，也不会用上一条样本的末尾预测下一条样本的开头；
+按样本分块只在没有KV缓存时生效，前向需传 use_cache=False（SFTTrainer.compute_loss 已这样做）
+分桶：不打包时用 Trainer 的 group_by_length 采样，长度相近的样本放在同一批，减少填充
+
+用法:
+    python packing.py --config configs/train_smoke_cpu.json --set data.pretokenized_dir=autodl-tmp/datas/pretokenized --steps 20
+"""
+
+import time
+import bisect
+import argparse
+
+import numpy as np
+import torch
+from datasets import Dataset
+
+IGNORE_INDEX = -100
+MODES = ('pad', 'bucket', 'pack')
+
+
+def pack_by_length(lengths, max_length):
+    """
+    best-fit decreasing 装箱：从长到短依次放进剩余空间最小且放得下的行
+
+    返回:
+        list[list[int]]: 每行包含的样本在 lengths 中的位置
+    """
+    lengths = np.asarray(lengths, dtype=np.int64)
+    remaining = []  # 按 (剩余空间, 行号) 排序
+    packs = []
+    for i in np.argsort(-lengths, kind='stable'):
+        length = int(lengths[i])
+        position = bisect.bisect_left(remaining, (length, -1))
+        if position < len(remaining):
+            space, row = remaining.pop(position)
+            packs[row].append(int(i))
+            space -= length
+        else:
+            row = len(packs)
+            packs.append([int(i)])
+            space = max_length - length
+        if space > 0:
+            bisect.insort(remaining, (space, row))
+    return packs
+
+
+def to_packed_dataset(shards, indices, max_length, loss_mask=False):
+    """
+    把预分词样本打包成行，返回供 SFTTrainer 使用的数据集（配合 PackedCollator）
+
+    每行包含 input_ids、labels、position_ids 和 length（行内的有效token数）
+    """
+    indices = np.asarray(indices, dtype=np.int64)
+    packs = [indices[pack].tolist() for pack in pack_by_length(shards.lengths[indices], max_length)]
+
+    def fetch(batch):
+        output = {'input_ids': [], 'labels': [], 'position_ids': [], 'length': []}
+        for pack in batch['pack']:
+            examples = [shards.example(index, loss_mask) for index in pack]
+            labels = [example_labels.copy() for _, example_labels in examples]
+            for example_labels in labels:
+                example_labels[0] = IGNORE_INDEX
+            output['input_ids'].append(np.concatenate([ids for ids, _ in examples]))
+            output['labels'].append(np.concatenate(labels))
+            output['position_ids'].append(np.concatenate([np.arange(len(ids)) for ids, _ in examples]))
+            output['length'].append(sum(len(ids) for ids, _ in examples))
+        return output
+
+    dataset = Dataset.from_dict({'pack': packs, 'length': [int(shards.lengths[pack].sum()) for pack in packs]})
+    dataset.set_transform(fetch)
+    return dataset
+
+
+class PackedCollator:
+    """
+    把打包后的行补齐到同一长度
+
+    末尾的填充作为单独的一段（position_ids 重新从0开始，标签为-100），不返回 attention_mask
+    """
+
+    def __init__(self, pad_token_id, pad_to_multiple_of=None):
+        self.pad_token_id = pad_token_id
+        self.pad_to_multiple_of = pad_to_multiple_of
+
+    def __call__(self, examples):
+        width = max(len(example['input_ids']) for example in examples)
+        if self.pad_to_multiple_of:
+            width = -(-width // self.pad_to_multiple_of) * self.pad_to_multiple_of
+        input_ids = torch.full((len(examples), width), self.pad_token_id, dtype=torch.long)
+        labels = torch.full((len(examples), width), IGNORE_INDEX, dtype=torch.long)
+        position_ids = torch.arange(width, dtype=torch.long).repeat(len(examples), 1)
+        for row, example in enumerate(examples):
+            n = len(example['input_ids'])
+            input_ids[row, :n] = torch.as_tensor(example['input_ids'])
+            labels[row, :n] = torch.as_tensor(example['labels'])
+            position_ids[row, :n] = torch.as_tensor(example['position_ids'])
+            position_ids[row, n:] = torch.arange(width - n)
+        return {'input_ids': input_ids, 'labels': labels, 'position_ids': position_ids}
+
+
+def padding_ratio(lengths, order, batch_size):
+    """按给定顺序每 batch_size 行组成一批、补齐到批内最长行时，填充token所占的比例"""
+    lengths = np.asarray(lengths, dtype=np.int64)[np.asarray(order, dtype=np.int64)]
+    padded = 0
+    for start in range(0, len(lengths), batch_size):
+        batch = lengths[start:start + batch_size]
+        padded += len(batch) * int(batch.max())
+    return 1 - lengths.sum() / padded if padded else 0.0
+
+
+def benchmark_mode(config, mode, steps, warmup=1):
+    """
+    用配置中的模型和LoRA设置按指定批处理方式训练若干步
+
+    返回:
+        dict: 整个训练集的填充比例，以及计时步数内的有效 tokens/秒 和每步耗时
+    """
+    from peft import get_peft_model
+    from transformers.trainer_pt_utils import LengthGroupedSampler, get_length_grouped_indices
+    from trl.trainer.sft_trainer import DataCollatorForLanguageModeling
+    from pretokenize import prepare_pretokenized
+    from train import build_peft_config, load_model, load_tokenizer
+
+    config = dict(config, data=dict(config['data'], batching=mode))
+    torch.manual_seed(config.get('seed', 42))
+    tokenizer = load_tokenizer(config)
+    train_dataset, _, _ = prepare_pretokenized(config, tokenizer)
+    lengths = np.asarray(train_dataset.with_format(None)['length'][:], dtype=np.int64)
+    batch_size = config['sft'].get('per_device_train_batch_size', 1)
+
+    if mode == 'bucket':
+        sampler = LengthGroupedSampler(batch_size, lengths=lengths.tolist())
+        order = get_length_grouped_indices(lengths.tolist(), batch_size)
+    else:
+        sampler = torch.utils.data.RandomSampler(train_dataset)
+        order = np.random.default_rng(config.get('seed', 42)).permutation(len(lengths))
+    if mode == 'pack':
+        collator = PackedCollator(tokenizer.pad_token_id)
+    else:
+        collator = DataCollatorForLanguageModeling(pad_token_id=tokenizer.pad_token_id)
+
+    def collate(examples):
+        rows = [{key: example[key] for key in example if key != 'length'} for example in examples]
+        return sum(example['length'] for example in examples), collator(rows)
+
+    loader = torch.utils.data.DataLoader(train_dataset, batch_size=batch_size, sampler=sampler, collate_fn=collate)
+    model = load_model(config, tokenizer)
+    model = get_peft_model(model, build_peft_config(config, model, tokenizer))
+    model.train()
+    optimizer = torch.optim.AdamW([p for p in model.parameters() if p.requires_grad],
+                                  lr=config['sft'].get('learning_rate', 1e-4))
+
+    tokens = timed_steps = 0
+    elapsed = 0.0
+    iterator = iter(loader)
+    for step in range(steps + warmup):
+        try:
+            real_tokens, batch = next(iterator)
+        except StopIteration:
+            iterator = iter(loader)
+            real_tokens, batch = next(iterator)
+        start_time = time.time()
+        loss = model(**batch, use_cache=False).loss
+        loss.backward()
+        optimizer.step()
+        optimizer.zero_grad()
+        if step >= warmup:
+            elapsed += time.time() - start_time
+            tokens += real_tokens
+            timed_steps += 1
+
+    return {
+        'mode': mode,
+        'rows': len(lengths),
+        'padding_ratio': padding_ratio(lengths, order, batch_size),
+        'tokens_per_second': tokens / elapsed if elapsed else 0.0,
+        'seconds_per_step': elapsed / timed_steps if timed_steps else 0.0,
+        'attn_implementation': model.config._attn_implementation,
+    }
+
+
+def print_benchmark_report(results):
+    """打印各批处理方式的对比"""
+    print("\n========== 批处理方式对比 ==========")
+    print(f"注意力实现: {results[0]['attn_implementation']}")
+    print(f"{'方式':<8}{'行数':>8}{'填充比例':>10}{'有效tokens/秒':>16}{'秒/步':>10}")
+    for result in results:
+        print(f"{result['mode']:<8}{result['rows']:>8}{result['padding_ratio'] * 100:>9.1f}%"
+              f"{result['tokens_per_second']:>16.1f}{result['seconds_per_step']:>10.3f}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="对比直接补齐、按长度分桶和打包三种批处理方式的吞吐量和填充比例")
+    parser.add_argument("--config", type=str, default="configs/train_default.json",
+                        help="train.py 使用的JSON配置文件，需设置 data.pretokenized_dir")
+    parser.add_argument("--set", type=str, nargs='*', default=[], dest="overrides",
+                        help="覆盖配置项，例如 sft.per_device_train_batch_size=8")
+    parser.add_argument("--modes", type=str, nargs='+', default=list(MODES), choices=MODES,
+                        help="要对比的批处理方式")
+    parser.add_argument("--steps", type=int, default=20,
+                        help="每种方式计时的训练步数")
+    args = parser.parse_args()
+
+    from train import load_config
+    config = load_config(args.config, args.overrides)
+    if not config['data'].get('pretokenized_dir'):
+        parser.error("需要在配置中设置 data.pretokenized_dir（见 pretokenize.py）")
+    print_benchmark_report([benchmark_mode(config, mode, args.steps) for mode in args.modes])
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,308 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+生成轨迹的困惑度评分
+加载基础模型或微调模型，不做生成：把对话文件中的提示词和 model_response 拼接后批量前向，计算回复部分每个token的负对数似然，
+按一级标题分为人物画像、活动轨迹和主观评价三段分别给出困惑度；样本按长度排序后按token预算组批，减少填充。
+困惑度在整个语料中用中位数/MAD的稳健z分数找出异常（过高为不通顺或格式错乱，过低多为重复退化），
+可在调用LLM评估前作为低成本的质量信号
+
+用法:
+    python perplexity_score.py --model_path autodl-tmp/ljz_qwen2.5-7b --input_folder /root/for_eval --output ppl.csv
+"""
+
+import os
+import csv
+import json
+import math
+import time
+import argparse
+
+import numpy as np
+import torch
+import torch.nn.functional as F
+from transformers import AutoModelForCausalLM, AutoTokenizer
+
+# (段名, 一级标题中的关键字)，标题之前或不认识的标题记为 other
+SECTIONS = [('persona', '基本信息'), ('activity', '活动轨迹'), ('evaluation', '评价')]
+SECTION_NAMES = [name for name, _ in SECTIONS] + ['other']
+PROMPT_SECTION = -1
+DEFAULT_BATCH_TOKENS = 16384
+LOGITS_CHUNK = 4096        # 每次计算词表logits的位置数，避免生成 batch×长度×词表 的大张量
+OUTLIER_Z = 3.5            # 稳健z分数（0.6745·(x-中位数)/MAD）的绝对值超过该值视为异常
+MIN_SECTION_TOKENS = 8     # 少于该token数的段不参与异常判定
+
+
+def load_items(input_folder, file_names):
+    """读取对话JSON文件，返回 [(file_name, record_id, (system_message, user_prompt, model_response))]"""
+    items = []
+    for file_name in file_names:
+        try:
+            with open(os.path.join(input_folder, file_name), 'r', encoding='utf-8') as f:
+                data = json.load(f)
+        except (OSError, json.JSONDecodeError):
+            continue
+        if isinstance(data, dict) and data.get('model_response') and not data['model_response'].startswith('Error:'):
+            items.append((file_name, data.get('id'),
+                          (data.get('system_message'), data.get('user_prompt'), data['model_response'])))
+    return items
+
+
+def split_sections(text):
+    """按一级标题把回复切分为 [(段编号, 文本)]，拼接后与原文一致"""
+    parts = []
+    current = len(SECTIONS)  # other
+    buffer = []
+    for line in text.splitlines(keepends=True):
+        stripped = line.strip().strip('*')
+        if stripped.startswith('# ') or stripped.startswith('#\t'):
+            section = next((i for i, (_, keyword) in enumerate(SECTIONS) if keyword in stripped), len(SECTIONS))
+            if buffer and section != current:
+                parts.append((current, ''.join(buffer)))
+                buffer = []
+            current = section
+        buffer.append(line)
+    if buffer:
+        parts.append((current, ''.join(buffer)))
+    return parts
+
+
+def build_prompt(tokenizer, system_message, user_prompt):
+    """与生成时一致的提示词；聊天模板不支持system角色时把system内容并入用户消息"""
+    messages = [{'role': 'system', 'content': system_message or ''}, {'role': 'user', 'content': user_prompt or ''}]
+    try:
+        return tokenizer.apply_chat_template(messages, tokenize=False, add_generation_prompt=True)
+    except Exception:
+        merged = [{'role': 'user', 'content': (system_message or '') + '\n\n' + (user_prompt or '')}]
+        return tokenizer.apply_chat_template(merged, tokenize=False, add_generation_prompt=True)
+
+
+class PerplexityScorer:
+    """按段计算回复负对数似然的本地评分器"""
+
+    def __init__(self, model_path, adapter_dir=None, batch_tokens=DEFAULT_BATCH_TOKENS, device=None, dtype=None):
+        if device is None:
+            device = 'cuda' if torch.cuda.is_available() else 'cpu'
+        if dtype is None:
+            dtype = torch.bfloat16 if device != 'cpu' else torch.float32
+        self.device = device
+        self.batch_tokens = batch_tokens
+        self.model_name = os.path.basename(os.path.normpath(adapter_dir or model_path))
+
+        self.tokenizer = AutoTokenizer.from_pretrained(adapter_dir or model_path, trust_remote_code=True)
+        self.model = AutoModelForCausalLM.from_pretrained(model_path, trust_remote_code=True, dtype=dtype)
+        if adapter_dir:
+            from peft import PeftModel
+
+            if len(self.tokenizer) != self.model.get_input_embeddings().weight.shape[0]:
+                self.model.resize_token_embeddings(len(self.tokenizer))
+            self.model = PeftModel.from_pretrained(self.model, adapter_dir).merge_and_unload()
+        self.model.to(device)
+        self.model.eval()
+        self.pad_id = self.tokenizer.pad_token_id if self.tokenizer.pad_token_id is not None else 0
+
+    def encode(self, items):
+        """
+        分词
+
+        参数:
+            items: [(system_message, user_prompt, model_response)]
+
+        返回:
+            list: 每条的 (token ids, 每个token的段编号)，提示词部分段编号为 PROMPT_SECTION
+        """
+        prompts = [build_prompt(self.tokenizer, system, user) for system, user, _ in items]
+        parts = [split_sections(response) for _, _, response in items]
+        # 所有提示词和各段文本一次批量分词
+        texts = prompts + [text for sections in parts for _, text in sections]
+        encoded = self.tokenizer(texts, add_special_tokens=False).input_ids
+        prompt_ids, section_ids = encoded[:len(prompts)], iter(encoded[len(prompts):])
+        rows = []
+        for ids, sections in zip(prompt_ids, parts):
+            ids = list(ids)
+            labels = [PROMPT_SECTION] * len(ids)
+            for section, _ in sections:
+                tokens = next(section_ids)
+                ids.extend(tokens)
+                labels.extend([section] * len(tokens))
+            rows.append((ids, labels))
+        return rows
+
+    def batches(self, lengths):
+        """按长度从长到短排序，每批的 行数×最长长度 不超过token预算"""
+        order = np.argsort(-np.asarray(lengths), kind='stable')
+        batch, width = [], 0
+        for index in order.tolist():
+            new_width = max(width, lengths[index])
+            if batch and new_width * (len(batch) + 1) > self.batch_tokens:
+                yield batch
+                batch, new_width = [], lengths[index]
+            batch.append(index)
+            width = new_width
+        if batch:
+            yield batch
+
+    @torch.inference_mode()
+    def score_batch(self, rows):
+        """
+        一次前向计算一批样本各段的负对数似然之和与token数
+
+        返回:
+            ndarray: [行数, 段数, 2]，最后一维为 (NLL之和, token数)
+        """
+        width = max(len(ids) for ids, _ in rows)
+        input_ids = torch.full((len(rows), width), self.pad_id, dtype=torch.long)
+        attention_mask = torch.zeros((len(rows), width), dtype=torch.long)
+        sections = torch.full((len(rows), width), PROMPT_SECTION, dtype=torch.long)
+        for b, (ids, labels) in enumerate(rows):
+            input_ids[b, :len(ids)] = torch.tensor(ids)
+            attention_mask[b, :len(ids)] = 1
+            sections[b, :len(labels)] = torch.tensor(labels)
+        input_ids, attention_mask = input_ids.to(self.device), attention_mask.to(self.device)
+
+        hidden = self.model.base_model(input_ids=input_ids, attention_mask=attention_mask)[0]
+        # 位置t的隐状态预测第t+1个token，只对回复中的token计算词表logits
+        targets = input_ids[:, 1:]
+        target_sections = sections[:, 1:].to(self.device)
+        rows_index, positions = torch.nonzero(target_sections != PROMPT_SECTION, as_tuple=True)
+        lm_head = self.model.get_output_embeddings()
+        nll = torch.empty(len(positions), dtype=torch.float32, device=self.device)
+        for start in range(0, len(positions), LOGITS_CHUNK):
+            r, p = rows_index[start:start + LOGITS_CHUNK], positions[start:start + LOGITS_CHUNK]
+            logits = lm_head(hidden[r, p]).float()
+            nll[start:start + LOGITS_CHUNK] = F.cross_entropy(logits, targets[r, p], reduction='none')
+
+        flat = rows_index * len(SECTION_NAMES) + target_sections[rows_index, positions]
+        size = len(rows) * len(SECTION_NAMES)
+        totals = torch.zeros(size, dtype=torch.float64, device=self.device).index_add_(0, flat, nll.double())
+        counts = torch.bincount(flat, minlength=size).double()
+        return torch.stack([totals, counts], dim=1).view(len(rows), len(SECTION_NAMES), 2).cpu().numpy()
+
+    def score(self, items, progress_every=50):
+        """
+        评分一组样本
+
+        返回:
+            ndarray: [样本数, 段数, 2]，顺序与 items 一致
+        """
+        rows = self.encode(items)
+        result = np.zeros((len(rows), len(SECTION_NAMES), 2))
+        for n, batch in enumerate(self.batches([len(ids) for ids, _ in rows])):
+            result[batch] = self.score_batch([rows[i] for i in batch])
+            if progress_every and (n + 1) % progress_every == 0:
+                print(f"已完成 {n + 1} 批")
+        return result
+
+
+def to_records(items, scores):
+    """每条轨迹各段的困惑度；某段没有token时为None"""
+    records = []
+    for (file_name, record_id, _), stats in zip(items, scores):
+        record = {'file': file_name, 'id': record_id}
+        total_nll, total_tokens = stats[:, 0].sum(), stats[:, 1].sum()
+        record['tokens'] = int(total_tokens)
+        record['nll'] = total_nll / total_tokens if total_tokens else None
+        record['ppl'] = math.exp(record['nll']) if total_tokens else None
+        for section, (nll, tokens) in zip(SECTION_NAMES, stats):
+            record[f'{section}_tokens'] = int(tokens)
+            record[f'{section}_ppl'] = math.exp(nll / tokens) if tokens else None
+        records.append(record)
+    return records
+
+
+def flag_outliers(records, threshold=OUTLIER_Z, min_tokens=MIN_SECTION_TOKENS):
+    """
+    按段用对数困惑度（即平均NLL）的稳健z分数标记异常，结果写入每条记录的 flags
+
+    high 表示困惑度异常高，low 表示异常低；缺少画像、轨迹或评价段记为 missing
+    """
+    for record in records:
+        record['flags'] = []
+    for section in ['all'] + [name for name, _ in SECTIONS]:
+        key, tokens_key = ('ppl', 'tokens') if section == 'all' else (f'{section}_ppl', f'{section}_tokens')
+        if section != 'all':
+            for record in records:
+                if not record[tokens_key]:
+                    record['flags'].append(f'{section}:missing')
+        valid = [r for r in records if r[key] and r[tokens_key] >= min_tokens]
+        if len(valid) < 3:
+            continue
+        values = np.log([r[key] for r in valid])
+        median = np.median(values)
+        mad = np.median(np.abs(values - median))
+        if mad == 0:
+            continue
+        for record, value in zip(valid, values):
+            z = 0.6745 * (value - median) / mad
+            if abs(z) > threshold:
+                record['flags'].append(f"{section}:{'high' if z > 0 else 'low'}")
+    return records
+
+
+def save_records(records, output_file):
+    """保存每条轨迹的各段困惑度和异常标记"""
+    fields = ['file', 'id', 'tokens', 'ppl'] + [f'{s}_{k}' for s in SECTION_NAMES for k in ('tokens', 'ppl')] + ['flags']
+    with open(output_file, 'w', newline='', encoding='utf-8') as f:
+        writer = csv.DictWriter(f, fieldnames=fields, extrasaction='ignore')
+        writer.writeheader()
+        for record in records:
+            writer.writerow(dict(record, flags=';'.join(record['flags'])))
+    print(f"结果已保存到: {output_file}")
+
+
+def print_perplexity_report(records, elapsed, top=10):
+    """打印各段困惑度分布、异常和吞吐量"""
+    print("\n========== 困惑度评分 ==========")
+    tokens = sum(r['tokens'] for r in records)
+    print(f"轨迹数: {len(records)}, 回复tokens: {tokens}, 用时 {elapsed:.1f}秒, "
+          f"{len(records) / max(elapsed, 1e-9) * 60:.0f} 条/分钟, {tokens / max(elapsed, 1e-9):.0f} tokens/秒")
+    print(f"{'段':<12}{'中位数':>10}{'P10':>10}{'P90':>10}{'覆盖':>8}")
+    for section in ['all'] + SECTION_NAMES:
+        key = 'ppl' if section == 'all' else f'{section}_ppl'
+        values = [r[key] for r in records if r[key]]
+        if not values:
+            continue
+        p10, median, p90 = np.percentile(values, [10, 50, 90])
+        print(f"{section:<12}{median:>10.2f}{p10:>10.2f}{p90:>10.2f}{len(values) / len(records) * 100:>7.1f}%")
+    flagged = [r for r in records if r['flags']]
+    print(f"异常轨迹: {len(flagged)} 条")
+    for record in sorted(flagged, key=lambda r: -(r['ppl'] or 0))[:top]:
+        print(f"  {record['file']}: 困惑度 {record['ppl'] or 0:.2f}, {', '.join(record['flags'])}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="按段计算生成轨迹的困惑度并标记异常")
+    parser.add_argument("--model_path", type=str, required=True,
+                        help="基础模型或导出的微调模型路径")
+    parser.add_argument("--adapter_dir", type=str, default=None,
+                        help="LoRA适配器目录（train.py 的 final_model），加载后合并进 --model_path")
+    parser.add_argument("--input_folder", type=str, default="/root/for_eval",
+                        help="对话JSON文件所在目录")
+    parser.add_argument("--batch_tokens", type=int, default=DEFAULT_BATCH_TOKENS,
+                        help="每批 行数×最长长度 的上限")
+    parser.add_argument("--limit", type=int, default=None,
+                        help="最多评分的文件数量")
+    parser.add_argument("--threshold", type=float, default=OUTLIER_Z,
+                        help="判定异常的稳健z分数阈值")
+    parser.add_argument("--device", type=str, default=None,
+                        help="运行设备，默认有GPU时使用cuda")
+    parser.add_argument("--output", type=str, default=None,
+                        help="保存每条轨迹结果的CSV路径")
+    args = parser.parse_args()
+
+    file_names = sorted(f for f in os.listdir(args.input_folder) if f.endswith('.json'))[:args.limit]
+    items = load_items(args.input_folder, file_names)
+
+    scorer = PerplexityScorer(args.model_path, args.adapter_dir, args.batch_tokens, args.device)
+    start = time.time()
+    scores = scorer.score([texts for _, _, texts in items])
+    elapsed = time.time() - start
+
+    records = flag_outliers(to_records(items, scores), args.threshold)
+    print_perplexity_report(records, elapsed)
+    if args.output:
+        save_records(records, args.output)
+
+
+if __name__ == "__main__":
+    main()
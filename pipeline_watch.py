@@ -0,0 +1,328 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+流式生成→评估流水线
+监听生成脚本的输出目录（优先使用inotify，不可用时轮询），对话文件一写完就放入有界队列，
+由 judge_pool 的工作池立即评估并写入结果库；队列积压过多时暂停生成进程（反压），
+使端到端耗时接近 max(生成, 评估) 而不是两者之和
+"""
+
+import os
+import json
+import time
+import queue
+import signal
+import argparse
+import threading
+import subprocess
+
+from eval import (
+    MAX_WORKERS,
+    REQUESTS_PER_SECOND,
+    RESULTS_DB,
+    commit_result,
+    judge_file,
+    open_results_store,
+)
+from judge_pool import STOP, run_pool_sync
+
+try:
+    from inotify_simple import INotify, flags as inotify_flags
+    INOTIFY_AVAILABLE = True
+except ImportError:
+    INOTIFY_AVAILABLE = False
+
+DEFAULT_QUEUE_SIZE = 32
+POLL_INTERVAL = 2.0  # 轮询间隔（秒）
+
+
+class DirectoryWatcher:
+    """监听目录中新写完的JSON文件"""
+
+    def __init__(self, folder, poll_interval=POLL_INTERVAL, use_inotify=True):
+        self.folder = folder
+        self.poll_interval = poll_interval
+        self.inotify = None
+        self.pending = {}  # 轮询模式下尚未稳定的文件 -> (大小, 修改时间)
+        if use_inotify and INOTIFY_AVAILABLE:
+            self.inotify = INotify()
+            # 原子改名写入触发MOVED_TO，直接写入的文件在关闭时触发CLOSE_WRITE
+            self.inotify.add_watch(folder, inotify_flags.CLOSE_WRITE | inotify_flags.MOVED_TO)
+
+    @property
+    def mode(self):
+        return 'inotify' if self.inotify else 'polling'
+
+    def existing(self):
+        """启动时目录中已有的JSON文件"""
+        return sorted(f for f in os.listdir(self.folder) if f.endswith('.json'))
+
+    def poll(self):
+        """等待一个监听周期，返回这段时间内写完的JSON文件名列表"""
+        if self.inotify:
+            events = self.inotify.read(timeout=1000)
+            return sorted({e.name for e in events if e.name.endswith('.json')})
+
+        time.sleep(self.poll_interval)
+        ready = []
+        current = {}
+        with os.scandir(self.folder) as entries:
+            for entry in entries:
+                if entry.name.endswith('.json') and entry.is_file():
+                    stat = entry.stat()
+                    current[entry.name] = (stat.st_size, stat.st_mtime)
+        for name, signature in current.items():
+            # 连续两次扫描大小和修改时间都不变，才认为文件已经写完
+            if self.pending.get(name) == signature:
+                ready.append(name)
+        self.pending = {name: sig for name, sig in current.items() if name not in ready}
+        return sorted(ready)
+
+    def close(self):
+        if self.inotify:
+            self.inotify.close()
+
+
+def is_complete_json(file_path):
+    """非原子写入的文件可能只写了一半，入队前确认能解析"""
+    try:
+        with open(file_path, 'r', encoding='utf-8') as f:
+            json.load(f)
+        return True
+    except (OSError, ValueError):
+        return False
+
+
+def signal_generator(process, sig):
+    """
+    向生成进程所在的进程组发送信号
+
+    生成命令经 /bin/sh 启动并且自成一个进程组（start_new_session），只向 shell 发信号时
+    复合命令中真正的生成进程收不到；进程组已不存在时忽略
+    """
+    try:
+        os.killpg(process.pid, sig)
+    except ProcessLookupError:
+        pass
+
+
+class Backpressure:
+    """按队列积压暂停/恢复生成进程组：超过高水位时发送SIGSTOP，降到低水位以下时发送SIGCONT"""
+
+    def __init__(self, process, high, low):
+        self.process = process
+        self.high = high
+        self.low = low
+        self.paused = False
+        self.pauses = 0
+        self.paused_time = 0.0
+        self.paused_at = None
+
+    def update(self, backlog):
+        if self.process is None or self.process.poll() is not None:
+            return
+        if not self.paused and backlog >= self.high:
+            signal_generator(self.process, signal.SIGSTOP)
+            self.paused, self.paused_at = True, time.time()
+            self.pauses += 1
+            print(f"Backlog {backlog} >= {self.high}, pausing generator")
+        elif self.paused and backlog <= self.low:
+            self.resume()
+            print(f"Backlog {backlog} <= {self.low}, resuming generator")
+
+    def resume(self):
+        if self.paused:
+            signal_generator(self.process, signal.SIGCONT)
+            self.paused_time += time.time() - self.paused_at
+            self.paused = False
+
+
+def watch_directory(watcher, file_queue, skip, landed, stop_event, process=None,
+                    idle_timeout=None, backpressure=None):
+    """
+    生产者：把新写完的文件放入队列，队列满时阻塞（反压）
+
+    结束条件：生成进程退出后目录中没有新文件，或未指定生成进程时空闲超过 idle_timeout 秒
+    """
+    seen = set(skip)
+    last_new = time.time()
+
+    def enqueue(names):
+        nonlocal last_new
+        for name in names:
+            if name in seen or stop_event.is_set():
+                continue
+            path = os.path.join(watcher.folder, name)
+            if not is_complete_json(path):
+                continue  # 之后的写入事件或扫描会再次发现它
+            seen.add(name)
+            landed[name] = time.time()
+            last_new = landed[name]
+            while not stop_event.is_set():
+                if backpressure:
+                    backpressure.update(file_queue.qsize())
+                try:
+                    file_queue.put(name, timeout=1.0)
+                    break
+                except queue.Full:
+                    continue
+
+    try:
+        enqueue(watcher.existing())
+        while not stop_event.is_set():
+            generator_done = process is not None and process.poll() is not None
+            enqueue(watcher.poll())
+            if backpressure:
+                backpressure.update(file_queue.qsize())
+            if generator_done:
+                # 生成进程已退出：最后完整扫描一次目录，避免遗漏
+                enqueue(watcher.existing())
+                break
+            if process is None and idle_timeout and time.time() - last_new > idle_timeout:
+                print(f"No new files for {idle_timeout}s, stopping watcher")
+                break
+    finally:
+        if backpressure:
+            backpressure.resume()
+        file_queue.put(STOP)
+
+
+def run_pipeline(input_folder, output_file, db_path=RESULTS_DB, max_workers=MAX_WORKERS,
+                 requests_per_second=REQUESTS_PER_SECOND, queue_size=DEFAULT_QUEUE_SIZE,
+                 command=None, idle_timeout=60, poll_interval=POLL_INTERVAL, use_inotify=True):
+    """
+    边生成边评估
+
+    参数:
+        command (str): 可选的生成命令（如 "python get_qwen_output.py"），由流水线启动并在积压时暂停
+        queue_size (int): 待评估队列容量，也是暂停生成进程的高水位
+
+    返回:
+        dict: 评估数、失败数、端到端耗时、生成耗时和文件落盘到写入结果库的延迟
+    """
+    os.makedirs(input_folder, exist_ok=True)
+    store = open_results_store(db_path, output_file)
+    watcher = DirectoryWatcher(input_folder, poll_interval, use_inotify)
+    file_queue = queue.Queue(maxsize=queue_size)
+    stop_event = threading.Event()
+    landed = {}
+    lags = []
+
+    start_time = time.time()
+    process = subprocess.Popen(command, shell=True, start_new_session=True) if command else None
+    backpressure = Backpressure(process, high=queue_size, low=max(queue_size // 4, 1)) if process else None
+    print(f"Watching {input_folder} ({watcher.mode}), workers: {max_workers}, queue size: {queue_size}")
+    generator_exit = []
+    waiter = None
+    if process:
+        print(f"Started generator (pid {process.pid}): {command}")
+
+        def wait_generator():
+            process.wait()
+            generator_exit.append(time.time())
+
+        waiter = threading.Thread(target=wait_generator, daemon=True)
+        waiter.start()
+
+    producer = threading.Thread(
+        target=watch_directory,
+        args=(watcher, file_queue, store.processed_files(), landed, stop_event, process, idle_timeout, backpressure),
+        daemon=True,
+    )
+    producer.start()
+
+    def on_result(file_name, result, error):
+        if error is not None:
+            # 不标记为已处理，以便下次重试
+            print(f"Error processing file {file_name}: {str(error)}")
+            return
+        commit_result(store, file_name, result)
+        lags.append(time.time() - landed[file_name])
+
+    try:
+        stats = run_pool_sync(file_queue, lambda name: judge_file(os.path.join(input_folder, name)), on_result,
+                              concurrency=max_workers, rate=requests_per_second)
+        generation_time = None
+        if waiter:
+            waiter.join()
+            generation_time = generator_exit[0] - start_time
+        store.flush()
+        store.export_csv(output_file)
+    except KeyboardInterrupt:
+        print("\n用户中断，程序已停止")
+        stats = {'completed': len(lags), 'failed': 0}
+        generation_time = None
+    finally:
+        stop_event.set()
+        if process:
+            # shell 已退出时进程组里仍可能有后台启动的生成进程，整个进程组一起结束
+            if backpressure:
+                backpressure.resume()
+            signal_generator(process, signal.SIGTERM)
+        producer.join(timeout=5)
+        watcher.close()
+        store.close()
+
+    lags.sort()
+    return {
+        'completed': stats['completed'],
+        'failed': stats['failed'],
+        'elapsed': time.time() - start_time,
+        'generation_time': generation_time,
+        'watch_mode': watcher.mode,
+        'generator_pauses': backpressure.pauses if backpressure else 0,
+        'generator_paused_seconds': backpressure.paused_time if backpressure else 0.0,
+        'lag_mean': sum(lags) / len(lags) if lags else 0.0,
+        'lag_p95': lags[min(len(lags) - 1, int(len(lags) * 0.95))] if lags else 0.0,
+        'lag_max': lags[-1] if lags else 0.0,
+    }
+
+
+def print_pipeline_report(report):
+    """打印流水线运行结果"""
+    print("\n========== 流水线运行结果 ==========")
+    print(f"监听方式: {report['watch_mode']}")
+    print(f"评估完成: {report['completed']}, 失败: {report['failed']}, 端到端耗时: {report['elapsed']:.1f}秒")
+    if report['generation_time'] is not None:
+        print(f"生成进程耗时: {report['generation_time']:.1f}秒, "
+              f"评估拖尾: {report['elapsed'] - report['generation_time']:.1f}秒")
+        print(f"因积压暂停生成: {report['generator_pauses']} 次, 共 {report['generator_paused_seconds']:.1f}秒")
+    print(f"文件落盘到评估入库的延迟: 平均 {report['lag_mean']:.1f}秒, "
+          f"p95 {report['lag_p95']:.1f}秒, 最大 {report['lag_max']:.1f}秒")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="监听生成输出目录，边生成边评估")
+    parser.add_argument("--input_folder", type=str, default="/root/for_eval",
+                        help="生成脚本的输出目录")
+    parser.add_argument("--output_file", type=str, default="/root/for_eval/result.csv",
+                        help="结束时导出的CSV文件")
+    parser.add_argument("--db", type=str, default=RESULTS_DB,
+                        help="评估结果数据库")
+    parser.add_argument("--workers", type=int, default=MAX_WORKERS,
+                        help="并发评估请求数")
+    parser.add_argument("--rps", type=float, default=REQUESTS_PER_SECOND,
+                        help="每秒最多发起的评估请求数（0表示不限速）")
+    parser.add_argument("--queue_size", type=int, default=DEFAULT_QUEUE_SIZE,
+                        help="待评估队列容量，积压达到该值时暂停生成进程")
+    parser.add_argument("--run", type=str, default=None,
+                        help="由流水线启动的生成命令，例如 \"python get_qwen_output.py\"")
+    parser.add_argument("--idle_timeout", type=float, default=60,
+                        help="未指定--run时，连续多少秒没有新文件后结束")
+    parser.add_argument("--poll_interval", type=float, default=POLL_INTERVAL,
+                        help="轮询模式的扫描间隔（秒）")
+    parser.add_argument("--no_inotify", action="store_true",
+                        help="强制使用轮询模式")
+    args = parser.parse_args()
+
+    if not args.no_inotify and not INOTIFY_AVAILABLE:
+        print("提示: 未安装inotify_simple库，使用轮询监听目录。可以通过 'pip install inotify_simple' 安装。")
+
+    report = run_pipeline(args.input_folder, args.output_file, args.db, args.workers, args.rps,
+                          args.queue_size, args.run, args.idle_timeout, args.poll_interval,
+                          not args.no_inotify)
+    print_pipeline_report(report)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,207 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+按目标分布合成人群
+把目标分布（各属性的占比，如人群画像、年龄段、主要出行方式）展开为逐人的条件提示词：每个属性按最大余数法分配人数，
+独立打乱后组合，各属性的边际分布与目标完全一致；提示词相同的人放进同一批，批内共用一次提示词的前向（前缀缓存）；
+轨迹生成后解析其中的画像和出行方式，跟踪已完成部分的实际分布与目标分布的差距
+
+目标分布文件示例见 configs/population_default.json，供 finetuned_inference.py --population 使用
+"""
+
+import re
+import json
+import hashlib
+import random
+from collections import Counter
+
+from trajectory_parser import SEGMENT_TRIP, parse_trajectory
+
+PERSONA_KEY = '陆家嘴活动人群画像'
+TRAVEL_MODE_KEY = '主要出行方式'  # 轨迹中出现次数最多的出行方式，不是画像字段
+OTHER_VALUE = '其他'
+AGE_RANGE = re.compile(r'^\s*(\d+)\s*[-–~至]\s*(\d+)\s*岁?\s*$')
+NUMBER = re.compile(r'\d+(?:\.\d+)?')
+
+
+def load_spec(path):
+    """
+    读取目标分布
+
+    格式: {"size": 人数, "attributes": {属性名: {取值: 占比, ...}, ...}}，属性的先后顺序即提示词中的顺序，
+    占比不必归一化
+    """
+    with open(path, 'r', encoding='utf-8') as f:
+        spec = json.load(f)
+    for name, weights in spec.get('attributes', {}).items():
+        if not weights or any(w < 0 for w in weights.values()) or sum(weights.values()) <= 0:
+            raise ValueError(f"属性 {name} 的占比无效: {weights}")
+    return spec
+
+
+def allocate(weights, total):
+    """按占比把 total 个人分配给各取值（最大余数法，合计恰为 total）"""
+    norm = sum(weights.values())
+    exact = {value: total * weight / norm for value, weight in weights.items()}
+    counts = {value: int(share) for value, share in exact.items()}
+    for value in sorted(exact, key=lambda v: exact[v] - counts[v], reverse=True)[:total - sum(counts.values())]:
+        counts[value] += 1
+    return counts
+
+
+def build_user_prompt(attributes):
+    """人群画像放在最前（与训练数据的提示词一致），其余属性依次作为要求"""
+    persona = attributes.get(PERSONA_KEY)
+    prompt = f"请生成陆家嘴内一位{persona}的一天活动轨迹。" if persona else "请生成陆家嘴内一位人士的一天活动轨迹。"
+    requirements = [f"{name}为{value}" for name, value in attributes.items() if name != PERSONA_KEY]
+    if requirements:
+        prompt += "此人" + "，".join(requirements) + "。"
+    return prompt
+
+
+def expand_population(spec, size=None, seed=42):
+    """
+    展开为逐人的条件
+
+    返回:
+        list[dict]: 每人的 agent_id、attributes 和 user_prompt
+    """
+    size = size or spec['size']
+    rng = random.Random(seed)
+    columns = []
+    for name, weights in spec['attributes'].items():
+        column = [value for value, count in allocate(weights, size).items() for _ in range(count)]
+        rng.shuffle(column)
+        columns.append((name, column))
+    agents = []
+    for agent_id in range(size):
+        attributes = {name: column[agent_id] for name, column in columns}
+        agents.append({'agent_id': agent_id, 'attributes': attributes, 'user_prompt': build_user_prompt(attributes)})
+    return agents
+
+
+def population_fingerprint(spec, size=None, seed=42):
+    """目标分布、人数和随机种子的哈希，三者相同时 expand_population 展开的逐人条件相同，用于判断能否续跑"""
+    parts = {'spec': spec, 'size': size or spec['size'], 'seed': seed}
+    return hashlib.sha256(json.dumps(parts, sort_keys=True, ensure_ascii=False).encode('utf-8')).hexdigest()
+
+
+def group_batches(agents, batch_size, seed=42):
+    """
+    提示词相同的人分到同一批（每批共用一次提示词前向），批的顺序打乱，
+    使生成过程中已完成部分的分布始终接近目标分布
+    """
+    groups = {}
+    for agent in agents:
+        groups.setdefault(agent['user_prompt'], []).append(agent)
+    batches = [members[i:i + batch_size] for members in groups.values() for i in range(0, len(members), batch_size)]
+    random.Random(seed).shuffle(batches)
+    return batches
+
+
+def realised_attributes(text, names):
+    """从生成的轨迹中解析各属性的实际取值，缺失为None"""
+    parsed = parse_trajectory(text)
+    realised = {}
+    for name in names:
+        if name == TRAVEL_MODE_KEY:
+            modes = Counter(s['mode'] for s in parsed['segments'] if s['kind'] == SEGMENT_TRIP and s['mode'])
+            realised[name] = modes.most_common(1)[0][0] if modes else None
+        else:
+            realised[name] = parsed['persona'].get(name) or None
+    return realised
+
+
+def match_value(realised, candidates):
+    """
+    把实际取值归到目标分布的某个取值
+
+    年龄段（如 "25-34岁"）按数值区间匹配，其他取值按包含关系匹配；都不匹配时为"其他"，缺失为None
+    """
+    if realised is None:
+        return None
+    number = NUMBER.search(realised)
+    for candidate in candidates:
+        age_range = AGE_RANGE.match(candidate)
+        if age_range:
+            if number and int(age_range.group(1)) <= float(number.group()) <= int(age_range.group(2)):
+                return candidate
+        elif candidate in realised or realised in candidate:
+            return candidate
+    return OTHER_VALUE
+
+
+class PopulationTracker:
+    """
+    跟踪已完成轨迹的实际分布
+
+    每个属性统计: 实际取值的分布、与目标分布的总变差距离（TVD，0为完全一致）、
+    实际取值与该人的条件一致的比例（遵从率）和解析不到该属性的条数
+    """
+
+    def __init__(self, spec):
+        self.attributes = spec['attributes']
+        self.targets = {name: {value: weight / sum(weights.values()) for value, weight in weights.items()}
+                        for name, weights in self.attributes.items()}
+        self.realised = {name: Counter() for name in self.attributes}
+        self.matched = Counter()
+        self.missing = Counter()
+        self.completed = 0
+        self.errors = 0
+
+    def classify(self, text):
+        """解析轨迹并把各属性归到目标分布的取值"""
+        return {name: match_value(realised, self.attributes[name])
+                for name, realised in realised_attributes(text, self.attributes).items()}
+
+    def add(self, agent, text):
+        """加入一条完成的轨迹，返回该轨迹各属性归类后的取值；生成失败时返回None"""
+        if text is None or text.startswith('Error:'):
+            self.errors += 1
+            return None
+        values = self.classify(text)
+        self.restore(agent, values)
+        return values
+
+    def restore(self, agent, values):
+        """按已归类的取值计数（断点续跑时从结果文件恢复）"""
+        self.completed += 1
+        for name, value in values.items():
+            if name not in self.realised:
+                continue
+            if value is None:
+                self.missing[name] += 1
+                continue
+            self.realised[name][value] += 1
+            if value == agent['attributes'].get(name):
+                self.matched[name] += 1
+
+    def snapshot(self):
+        """当前各属性的实际分布、TVD、遵从率"""
+        result = {'completed': self.completed, 'errors': self.errors, 'attributes': {}}
+        for name, target in self.targets.items():
+            counts = self.realised[name]
+            parsed = sum(counts.values())
+            distribution = {value: counts[value] / parsed if parsed else 0.0
+                            for value in list(target) + [OTHER_VALUE]}
+            result['attributes'][name] = {
+                'distribution': distribution,
+                'tvd': 0.5 * sum(abs(distribution.get(v, 0.0) - target.get(v, 0.0)) for v in distribution),
+                'adherence': self.matched[name] / parsed if parsed else 0.0,
+                'missing': self.missing[name],
+            }
+        return result
+
+
+def print_population_report(snapshot, spec):
+    """打印实际分布与目标分布的对比"""
+    print("\n========== 人群合成：实际分布与目标分布 ==========")
+    print(f"完成: {snapshot['completed']} 条, 生成失败: {snapshot['errors']} 条")
+    for name, stats in snapshot['attributes'].items():
+        weights = spec['attributes'][name]
+        total = sum(weights.values())
+        print(f"[{name}] TVD: {stats['tvd']:.3f}, 遵从率: {stats['adherence'] * 100:.1f}%, 未解析: {stats['missing']}")
+        for value, share in stats['distribution'].items():
+            if value == OTHER_VALUE and share == 0:
+                continue
+            print(f"    {value:<16}目标 {weights.get(value, 0) / total * 100:>5.1f}%  实际 {share * 100:>5.1f}%")
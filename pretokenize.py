@@ -0,0 +1,355 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+训练数据预分词缓存
+把数据集按训练时的聊天模板渲染并分词，token id 和损失掩码（助手回复部分为1）写入内存映射的二进制分片；
+缓存目录以 tokenizer、聊天模板、源数据文件和最大长度的指纹命名，设置不变时训练启动只需映射分片，不再重复分词；
+data.path 可以是通配符（如 clean_dataset.py 输出的 clean-*.jsonl），匹配的文件按文件名顺序读取
+
+用法:
+    python pretokenize.py --config configs/train_default.json
+"""
+
+import os
+import glob
+import json
+import time
+import shutil
+import hashlib
+import argparse
+
+import numpy as np
+from datasets import Dataset
+
+from train import CHAT_TEMPLATE, THINK_INSTRUCTION, load_config, load_tokenizer, merge_system_message, to_messages
+
+FORMAT_VERSION = 1
+SHARD_EXAMPLES = 50000   # 每个分片最多包含的样本数
+BATCH_SIZE = 1000        # 每批分词的样本数
+DEFAULT_MAX_LENGTH = 1024
+IGNORE_INDEX = -100
+META_FILE = 'meta.json'
+
+
+def file_digest(path, chunk_size=1 << 20):
+    """源数据文件内容的SHA-256"""
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def source_files(path):
+    """data.path 展开为按文件名排序的源数据文件列表，支持通配符（与 load_dataset 的 data_files 一致）"""
+    files = sorted(glob.glob(path)) if glob.has_magic(path) else [path]
+    files = [f for f in files if os.path.isfile(f)]
+    if not files:
+        raise FileNotFoundError(f"找不到源数据文件: {path}")
+    return files
+
+
+def source_digest(paths):
+    """所有源数据文件内容的哈希；只有一个文件时与 file_digest 相同，已有缓存仍然有效"""
+    if len(paths) == 1:
+        return file_digest(paths[0])
+    digest = hashlib.sha256()
+    for path in paths:
+        digest.update(file_digest(path).encode('utf-8'))
+    return digest.hexdigest()
+
+
+def tokenizer_digest(tokenizer):
+    """tokenizer 词表、合并规则和特殊标记的哈希"""
+    digest = hashlib.sha256()
+    backend = getattr(tokenizer, 'backend_tokenizer', None)
+    if backend is not None:
+        digest.update(backend.to_str().encode('utf-8'))
+    else:
+        digest.update(json.dumps(tokenizer.get_vocab(), sort_keys=True).encode('utf-8'))
+    digest.update(json.dumps([str(t) for t in tokenizer.all_special_tokens], ensure_ascii=False).encode('utf-8'))
+    return digest.hexdigest()
+
+
+def fingerprint(tokenizer, source_paths, max_length):
+    """缓存的指纹：tokenizer、聊天模板、源文件内容（按顺序）、最大长度或格式版本任一变化都会重新分词"""
+    parts = {
+        'version': FORMAT_VERSION,
+        'tokenizer': tokenizer_digest(tokenizer),
+        'template': hashlib.sha256((CHAT_TEMPLATE + THINK_INSTRUCTION).encode('utf-8')).hexdigest(),
+        'source': source_digest(source_paths),
+        'max_length': max_length,
+    }
+    return hashlib.sha256(json.dumps(parts, sort_keys=True).encode('utf-8')).hexdigest(), parts
+
+
+def render_with_spans(messages, tokenizer):
+    """渲染聊天模板，同时返回助手回复（不含角色标记行）在文本中的字符区间"""
+    messages = merge_system_message(messages)
+    text = tokenizer.apply_chat_template(messages, tokenize=False)
+    spans = []
+    previous = 0
+    for i, message in enumerate(messages):
+        # 模板逐条追加消息，前缀渲染的长度即为每条消息的边界
+        end = len(tokenizer.apply_chat_template(messages[:i + 1], tokenize=False)) if i + 1 < len(messages) else len(text)
+        if message.get('role') == 'assistant':
+            header_end = text.find('\n', previous, end)
+            spans.append((header_end + 1 if header_end >= 0 else previous, end))
+        previous = end
+    return text, spans
+
+
+def encode_batch(samples, tokenizer, max_length):
+    """分词一批样本，返回 [(token_ids, loss_mask)]，格式错误的样本返回None"""
+    texts, all_spans, keep = [], [], []
+    for sample in samples:
+        messages = to_messages(sample)
+        if not isinstance(messages, list) or not messages:
+            keep.append(False)
+            continue
+        text, spans = render_with_spans(messages, tokenizer)
+        texts.append(text)
+        all_spans.append(spans)
+        keep.append(True)
+
+    encoded = tokenizer(texts, add_special_tokens=False, return_offsets_mapping=True,
+                        truncation=True, max_length=max_length) if texts else {'input_ids': [], 'offset_mapping': []}
+    results = []
+    position = 0
+    eos = tokenizer.eos_token_id
+    for kept in keep:
+        if not kept:
+            results.append(None)
+            continue
+        ids = np.asarray(encoded['input_ids'][position], dtype=np.uint32)
+        starts = np.asarray([start for start, _ in encoded['offset_mapping'][position]], dtype=np.int64)
+        mask = np.zeros(len(ids), dtype=np.uint8)
+        for span_start, span_end in all_spans[position]:
+            mask[(starts >= span_start) & (starts < span_end)] = 1
+        # 与SFTTrainer一致：序列末尾补EOS
+        if eos is not None and (len(ids) == 0 or ids[-1] != eos) and len(ids) < max_length:
+            ids = np.append(ids, np.uint32(eos))
+            mask = np.append(mask, np.uint8(mask[-1] if len(mask) else 0))
+        results.append((ids, mask))
+        position += 1
+    return results
+
+
+def _write_shard(directory, index, tokens, masks):
+    lengths = np.asarray([len(t) for t in tokens], dtype=np.int64)
+    offsets = np.concatenate([[0], np.cumsum(lengths)]).astype(np.int64)
+    np.concatenate(tokens).astype(np.uint32).tofile(os.path.join(directory, f'tokens-{index:05d}.bin'))
+    np.concatenate(masks).astype(np.uint8).tofile(os.path.join(directory, f'mask-{index:05d}.bin'))
+    np.save(os.path.join(directory, f'offsets-{index:05d}.npy'), offsets)
+    return int(offsets[-1])
+
+
+def build_shards(source_paths, tokenizer, output_dir, max_length, key, parts):
+    """按顺序读取JSONL源数据文件，分词后写入分片；先写到临时目录，完成后再改名，避免留下不完整的缓存"""
+    start_time = time.time()
+    tmp_dir = output_dir + '.tmp'
+    shutil.rmtree(tmp_dir, ignore_errors=True)
+    os.makedirs(tmp_dir)
+
+    stats = {'examples': 0, 'skipped': 0, 'tokens': 0, 'loss_tokens': 0, 'truncated': 0}
+    shards = []
+    tokens, masks, batch = [], [], []
+
+    def flush_batch():
+        for item in encode_batch(batch, tokenizer, max_length):
+            if item is None:
+                stats['skipped'] += 1
+                continue
+            ids, mask = item
+            tokens.append(ids)
+            masks.append(mask)
+            stats['examples'] += 1
+            stats['loss_tokens'] += int(mask.sum())
+            stats['truncated'] += int(len(ids) >= max_length)
+        batch.clear()
+
+    def flush_shard():
+        if tokens:
+            stats['tokens'] += _write_shard(tmp_dir, len(shards), tokens, masks)
+            shards.append(len(tokens))
+            tokens.clear()
+            masks.clear()
+
+    for source_path in source_paths:
+        with open(source_path, 'r', encoding='utf-8') as f:
+            for line in f:
+                line = line.strip()
+                if not line:
+                    continue
+                try:
+                    batch.append(json.loads(line))
+                except json.JSONDecodeError:
+                    stats['skipped'] += 1
+                    continue
+                if len(batch) >= BATCH_SIZE:
+                    flush_batch()
+                    if len(tokens) >= SHARD_EXAMPLES:
+                        flush_shard()
+    flush_batch()
+    flush_shard()
+
+    meta = dict(stats, fingerprint=key, parts=parts, source=[os.path.abspath(p) for p in source_paths], max_length=max_length,
+                shards=shards, build_seconds=time.time() - start_time, created_at=time.time())
+    with open(os.path.join(tmp_dir, META_FILE), 'w', encoding='utf-8') as f:
+        json.dump(meta, f, ensure_ascii=False, indent=2)
+    shutil.rmtree(output_dir, ignore_errors=True)
+    os.replace(tmp_dir, output_dir)
+    return meta
+
+
+class PretokenizedShards:
+    """以内存映射方式打开的分片，按全局下标读取样本"""
+
+    def __init__(self, directory):
+        with open(os.path.join(directory, META_FILE), 'r', encoding='utf-8') as f:
+            self.meta = json.load(f)
+        self.tokens, self.masks, self.offsets = [], [], []
+        for index in range(len(self.meta['shards'])):
+            offsets = np.load(os.path.join(directory, f'offsets-{index:05d}.npy'), mmap_mode='r')
+            self.offsets.append(offsets)
+            self.tokens.append(np.memmap(os.path.join(directory, f'tokens-{index:05d}.bin'), dtype=np.uint32,
+                                         mode='r', shape=(int(offsets[-1]),)))
+            self.masks.append(np.memmap(os.path.join(directory, f'mask-{index:05d}.bin'), dtype=np.uint8,
+                                        mode='r', shape=(int(offsets[-1]),)))
+        counts = np.asarray(self.meta['shards'], dtype=np.int64)
+        self.shard_starts = np.concatenate([[0], np.cumsum(counts)])
+        self.lengths = np.concatenate([np.diff(o) for o in self.offsets]) if self.offsets else np.zeros(0, np.int64)
+
+    def __len__(self):
+        return int(self.shard_starts[-1])
+
+    def get(self, index):
+        shard = int(np.searchsorted(self.shard_starts, index, side='right')) - 1
+        local = index - self.shard_starts[shard]
+        start, end = self.offsets[shard][local], self.offsets[shard][local + 1]
+        return self.tokens[shard][start:end], self.masks[shard][start:end]
+
+    def example(self, index, loss_mask=False):
+        """返回 (input_ids, labels)，loss_mask 为True时非助手回复位置的标签为-100"""
+        ids, mask = self.get(index)
+        ids = ids.astype(np.int64)
+        return ids, np.where(mask.astype(bool), ids, IGNORE_INDEX) if loss_mask else ids
+
+
+def to_dataset(shards, indices, loss_mask=False):
+    """
+    构造供 SFTTrainer 使用的数据集（需设置 dataset_kwargs={'skip_prepare_dataset': True} 和 remove_unused_columns=False）
+
+    数据集本身只保存样本下标和长度（length 列供按长度分桶），读取时通过 transform 从分片中取出 input_ids 和 labels
+
+    参数:
+        loss_mask (bool): True 时只在助手回复上计算损失，否则在整个序列上计算（与按文本训练一致）
+    """
+    def fetch(batch):
+        output = {'input_ids': [], 'labels': [], 'length': []}
+        for index in batch['index']:
+            ids, labels = shards.example(index, loss_mask)
+            output['input_ids'].append(ids)
+            output['labels'].append(labels)
+            output['length'].append(len(ids))
+        return output
+
+    indices = np.asarray(indices, dtype=np.int64)
+    dataset = Dataset.from_dict({'index': indices, 'length': shards.lengths[indices]})
+    dataset.set_transform(fetch)
+    return dataset
+
+
+def cache_path(cache_dir, key):
+    return os.path.join(cache_dir, key[:16])
+
+
+def prepare_pretokenized(config, tokenizer, cache_dir=None, rebuild=False):
+    """
+    返回 (训练集, 验证集, 报告)；指纹相同的缓存存在时直接映射，否则先分词写入缓存
+
+    训练集/验证集只在样本下标上按 seed 和 test_size 划分，不影响缓存
+    """
+    data = config['data']
+    cache_dir = cache_dir or data['pretokenized_dir']
+    max_length = config['sft'].get('max_length') or DEFAULT_MAX_LENGTH
+
+    start_time = time.time()
+    sources = source_files(data['path'])
+    key, parts = fingerprint(tokenizer, sources, max_length)
+    fingerprint_seconds = time.time() - start_time
+    directory = cache_path(cache_dir, key)
+    built = rebuild or not os.path.exists(os.path.join(directory, META_FILE))
+    if built:
+        print(f"Tokenizing {len(sources)} file(s) from {data['path']} into {directory}")
+        build_shards(sources, tokenizer, directory, max_length, key, parts)
+
+    load_start = time.time()
+    shards = PretokenizedShards(directory)
+    rng = np.random.default_rng(config.get('seed', 42))
+    order = rng.permutation(len(shards))
+    n_test = int(round(len(shards) * data.get('test_size', 0.05)))
+    test, train = order[:n_test], order[n_test:]
+    if data.get('max_train_samples'):
+        train = train[:data['max_train_samples']]
+    if data.get('max_eval_samples'):
+        test = test[:data['max_eval_samples']]
+    loss_mask = bool(config['sft'].get('assistant_only_loss', False))
+    if data.get('batching') == 'pack':
+        from packing import to_packed_dataset
+        datasets = (to_packed_dataset(shards, train, max_length, loss_mask),
+                    to_packed_dataset(shards, test, max_length, loss_mask))
+    else:
+        datasets = (to_dataset(shards, train, loss_mask), to_dataset(shards, test, loss_mask))
+    load_seconds = time.time() - load_start + fingerprint_seconds
+
+    meta = shards.meta
+    report = {
+        'directory': directory,
+        'cache_hit': not built,
+        'examples': meta['examples'],
+        'tokens': meta['tokens'],
+        'loss_token_share': meta['loss_tokens'] / meta['tokens'] if meta['tokens'] else 0.0,
+        'truncated': meta['truncated'],
+        'skipped': meta['skipped'],
+        'build_seconds': meta['build_seconds'],
+        'load_seconds': load_seconds,
+        'saved_seconds': meta['build_seconds'] - load_seconds if not built else 0.0,
+    }
+    return datasets[0], datasets[1], report
+
+
+def print_pretokenize_report(report):
+    """打印缓存信息和节省的时间"""
+    print("\n========== 预分词缓存 ==========")
+    print(f"缓存目录: {report['directory']} ({'命中' if report['cache_hit'] else '新建'})")
+    print(f"样本: {report['examples']}, token: {report['tokens']}, "
+          f"助手回复token占比: {report['loss_token_share'] * 100:.1f}%, 被截断: {report['truncated']}, "
+          f"跳过: {report['skipped']}")
+    print(f"分词用时: {report['build_seconds']:.2f}秒, 校验指纹并映射分片: {report['load_seconds']:.2f}秒")
+    if report['cache_hit']:
+        print(f"本次启动节省: {report['saved_seconds']:.2f}秒")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="把训练数据预先分词并写入内存映射分片")
+    parser.add_argument("--config", type=str, default="configs/train_default.json",
+                        help="train.py 使用的JSON配置文件")
+    parser.add_argument("--set", type=str, nargs='*', default=[], dest="overrides",
+                        help="覆盖配置项，例如 data.path=other.jsonl")
+    parser.add_argument("--cache_dir", type=str, default=None,
+                        help="缓存目录，默认为配置中的 data.pretokenized_dir")
+    parser.add_argument("--rebuild", action="store_true",
+                        help="忽略已有缓存，重新分词")
+    args = parser.parse_args()
+
+    config = load_config(args.config, args.overrides)
+    config['data'].setdefault('pretokenized_dir', args.cache_dir or os.path.join(
+        os.path.dirname(config['data']['path']) or '.', 'pretokenized'))
+    tokenizer = load_tokenizer(config)
+    _, _, report = prepare_pretokenized(config, tokenizer, args.cache_dir, args.rebuild)
+    print_pretokenize_report(report)
+
+
+if __name__ == "__main__":
+    main()
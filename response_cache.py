@@ -0,0 +1,155 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+API响应缓存
+以 (接口地址, 模型, 消息, 采样参数) 的哈希为键，把完整的API响应保存在本地SQLite文件中，
+内容完全相同的请求直接返回缓存结果；总大小超过上限时按最近使用时间淘汰(LRU)
+"""
+
+import os
+import json
+import time
+import hashlib
+import sqlite3
+import argparse
+import threading
+
+DEFAULT_MAX_MB = 512
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS responses (
+    key TEXT PRIMARY KEY,
+    model TEXT,
+    response TEXT NOT NULL,
+    size INTEGER NOT NULL,
+    created_at REAL,
+    last_access REAL
+);
+CREATE INDEX IF NOT EXISTS idx_responses_last_access ON responses(last_access);
+"""
+
+
+def make_key(endpoint, model, messages, params=None):
+    """请求内容的SHA-256哈希，字典按键排序后序列化，保证相同请求得到相同的键"""
+    payload = {'endpoint': endpoint, 'model': model, 'messages': messages, 'params': params or {}}
+    text = json.dumps(payload, ensure_ascii=False, sort_keys=True, separators=(',', ':'))
+    return hashlib.sha256(text.encode('utf-8')).hexdigest()
+
+
+class ResponseCache:
+    """按大小做LRU淘汰的持久化响应缓存，可在多个评估线程间共享"""
+
+    def __init__(self, db_path, max_mb=DEFAULT_MAX_MB):
+        directory = os.path.dirname(db_path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self.db_path = db_path
+        self.max_bytes = int(max_mb * 1024 * 1024)
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(db_path, check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.executescript(SCHEMA)
+        self.conn.commit()
+        self.total_bytes = self.conn.execute("SELECT COALESCE(SUM(size), 0) FROM responses").fetchone()[0]
+        self.stats = {'lookups': 0, 'hits': 0, 'stores': 0, 'bypassed': 0, 'evicted': 0}
+
+    def get(self, key):
+        """返回缓存的响应（dict），未命中时返回None"""
+        with self.lock:
+            self.stats['lookups'] += 1
+            row = self.conn.execute("SELECT response FROM responses WHERE key = ?", (key,)).fetchone()
+            if row is None:
+                return None
+            self.stats['hits'] += 1
+            with self.conn:
+                self.conn.execute("UPDATE responses SET last_access = ? WHERE key = ?", (time.time(), key))
+        return json.loads(row[0])
+
+    def put(self, key, response, model=None):
+        """保存一条响应，超过容量上限时淘汰最久未使用的条目"""
+        text = json.dumps(response, ensure_ascii=False)
+        size = len(text.encode('utf-8'))
+        now = time.time()
+        with self.lock:
+            old = self.conn.execute("SELECT size FROM responses WHERE key = ?", (key,)).fetchone()
+            with self.conn:
+                self.conn.execute(
+                    "INSERT OR REPLACE INTO responses (key, model, response, size, created_at, last_access) "
+                    "VALUES (?, ?, ?, ?, ?, ?)", (key, model, text, size, now, now))
+            self.total_bytes += size - (old[0] if old else 0)
+            self.stats['stores'] += 1
+            if self.total_bytes > self.max_bytes:
+                self._evict()
+
+    def bypass(self):
+        """记录一次按要求跳过缓存的请求（如需要重新采样的生成请求）"""
+        with self.lock:
+            self.stats['bypassed'] += 1
+
+    def _evict(self):
+        # 淘汰到上限的90%，避免每次写入都触发淘汰
+        target = self.max_bytes * 0.9
+        evicted = []
+        for key, size in self.conn.execute("SELECT key, size FROM responses ORDER BY last_access"):
+            if self.total_bytes <= target:
+                break
+            evicted.append((key,))
+            self.total_bytes -= size
+        with self.conn:
+            self.conn.executemany("DELETE FROM responses WHERE key = ?", evicted)
+        self.stats['evicted'] += len(evicted)
+
+    def report(self):
+        """本次运行的命中率、节省的调用次数和缓存占用"""
+        with self.lock:
+            entries = self.conn.execute("SELECT COUNT(*) FROM responses").fetchone()[0]
+            stats = dict(self.stats)
+        stats['hit_rate'] = stats['hits'] / stats['lookups'] if stats['lookups'] else 0.0
+        stats['calls_saved'] = stats['hits']
+        stats['entries'] = entries
+        stats['size_mb'] = self.total_bytes / 1024 / 1024
+        stats['max_mb'] = self.max_bytes / 1024 / 1024
+        return stats
+
+    def clear(self):
+        with self.lock:
+            with self.conn:
+                self.conn.execute("DELETE FROM responses")
+            self.total_bytes = 0
+
+    def close(self):
+        with self.lock:
+            if self.conn is not None:
+                self.conn.close()
+                self.conn = None
+
+
+def print_cache_report(report, title="响应缓存统计"):
+    """打印缓存统计"""
+    print(f"\n========== {title} ==========")
+    print(f"查询: {report['lookups']}, 命中: {report['hits']} ({report['hit_rate'] * 100:.1f}%), "
+          f"节省调用: {report['calls_saved']}, 新写入: {report['stores']}, 跳过缓存: {report['bypassed']}")
+    print(f"缓存条目: {report['entries']}, 占用 {report['size_mb']:.1f}MB / {report['max_mb']:.1f}MB, "
+          f"本次淘汰: {report['evicted']}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="查看或清空API响应缓存")
+    parser.add_argument("--cache", type=str, default="/root/for_eval/response_cache.db",
+                        help="缓存数据库路径")
+    parser.add_argument("--clear", action="store_true",
+                        help="清空缓存")
+    args = parser.parse_args()
+
+    cache = ResponseCache(args.cache)
+    if args.clear:
+        cache.clear()
+        print(f"已清空缓存: {args.cache}")
+    report = cache.report()
+    print(f"缓存条目: {report['entries']}, 占用 {report['size_mb']:.1f}MB")
+    cache.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,307 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+评估结果存储
+使用内嵌SQLite数据库保存每个文件的分数、评估原文、模型、耗时、token用量和状态，
+批量提交事务，断点续跑时通过主键索引查询已处理文件；CSV/Parquet按需导出
+"""
+
+import os
+import csv
+import json
+import time
+import sqlite3
+import argparse
+
+DIMENSIONS = ['时间逻辑一致性', '活动目的连贯性', '人物画像匹配度', '活动真实性与丰富度']
+SCORE_COLUMNS = ['score_time_logic', 'score_purpose', 'score_persona', 'score_realism']
+
+# 导出CSV时的列顺序，与原 result.csv 保持一致
+EXPORT_FIELDS = ['id', 'file'] + DIMENSIONS + [
+    'judge_model', 'prompt_tokens', 'completion_tokens', 'cached_tokens',
+    'rubric_tokens_est', 'latency', 'pack_size', 'status',
+]
+
+STATUS_SCORED = 'scored'    # 已评分
+STATUS_SKIPPED = 'skipped'  # 无法提取活动链，跳过
+STATUS_LEGACY = 'legacy'    # 从 processed_files.txt 导入，只知道已处理
+STATUS_REJECTED = 'rejected'  # 未通过规则预评估，未调用LLM评估
+STATUS_DUPLICATE = 'duplicate'  # 与已保留的轨迹近似重复，未调用LLM评估
+STATUS_FAILED = 'failed'    # 评估调用失败（重试用尽仍无回复），不算已处理，下次运行时重新评估
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS results (
+    file TEXT PRIMARY KEY,
+    record_id TEXT,
+    status TEXT NOT NULL,
+    score_time_logic INTEGER,
+    score_purpose INTEGER,
+    score_persona INTEGER,
+    score_realism INTEGER,
+    raw_response TEXT,
+    judge_model TEXT,
+    latency REAL,
+    prompt_tokens INTEGER,
+    completion_tokens INTEGER,
+    cached_tokens INTEGER,
+    rubric_tokens_est INTEGER,
+    pack_size INTEGER,
+    created_at REAL
+);
+CREATE INDEX IF NOT EXISTS idx_results_status ON results(status);
+"""
+
+INSERT_SQL = """
+INSERT OR REPLACE INTO results (
+    file, record_id, status, score_time_logic, score_purpose, score_persona, score_realism,
+    raw_response, judge_model, latency, prompt_tokens, completion_tokens, cached_tokens,
+    rubric_tokens_est, pack_size, created_at
+) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+"""
+
+
+class ResultsStore:
+    """SQLite评估结果存储，写入先进入缓冲区，按条数或时间间隔批量提交"""
+
+    def __init__(self, db_path, batch_size=20, flush_interval=5.0):
+        directory = os.path.dirname(db_path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self.db_path = db_path
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.pending = []
+        self.last_flush = time.time()
+
+        self.conn = sqlite3.connect(db_path)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.executescript(SCHEMA)
+        self.conn.commit()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+
+    def is_processed(self, file_name):
+        """通过主键索引查询单个文件是否已处理（评估调用失败的不算）"""
+        row = self.conn.execute("SELECT 1 FROM results WHERE file = ? AND status != ?",
+                                (file_name, STATUS_FAILED)).fetchone()
+        return row is not None
+
+    def processed_files(self):
+        """返回所有已处理（已评分、跳过、拒绝、重复或历史导入）的文件名集合，评估调用失败的不包括在内"""
+        return {row[0] for row in self.conn.execute("SELECT file FROM results WHERE status != ?", (STATUS_FAILED,))}
+
+    def scored_results(self):
+        """返回已评分文件的分数 {文件名: {维度: 分数}}"""
+        query = f"SELECT file, {', '.join(SCORE_COLUMNS)} FROM results WHERE status = ?"
+        return {row[0]: dict(zip(DIMENSIONS, row[1:])) for row in self.conn.execute(query, (STATUS_SCORED,))}
+
+    def add_result(self, file_name, record_id, scores, usage=None, raw_response=None):
+        """缓存一条评分结果"""
+        usage = usage or {}
+        row = (
+            file_name,
+            None if record_id is None else str(record_id),
+            STATUS_SCORED,
+            *[scores.get(dim) for dim in DIMENSIONS],
+            raw_response,
+            usage.get('model'),
+            usage.get('latency'),
+            usage.get('prompt_tokens'),
+            usage.get('completion_tokens'),
+            usage.get('cached_tokens'),
+            usage.get('rubric_tokens_est'),
+            usage.get('pack_size', 1),
+            time.time(),
+        )
+        self._append(row)
+
+    def add_skipped(self, file_name, record_id=None, status=STATUS_SKIPPED, reason=None):
+        """缓存一条无分数的处理记录，reason 保存在 raw_response 列中"""
+        row = (file_name, None if record_id is None else str(record_id), status,
+               None, None, None, None, reason, None, None, None, None, None, None, None, time.time())
+        self._append(row)
+
+    def _append(self, row):
+        self.pending.append(row)
+        if len(self.pending) >= self.batch_size or time.time() - self.last_flush >= self.flush_interval:
+            self.flush()
+
+    def flush(self):
+        """在一个事务中提交缓冲区中的全部记录"""
+        if self.pending:
+            with self.conn:
+                self.conn.executemany(INSERT_SQL, self.pending)
+            print(f"Committed {len(self.pending)} results to {self.db_path}")
+            self.pending = []
+        self.last_flush = time.time()
+
+    def close(self):
+        """提交剩余记录并关闭连接"""
+        if self.conn is not None:
+            self.flush()
+            self.conn.close()
+            self.conn = None
+
+    def rows(self, order_by='file'):
+        """按导出列顺序返回所有记录"""
+        query = f"""
+            SELECT record_id, file, {', '.join(SCORE_COLUMNS)}, judge_model, prompt_tokens,
+                   completion_tokens, cached_tokens, rubric_tokens_est, latency, pack_size, status
+            FROM results WHERE status != ? ORDER BY {order_by}
+        """
+        for row in self.conn.execute(query, (STATUS_LEGACY,)):
+            yield dict(zip(EXPORT_FIELDS, row))
+
+    def export_csv(self, output_file, status=STATUS_SCORED):
+        """导出为CSV（先写临时文件再替换，导出过程中崩溃不会损坏已有文件）"""
+        directory = os.path.dirname(output_file)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        tmp_file = output_file + '.tmp'
+        count = 0
+        with open(tmp_file, 'w', newline='', encoding='utf-8') as f:
+            writer = csv.DictWriter(f, fieldnames=EXPORT_FIELDS)
+            writer.writeheader()
+            for row in self.rows():
+                if status and row['status'] != status:
+                    continue
+                if row['latency'] is not None:
+                    row['latency'] = f"{row['latency']:.3f}"
+                writer.writerow(row)
+                count += 1
+        os.replace(tmp_file, output_file)
+        print(f"Exported {count} rows to {output_file}")
+        return count
+
+    def export_parquet(self, output_file, status=STATUS_SCORED):
+        """导出为Parquet，需要安装 pyarrow"""
+        try:
+            import pyarrow as pa
+            import pyarrow.parquet as pq
+        except ImportError:
+            print("提示: 导出Parquet需要安装pyarrow库，可以通过 'pip install pyarrow' 安装。")
+            return 0
+
+        rows = [row for row in self.rows() if not status or row['status'] == status]
+        columns = {field: [row[field] for row in rows] for field in EXPORT_FIELDS}
+        pq.write_table(pa.table(columns), output_file)
+        print(f"Exported {len(rows)} rows to {output_file}")
+        return len(rows)
+
+    def import_legacy(self, processed_files_log=None, result_csv=None, input_folder=None):
+        """导入旧版 processed_files.txt 和 result.csv，已存在的记录不会被覆盖
+
+        旧版 result.csv 只有 id 列没有 file 列，此时扫描 input_folder 中JSON文件的 id 字段找到对应文件；
+        有 id 无法对应到唯一文件时抛出 ValueError，不导入任何记录，避免已付费的分数被静默丢弃
+        """
+        known = self.processed_files()
+        imported = 0
+
+        if result_csv and os.path.isfile(result_csv):
+            with open(result_csv, 'r', newline='', encoding='utf-8') as f:
+                rows = list(csv.DictReader(f))
+            if rows and 'file' not in rows[0]:
+                files_by_id = legacy_file_map(rows, input_folder, processed_files_log)
+                for row in rows:
+                    row['file'] = files_by_id[row.get('id')]
+            for row in rows:
+                file_name = row.get('file')
+                if not file_name or file_name in known:
+                    continue
+                scores = {dim: int(row[dim]) for dim in DIMENSIONS if row.get(dim, '').strip().isdigit()}
+                usage = {
+                    'model': row.get('judge_model') or None,
+                    'latency': float(row['latency']) if row.get('latency') else None,
+                    'pack_size': int(row['pack_size']) if row.get('pack_size') else 1,
+                }
+                for key in ('prompt_tokens', 'completion_tokens', 'cached_tokens', 'rubric_tokens_est'):
+                    usage[key] = int(row[key]) if row.get(key) else None
+                self.add_result(file_name, row.get('id'), scores, usage)
+                known.add(file_name)
+                imported += 1
+
+        if processed_files_log and os.path.isfile(processed_files_log):
+            with open(processed_files_log, 'r', encoding='utf-8') as f:
+                for line in f:
+                    file_name = line.strip()
+                    if file_name and file_name not in known:
+                        self.add_skipped(file_name, status=STATUS_LEGACY)
+                        known.add(file_name)
+                        imported += 1
+
+        self.flush()
+        return imported
+
+
+def legacy_file_map(rows, input_folder, processed_files_log=None):
+    """旧版 result.csv 没有 file 列时，按JSON文件中的 id 字段建立 {id: 文件名}
+
+    同一 id 对应多个文件时，只保留 processed_files.txt 中记录过的文件；仍不唯一或找不到时抛出 ValueError
+    """
+    if not input_folder or not os.path.isdir(input_folder):
+        raise ValueError("旧版 result.csv 没有 file 列，需要提供输入文件夹以按 id 找到对应文件")
+
+    candidates = {}
+    for file_name in sorted(f for f in os.listdir(input_folder) if f.endswith('.json')):
+        try:
+            with open(os.path.join(input_folder, file_name), 'r', encoding='utf-8') as f:
+                record_id = json.load(f).get('id')
+        except (OSError, ValueError, AttributeError):
+            continue
+        if record_id is not None:
+            candidates.setdefault(str(record_id), []).append(file_name)
+
+    processed = set()
+    if processed_files_log and os.path.isfile(processed_files_log):
+        with open(processed_files_log, 'r', encoding='utf-8') as f:
+            processed = {line.strip() for line in f if line.strip()}
+
+    files_by_id, unmapped = {}, []
+    for row in rows:
+        record_id = row.get('id')
+        files = candidates.get(record_id, [])
+        if len(files) > 1:
+            files = [f for f in files if f in processed]
+        if len(files) == 1:
+            files_by_id[record_id] = files[0]
+        else:
+            unmapped.append(record_id)
+    if unmapped:
+        raise ValueError(f"旧版 result.csv 中有 {len(unmapped)} 个 id 无法在 {input_folder} 中对应到唯一文件: "
+                         f"{unmapped[:10]}")
+    return files_by_id
+
+
+def main():
+    parser = argparse.ArgumentParser(description="评估结果数据库的导入与导出")
+    parser.add_argument("--db", type=str, default="/root/for_eval/results.db",
+                        help="SQLite数据库路径")
+    parser.add_argument("--csv", type=str, default=None,
+                        help="导出CSV文件路径")
+    parser.add_argument("--parquet", type=str, default=None,
+                        help="导出Parquet文件路径")
+    parser.add_argument("--import_csv", type=str, default=None,
+                        help="导入旧版 result.csv（没有file列时需要同时提供 --input_folder）")
+    parser.add_argument("--input_folder", type=str, default=None,
+                        help="待评估JSON文件夹，用于把旧版 result.csv 的 id 对应到文件")
+    parser.add_argument("--import_processed", type=str, default=None,
+                        help="导入旧版 processed_files.txt")
+    args = parser.parse_args()
+
+    with ResultsStore(args.db) as store:
+        if args.import_csv or args.import_processed:
+            imported = store.import_legacy(args.import_processed, args.import_csv, args.input_folder)
+            print(f"Imported {imported} legacy records")
+        if args.csv:
+            store.export_csv(args.csv)
+        if args.parquet:
+            store.export_parquet(args.parquet)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,338 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+基于规则的本地预评估
+将每条 model_response 解析为出行/活动记录后，把整个语料拼成一张扁平的记录表，
+用 NumPy 向量化地一次性检查所有轨迹：时间重叠与空档、时长一致性、一天内的覆盖范围、
+坐标是否落在陆家嘴范围内、坐标重复使用以及格式完整性。
+明显有问题的轨迹在调用LLM评估前即可打分并过滤掉
+"""
+
+import os
+import csv
+import json
+import time
+import argparse
+
+import numpy as np
+
+from trajectory_parser import (
+    EVALUATION_FIELDS,
+    PERSONA_FIELDS,
+    SEGMENT_ACTIVITY,
+    parse_trajectory,
+)
+
+# 陆家嘴区域经纬度范围 (最小经度, 最小纬度, 最大经度, 最大纬度)，WGS84
+LUJIAZUI_BBOX = (121.490, 31.215, 121.545, 31.255)
+
+OVERLAP_TOLERANCE = 1.0     # 前后记录时间重叠超过该分钟数视为冲突
+MAX_GAP_MINUTES = 30.0      # 相邻记录之间超过该分钟数的空档视为缺失
+DURATION_TOLERANCE = 2.0    # 标注时长与起止时间相差超过该分钟数视为不一致
+MIN_DAY_SPAN = 120.0        # 一天内在陆家嘴的活动跨度少于该分钟数视为覆盖不足
+COORD_DECIMALS = 5          # 判断坐标重复时保留的小数位（约1米）
+HOT_COORD_SHARE = 0.01      # 同一坐标出现在超过该比例的轨迹中视为“热门”虚构坐标
+HOT_COORD_MIN_COUNT = 5
+
+MIN_RULE_SCORE = 3.0        # 规则分低于该值的轨迹不再送去LLM评估
+MIN_COMPLETENESS = 0.6
+MAX_OUTSIDE_SHARE = 0.5
+MAX_OVERLAPS = 3
+
+
+def load_corpus(input_folder, file_names=None):
+    """读取目录中的对话JSON文件，返回 [(file_name, record_id, model_response)]"""
+    if file_names is None:
+        file_names = sorted(f for f in os.listdir(input_folder) if f.endswith('.json'))
+
+    corpus = []
+    for file_name in file_names:
+        try:
+            with open(os.path.join(input_folder, file_name), 'r', encoding='utf-8') as f:
+                data = json.load(f)
+        except (OSError, json.JSONDecodeError):
+            continue
+        if isinstance(data, dict) and 'model_response' in data:
+            corpus.append((file_name, data.get('id'), data.get('model_response') or ''))
+    return corpus
+
+
+def build_segment_table(parsed_list):
+    """将所有轨迹的出行/活动记录拼接为列式数组，缺失值为 NaN"""
+    columns = {name: [] for name in ('traj', 'is_activity', 'start', 'end', 'stated', 'lon', 'lat', 'place')}
+    for traj_index, parsed in enumerate(parsed_list):
+        for segment in parsed['segments']:
+            columns['traj'].append(traj_index)
+            columns['is_activity'].append(segment['kind'] == SEGMENT_ACTIVITY)
+            for name, key in (('start', 'start'), ('end', 'end'), ('stated', 'stated_minutes'),
+                              ('lon', 'lon'), ('lat', 'lat')):
+                value = segment[key]
+                columns[name].append(np.nan if value is None else value)
+            columns['place'].append(segment['place_name'] or '')
+
+    table = {
+        'traj': np.asarray(columns['traj'], dtype=np.int64),
+        'is_activity': np.asarray(columns['is_activity'], dtype=bool),
+    }
+    for name in ('start', 'end', 'stated', 'lon', 'lat'):
+        table[name] = np.asarray(columns[name], dtype=np.float64)
+
+    # 地点名称编码为整数，便于向量化比较
+    place_ids = {}
+    table['place'] = np.asarray([place_ids.setdefault(p, len(place_ids)) for p in columns['place']], dtype=np.int64)
+    return table
+
+
+def _count(traj, mask, n):
+    """按轨迹统计满足条件的记录数"""
+    return np.bincount(traj[mask], minlength=n)
+
+
+def _share(numerator, denominator):
+    return np.divide(numerator, denominator, out=np.zeros(len(numerator)), where=denominator > 0)
+
+
+def check_time(table, n):
+    """时间检查：倒置时段、时长不一致、相邻记录重叠与空档、一天内的活动跨度"""
+    traj, start, end = table['traj'], table['start'], table['end']
+    has_time = ~np.isnan(start) & ~np.isnan(end)
+    duration = end - start
+
+    negative = _count(traj, has_time & (duration < 0), n)
+    stated = table['stated']
+    mismatch_mask = has_time & ~np.isnan(stated) & (np.abs(duration - stated) > DURATION_TOLERANCE)
+    mismatch = _count(traj, mismatch_mask, n)
+
+    # 相邻记录（按文本中出现的顺序）之间的衔接
+    t, s, e = traj[has_time], start[has_time], end[has_time]
+    same = t[1:] == t[:-1]
+    delta = s[1:] - e[:-1]
+    overlaps = _count(t[1:], same & (delta < -OVERLAP_TOLERANCE), n)
+    gaps = _count(t[1:], same & (delta > MAX_GAP_MINUTES), n)
+
+    # 一天内的覆盖范围
+    first = np.full(n, np.inf)
+    last = np.full(n, -np.inf)
+    np.minimum.at(first, t, s)
+    np.maximum.at(last, t, e)
+    span = np.where(np.isfinite(first) & np.isfinite(last), last - first, 0.0)
+    covered = np.bincount(t, weights=np.clip(e - s, 0, None), minlength=n)
+
+    return {
+        'time_records': _count(traj, has_time, n),
+        'negative_durations': negative,
+        'duration_mismatches': mismatch,
+        'overlaps': overlaps,
+        'gaps': gaps,
+        'day_span_minutes': span,
+        'coverage_ratio': np.clip(_share(covered, span), 0, 1),
+        'first_start': np.where(np.isfinite(first), first, np.nan),
+        'last_end': np.where(np.isfinite(last), last, np.nan),
+    }
+
+
+def check_coordinates(table, n, bbox=LUJIAZUI_BBOX):
+    """坐标检查：活动地点是否落在陆家嘴范围内、同一轨迹内坐标复用、跨轨迹的热门坐标"""
+    traj, lon, lat = table['traj'], table['lon'], table['lat']
+    point = table['is_activity'] & ~np.isnan(lon) & ~np.isnan(lat)
+    min_lon, min_lat, max_lon, max_lat = bbox
+    inside = (lon >= min_lon) & (lon <= max_lon) & (lat >= min_lat) & (lat <= max_lat)
+
+    points = _count(traj, point, n)
+    outside = _count(traj, point & ~inside, n)
+
+    scale = 10 ** COORD_DECIMALS
+    t = traj[point]
+    keys = np.stack([t, np.round(lon[point] * scale).astype(np.int64),
+                     np.round(lat[point] * scale).astype(np.int64)], axis=1)
+    reused = np.zeros(n, dtype=np.int64)
+    hot = np.zeros(n, dtype=np.int64)
+    if len(keys):
+        # 同一轨迹中同一坐标对应多个不同地点名称，视为坐标复用
+        with_place = np.concatenate([keys, table['place'][point][:, None]], axis=1)
+        distinct = np.unique(with_place, axis=0)
+        _, places_per_coord = np.unique(distinct[:, :3], axis=0, return_counts=True)
+        _, inverse = np.unique(keys, axis=0, return_inverse=True)
+        reused = np.bincount(t, weights=(places_per_coord[inverse.ravel()] > 1), minlength=n).astype(np.int64)
+
+        # 跨轨迹统计每个坐标被多少条轨迹使用（两次unique得到的坐标集合相同、顺序一致）
+        per_traj = np.unique(keys, axis=0)
+        _, traj_counts = np.unique(per_traj[:, 1:], axis=0, return_counts=True)
+        _, point_inverse = np.unique(keys[:, 1:], axis=0, return_inverse=True)
+        threshold = max(HOT_COORD_MIN_COUNT, int(np.ceil(HOT_COORD_SHARE * n)))
+        is_hot = traj_counts[point_inverse.ravel()] >= threshold
+        hot = np.bincount(t, weights=is_hot, minlength=n).astype(np.int64)
+
+    return {
+        'activity_points': points,
+        'outside_bbox_share': _share(outside, points),
+        'reused_coord_share': _share(reused, points),
+        'hot_coord_share': _share(hot, points),
+    }
+
+
+def count_fields(parsed_list):
+    """统计每条轨迹中解析出的画像字段数和主观评价字段数"""
+    persona = np.asarray([sum(1 for f in PERSONA_FIELDS if p['persona'].get(f)) for p in parsed_list], dtype=np.float64)
+    evaluation = np.asarray([sum(1 for f in EVALUATION_FIELDS if p['evaluation'].get(f) is not None)
+                             for p in parsed_list], dtype=np.float64)
+    return persona, evaluation
+
+
+def check_format(persona, evaluation, table, n):
+    """格式完整性：画像字段、主观评价字段、出行/活动记录的时间与坐标是否齐全"""
+    traj = table['traj']
+    records = np.bincount(traj, minlength=n)
+    with_time = _count(traj, ~np.isnan(table['start']) & ~np.isnan(table['end']), n)
+    with_coord = _count(traj, ~np.isnan(table['lon']) & ~np.isnan(table['lat']), n)
+    activities = _count(traj, table['is_activity'], n)
+
+    parts = np.stack([
+        persona / len(PERSONA_FIELDS),
+        evaluation / len(EVALUATION_FIELDS),
+        _share(with_time, records),
+        _share(with_coord, records),
+        (activities > 0).astype(np.float64),
+    ])
+    return {
+        'records': records,
+        'activities': activities,
+        'completeness': parts.mean(axis=0),
+    }
+
+
+def run_checks(texts, bbox=LUJIAZUI_BBOX):
+    """
+    对整个语料运行规则检查
+
+    参数:
+        texts (list): model_response 文本列表
+
+    返回:
+        dict: 每个指标为长度等于轨迹数的数组，另含 rule_score、passed 和 reasons
+    """
+    parsed_list = [parse_trajectory(text) for text in texts]
+    persona, evaluation = count_fields(parsed_list)
+    return run_checks_on_table(build_segment_table(parsed_list), persona, evaluation, bbox)
+
+
+def run_checks_on_table(table, persona, evaluation, bbox=LUJIAZUI_BBOX):
+    """
+    在已构建好的记录表上运行规则检查（可直接使用 trajectory_store.py 的列式存储）
+
+    参数:
+        table (dict): build_segment_table 格式的列式数组
+        persona (ndarray): 每条轨迹的画像字段数
+        evaluation (ndarray): 每条轨迹的主观评价字段数
+    """
+    n = len(persona)
+    results = {}
+    results.update(check_format(persona, evaluation, table, n))
+    results.update(check_time(table, n))
+    results.update(check_coordinates(table, n, bbox))
+
+    penalty = (
+        1.5 * results['overlaps']
+        + 2.0 * results['negative_durations']
+        + 0.5 * results['gaps']
+        + 0.5 * results['duration_mismatches']
+        + 4.0 * results['outside_bbox_share']
+        + 2.0 * results['reused_coord_share']
+        + 5.0 * (1 - results['completeness'])
+        + 2.0 * (results['day_span_minutes'] < MIN_DAY_SPAN)
+    )
+    results['rule_score'] = np.clip(10.0 - penalty, 0.0, 10.0)
+
+    failures = {
+        'no_activities': results['activities'] == 0,
+        'incomplete_format': results['completeness'] < MIN_COMPLETENESS,
+        'outside_lujiazui': results['outside_bbox_share'] > MAX_OUTSIDE_SHARE,
+        'time_overlaps': results['overlaps'] >= MAX_OVERLAPS,
+        'negative_durations': results['negative_durations'] > 0,
+        'low_rule_score': results['rule_score'] < MIN_RULE_SCORE,
+    }
+    failed = np.zeros(n, dtype=bool)
+    for mask in failures.values():
+        failed |= mask
+    results['passed'] = ~failed
+    results['reasons'] = [[name for name, mask in failures.items() if mask[i]] for i in range(n)]
+    results['failure_counts'] = {name: int(mask.sum()) for name, mask in failures.items()}
+    return results
+
+
+def trajectory_report(results, i):
+    """返回单条轨迹的检查结果（可JSON序列化）"""
+    report = {}
+    for key, values in results.items():
+        if key in ('failure_counts',):
+            continue
+        value = values[i]
+        if isinstance(value, np.generic):
+            value = value.item()
+        if isinstance(value, float):
+            value = round(value, 4)
+        report[key] = value
+    return report
+
+
+def save_results(corpus, results, output_file):
+    """将每条轨迹的检查结果保存为CSV"""
+    fields = ['file', 'id'] + [k for k in results if k not in ('failure_counts',)]
+    with open(output_file, 'w', newline='', encoding='utf-8') as f:
+        writer = csv.DictWriter(f, fieldnames=fields)
+        writer.writeheader()
+        for i, (file_name, record_id, _) in enumerate(corpus):
+            row = trajectory_report(results, i)
+            row['reasons'] = ';'.join(row['reasons'])
+            row.update({'file': file_name, 'id': record_id})
+            writer.writerow(row)
+
+
+def print_summary(results, elapsed):
+    """打印语料级别的检查汇总"""
+    n = len(results['passed'])
+    print("\n========== 规则预评估汇总 ==========")
+    print(f"轨迹数: {n}, 通过: {int(results['passed'].sum())}, 过滤: {n - int(results['passed'].sum())}, 用时: {elapsed:.2f}秒")
+    if n == 0:
+        return
+    print(f"平均规则分: {results['rule_score'].mean():.2f}")
+    print(f"存在时间重叠的轨迹: {int((results['overlaps'] > 0).sum())}, 存在空档的轨迹: {int((results['gaps'] > 0).sum())}")
+    print(f"平均格式完整度: {results['completeness'].mean() * 100:.1f}%")
+    print(f"活动地点落在陆家嘴范围外的比例: {results['outside_bbox_share'].mean() * 100:.1f}%")
+    print(f"同一轨迹内坐标复用比例: {results['reused_coord_share'].mean() * 100:.1f}%, "
+          f"热门坐标比例: {results['hot_coord_share'].mean() * 100:.1f}%")
+    print("过滤原因:")
+    for name, count in results['failure_counts'].items():
+        print(f"  {name}: {count}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="在LLM评估前对活动轨迹进行规则检查")
+    parser.add_argument("--input_folder", type=str, default="/root/for_eval",
+                        help="对话JSON文件所在目录")
+    parser.add_argument("--output", type=str, default="/root/for_eval/rule_checks.csv",
+                        help="每条轨迹检查结果的CSV文件")
+    parser.add_argument("--store_dir", type=str, default=None,
+                        help="直接读取 trajectory_store.py 生成的Parquet存储，不再解析JSON文本")
+    args = parser.parse_args()
+
+    start_time = time.time()
+    if args.store_dir:
+        from trajectory_store import load_tables, to_segment_table
+
+        persons, activities = load_tables(args.store_dir)
+        table, persona, evaluation = to_segment_table(persons, activities)
+        results = run_checks_on_table(table, persona, evaluation)
+        corpus = list(zip(persons['file'].to_pylist(), persons['record_id'].to_pylist(), [None] * persons.num_rows))
+    else:
+        corpus = load_corpus(args.input_folder)
+        results = run_checks([text for _, _, text in corpus])
+    elapsed = time.time() - start_time
+
+    print_summary(results, elapsed)
+    save_results(corpus, results, args.output)
+    print(f"\n检查结果已保存到: {args.output}")
+
+
+if __name__ == "__main__":
+    main()
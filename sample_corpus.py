@@ -0,0 +1,193 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+JSONL语料流式抽样
+单次遍历源文件，用蓄水池抽样（Algorithm L）抽取固定条数，内存只与抽样条数有关，可处理数GB的语料；
+可按 [陆家嘴活动人群画像] 分层，每个画像各自维护蓄水池，遍历结束后按等量或按比例分配名额；随机种子固定时结果可复现
+
+用法:
+    python sample_corpus.py --input_file lora_finetune_dataset_functioncall.jsonl --output_file sample500.jsonl --num 500
+    python sample_corpus.py --input_file lora_finetune_dataset_functioncall.jsonl --output_file sample500.jsonl --num 500 --stratify equal
+"""
+
+import re
+import json
+import math
+import time
+import random
+import argparse
+from collections import Counter
+
+PERSONA_PATTERN = re.compile(r'\[陆家嘴活动人群画像\]\s*[:：]\s*\(?([^()（）\\\n\t"，,]+)')
+UNKNOWN_PERSONA = '未知'
+
+
+class Reservoir:
+    """
+    蓄水池抽样（Algorithm L）：前k条直接放入，之后按几何分布跳过若干条再随机替换一条，
+    随机数调用次数约为 k·log(n/k)
+
+    items 中保存 (行号, 内容)
+    """
+
+    def __init__(self, k, rng):
+        self.k = k
+        self.rng = rng
+        self.items = []
+        self.seen = 0
+        self.w = 1.0
+        self.next_index = None
+
+    def _schedule(self):
+        self.w *= math.exp(math.log(self.rng.random()) / self.k)
+        self.next_index = self.seen + int(math.log(self.rng.random()) / math.log(1 - self.w)) + 1
+
+    def offer(self, item):
+        self.seen += 1
+        if self.k <= 0:
+            return
+        if len(self.items) < self.k:
+            self.items.append(item)
+            if len(self.items) == self.k:
+                self._schedule()
+        elif self.seen == self.next_index:
+            self.items[self.rng.randrange(self.k)] = item
+            self._schedule()
+
+
+def extract_persona(line):
+    """从一行JSONL中取出人群画像；中文被转义为\\uXXXX时先解析JSON"""
+    match = PERSONA_PATTERN.search(line)
+    if match is None and '\\u' in line:
+        try:
+            match = PERSONA_PATTERN.search(json.dumps(json.loads(line), ensure_ascii=False))
+        except json.JSONDecodeError:
+            return UNKNOWN_PERSONA
+    return match.group(1).strip() if match else UNKNOWN_PERSONA
+
+
+def allocate(counts, num, strategy):
+    """
+    按各层的总条数分配抽样名额
+
+    参数:
+        counts (dict): 画像 -> 总条数
+        strategy (str): equal（各层等量，不足的层把余量让给其他层）或 proportional（按比例，最大余数法取整）
+    """
+    num = min(num, sum(counts.values()))
+    quota = {name: 0 for name in counts}
+    if strategy == 'proportional':
+        total = sum(counts.values())
+        exact = {name: num * count / total for name, count in counts.items()}
+        quota = {name: int(value) for name, value in exact.items()}
+        for name in sorted(exact, key=lambda n: exact[n] - quota[n], reverse=True)[:num - sum(quota.values())]:
+            quota[name] += 1
+        return quota
+
+    remaining = num
+    open_strata = sorted(counts, key=lambda n: counts[n])
+    while remaining > 0 and open_strata:
+        share = max(remaining // len(open_strata), 1)
+        for name in list(open_strata):
+            take = min(share, counts[name] - quota[name], remaining)
+            quota[name] += take
+            remaining -= take
+            if quota[name] >= counts[name]:
+                open_strata.remove(name)
+            if remaining == 0:
+                break
+    return quota
+
+
+def sample_corpus(input_file, num, stratify=None, seed=42):
+    """
+    单次遍历抽样
+
+    参数:
+        stratify (str): None 不分层；equal / proportional 按画像分层
+
+    返回:
+        (lines, report): 按源文件顺序排列的抽样行，以及统计信息
+    """
+    rng = random.Random(seed)
+    start_time = time.time()
+    reservoirs = {}
+    population = Counter()
+    total_bytes = 0
+    empty = 0
+
+    with open(input_file, 'rb') as f:
+        for index, raw in enumerate(f):
+            total_bytes += len(raw)
+            line = raw.decode('utf-8', errors='replace').rstrip('\r\n')
+            if not line.strip():
+                empty += 1
+                continue
+            persona = extract_persona(line) if stratify else None
+            population[persona] += 1
+            if persona not in reservoirs:
+                # 每层最多分到 num 条，蓄水池容量取 num 即可
+                reservoirs[persona] = Reservoir(num, random.Random(rng.random()))
+            reservoirs[persona].offer((index, line))
+
+    quota = allocate(population, num, stratify) if stratify else {None: min(num, population[None])}
+    sampled = []
+    for persona, reservoir in reservoirs.items():
+        items = reservoir.items
+        if len(items) > quota[persona]:
+            # 蓄水池本身是均匀样本，随机取其中一部分仍是均匀样本
+            items = reservoir.rng.sample(items, quota[persona])
+        sampled.extend((index, persona, line) for index, line in items)
+    sampled.sort()
+
+    elapsed = time.time() - start_time
+    report = {
+        'input_file': input_file,
+        'lines': sum(population.values()),
+        'empty_lines': empty,
+        'sampled': len(sampled),
+        'seconds': elapsed,
+        'mb_per_second': total_bytes / 2 ** 20 / elapsed if elapsed > 0 else 0.0,
+        'strata': {str(name): {'population': population[name], 'sampled': quota.get(name, 0)}
+                   for name in sorted(population, key=lambda n: -population[n])} if stratify else {},
+    }
+    return [line for _, _, line in sampled], report
+
+
+def print_sample_report(report):
+    """打印抽样统计"""
+    print("\n========== 抽样结果 ==========")
+    print(f"源文件: {report['input_file']}, 共 {report['lines']} 条（空行 {report['empty_lines']}）")
+    print(f"抽取: {report['sampled']} 条, 用时 {report['seconds']:.1f}秒 ({report['mb_per_second']:.1f}MB/秒)")
+    if report['strata']:
+        print(f"{'人群画像':<16}{'总数':>10}{'抽取':>8}")
+        for name, stats in report['strata'].items():
+            print(f"{name:<16}{stats['population']:>10}{stats['sampled']:>8}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="单次遍历的JSONL蓄水池抽样，可按人群画像分层")
+    parser.add_argument("--input_file", type=str, required=True,
+                        help="源JSONL文件")
+    parser.add_argument("--output_file", type=str, required=True,
+                        help="抽样结果JSONL文件")
+    parser.add_argument("--num", type=int, default=500,
+                        help="抽样条数")
+    parser.add_argument("--stratify", type=str, default=None, choices=["equal", "proportional"],
+                        help="按人群画像分层：equal 各画像等量，proportional 按画像占比")
+    parser.add_argument("--seed", type=int, default=42,
+                        help="随机种子")
+    args = parser.parse_args()
+
+    lines, report = sample_corpus(args.input_file, args.num, args.stratify, args.seed)
+    if len(lines) < args.num:
+        print(f"警告: 数据不足{args.num}条，只抽取了{len(lines)}条")
+    with open(args.output_file, 'w', encoding='utf-8') as f:
+        for line in lines:
+            f.write(line + '\n')
+    print_sample_report(report)
+    print(f"已保存到: {args.output_file}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,584 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+轨迹坐标的空间索引与出行可行性检查
+在陆家嘴POI/参考点集合上建立网格索引（安装了scipy时使用KD树），对整个语料批量完成：
+向量化的haversine距离、出行速度与出行方式是否匹配、相邻记录之间的“瞬移”、
+活动地点吸附到最近POI，以及坐标和POI的重复使用率
+"""
+
+import os
+import csv
+import json
+import time
+import argparse
+
+import numpy as np
+
+from rule_checks import LUJIAZUI_BBOX, load_corpus
+from trajectory_parser import SEGMENT_ACTIVITY, SEGMENT_TRIP, parse_trajectory
+
+try:
+    from scipy.spatial import cKDTree
+    SCIPY_AVAILABLE = True
+except ImportError:
+    SCIPY_AVAILABLE = False
+
+EARTH_RADIUS = 6371008.8  # 米
+ORIGIN = ((LUJIAZUI_BBOX[0] + LUJIAZUI_BBOX[2]) / 2, (LUJIAZUI_BBOX[1] + LUJIAZUI_BBOX[3]) / 2)
+
+CELL_SIZE = 250.0           # 网格边长（米）
+SNAP_RADIUS = 150.0         # 活动地点与最近POI的距离在该范围内视为吸附成功
+COORD_DECIMALS = 5          # 判断坐标是否相同时保留的小数位（约1米）
+MIN_CHECK_DISTANCE = 500.0  # 直线距离低于该值的出行不检查速度下限（等车、找车位等时间占比大）
+JUMP_TOLERANCE = 300.0      # 相邻记录之间位置跳变超过该距离才检查是否“瞬移”
+FASTEST_KMH = 120.0         # 城区内任何出行方式的直线速度上限
+DISTANCE_TOLERANCE = 0.3    # 标注距离与坐标计算距离的相对误差上限
+MIN_DISTANCE_ERROR = 200.0  # 且绝对误差超过该值（米）才视为不一致
+
+# 出行方式关键词 -> (直线速度下限, 上限)，单位 km/h；按顺序匹配，先匹配到的优先
+MODE_SPEEDS = [
+    (('磁悬浮',), (20.0, 300.0)),
+    (('步行', '走路'), (1.0, 8.0)),
+    (('电动', '电瓶', '摩托'), (4.0, 40.0)),
+    (('自行车', '单车', '骑行'), (3.0, 25.0)),
+    (('轮渡', '渡轮', '摆渡'), (3.0, 30.0)),
+    (('公交', '巴士', '班车'), (3.0, 50.0)),
+    (('地铁', '轨道', '轻轨'), (5.0, 80.0)),
+    (('出租', '网约', '打车', '滴滴', '私家车', '自驾', '驾车', '开车', '汽车', '专车'), (4.0, 80.0)),
+]
+UNKNOWN_MODE = 'other'
+
+
+def haversine(lon1, lat1, lon2, lat2):
+    """两组经纬度之间的球面距离（米），支持广播"""
+    lon1, lat1, lon2, lat2 = (np.radians(np.asarray(v, dtype=np.float64)) for v in (lon1, lat1, lon2, lat2))
+    a = np.sin((lat2 - lat1) / 2) ** 2 + np.cos(lat1) * np.cos(lat2) * np.sin((lon2 - lon1) / 2) ** 2
+    return 2 * EARTH_RADIUS * np.arcsin(np.sqrt(np.clip(a, 0.0, 1.0)))
+
+
+def project(lon, lat, origin=ORIGIN):
+    """以陆家嘴中心为原点的局部平面坐标（米），几公里范围内误差可以忽略"""
+    lon = np.asarray(lon, dtype=np.float64)
+    lat = np.asarray(lat, dtype=np.float64)
+    x = np.radians(lon - origin[0]) * EARTH_RADIUS * np.cos(np.radians(origin[1]))
+    y = np.radians(lat - origin[1]) * EARTH_RADIUS
+    return x, y
+
+
+class GridIndex:
+    """均匀网格上的最近邻索引：点按格子编号排序，查询时逐圈扩大搜索范围"""
+
+    def __init__(self, lon, lat, cell_size=CELL_SIZE):
+        self.cell_size = cell_size
+        self.x, self.y = project(lon, lat)
+        keys = self._keys(*self._cells(self.x, self.y))
+        self.order = np.argsort(keys, kind='stable')
+        self.sorted_keys = keys[self.order]
+        if len(self.x):
+            self.extent = max(np.ptp(self.x), np.ptp(self.y)) + cell_size
+        else:
+            self.extent = 0.0
+
+    def _cells(self, x, y):
+        return np.floor(x / self.cell_size).astype(np.int64), np.floor(y / self.cell_size).astype(np.int64)
+
+    @staticmethod
+    def _keys(cx, cy):
+        return (cx << 32) + (cy & 0xFFFFFFFF)
+
+    def _search_ring(self, qx, qy, radius):
+        """在 (2r+1)^2 个格子中找最近点，返回 (平面距离, 点下标)，找不到时为 (inf, -1)"""
+        n = len(qx)
+        best = np.full(n, np.inf)
+        best_index = np.full(n, -1, dtype=np.int64)
+        cx, cy = self._cells(qx, qy)
+        for dx in range(-radius, radius + 1):
+            for dy in range(-radius, radius + 1):
+                keys = self._keys(cx + dx, cy + dy)
+                lo = np.searchsorted(self.sorted_keys, keys, side='left')
+                hi = np.searchsorted(self.sorted_keys, keys, side='right')
+                counts = hi - lo
+                if not counts.any():
+                    continue
+                # 展开每个查询点在该格子中的全部候选点
+                query = np.repeat(np.arange(n), counts)
+                offsets = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+                candidate = self.order[np.repeat(lo, counts) + offsets]
+                dist = np.hypot(self.x[candidate] - qx[query], self.y[candidate] - qy[query])
+                cell_best = np.full(n, np.inf)
+                np.minimum.at(cell_best, query, dist)
+                winner = dist == cell_best[query]
+                cell_index = np.full(n, -1, dtype=np.int64)
+                cell_index[query[winner]] = candidate[winner]
+                better = cell_best < best
+                best[better] = cell_best[better]
+                best_index[better] = cell_index[better]
+        return best, best_index
+
+    def _brute_force(self, qx, qy, chunk=2048):
+        best = np.empty(len(qx))
+        best_index = np.empty(len(qx), dtype=np.int64)
+        for i in range(0, len(qx), chunk):
+            dist = np.hypot(qx[i:i + chunk, None] - self.x[None, :], qy[i:i + chunk, None] - self.y[None, :])
+            best_index[i:i + chunk] = dist.argmin(axis=1)
+            best[i:i + chunk] = dist[np.arange(len(dist)), best_index[i:i + chunk]]
+        return best, best_index
+
+    def query(self, lon, lat, max_distance=None):
+        """
+        批量最近邻查询
+
+        返回:
+            tuple: (平面距离, 点下标)；max_distance 范围内没有点时距离为inf、下标为-1
+        """
+        qx, qy = project(lon, lat)
+        n = len(qx)
+        dist = np.full(n, np.inf)
+        index = np.full(n, -1, dtype=np.int64)
+        if n == 0 or len(self.x) == 0:
+            return dist, index
+
+        pending = np.arange(n)
+        radius = 1
+        while len(pending):
+            reach = radius * self.cell_size  # 搜索范围内切圆的半径，小于它的结果一定是最近点
+            if radius > 4 and (max_distance is None or reach < max_distance):
+                # 附近格子都是空的，剩下的查询直接逐点比较
+                d, i = self._brute_force(qx[pending], qy[pending])
+                dist[pending], index[pending] = d, i
+                break
+            d, i = self._search_ring(qx[pending], qy[pending], radius)
+            dist[pending], index[pending] = d, i
+            done = d <= reach
+            if max_distance is not None and reach >= max_distance:
+                done[:] = True
+            pending = pending[~done]
+            radius *= 2
+
+        if max_distance is not None:
+            index[dist > max_distance] = -1
+            dist[dist > max_distance] = np.inf
+        return dist, index
+
+
+class KDTreeIndex:
+    """scipy的KD树，接口与 GridIndex 相同"""
+
+    def __init__(self, lon, lat):
+        self.tree = cKDTree(np.column_stack(project(lon, lat)))
+        self.size = len(lon)
+
+    def query(self, lon, lat, max_distance=None):
+        points = np.column_stack(project(lon, lat))
+        n = len(points)
+        if n == 0 or self.size == 0:
+            return np.full(n, np.inf), np.full(n, -1, dtype=np.int64)
+        dist, index = self.tree.query(points, k=1, distance_upper_bound=np.inf if max_distance is None else max_distance)
+        index = np.where(np.isfinite(dist), index, -1).astype(np.int64)
+        return dist, index
+
+
+def build_index(lon, lat, use_kdtree=True, cell_size=CELL_SIZE):
+    """安装了scipy时使用KD树，否则使用网格索引"""
+    if use_kdtree and SCIPY_AVAILABLE:
+        return KDTreeIndex(lon, lat)
+    return GridIndex(lon, lat, cell_size)
+
+
+def load_pois(poi_file):
+    """读取POI参考点CSV（列：name, type, lon, lat），返回 dict 列式数组"""
+    names, types, lons, lats = [], [], [], []
+    with open(poi_file, 'r', encoding='utf-8-sig') as f:
+        for row in csv.DictReader(f):
+            try:
+                lon, lat = float(row['lon']), float(row['lat'])
+            except (KeyError, TypeError, ValueError):
+                continue
+            names.append((row.get('name') or '').strip())
+            types.append((row.get('type') or '').strip())
+            lons.append(lon)
+            lats.append(lat)
+    return {'name': names, 'type': types, 'lon': np.asarray(lons), 'lat': np.asarray(lats),
+            'source': os.path.basename(poi_file)}
+
+
+def pois_from_corpus(table, min_count=2):
+    """
+    没有POI数据时，用语料中出现过的地点名称构建参考点：每个名称取其活动坐标的中位数
+
+    只保留至少出现 min_count 次的名称，偶发的虚构地点不作为参考点
+    """
+    point = table['is_activity'] & ~np.isnan(table['lon']) & ~np.isnan(table['lat']) & (table['place'] > 0)
+    place = table['place'][point]
+    names, types, lons, lats = [], [], [], []
+    if len(place):
+        order = np.argsort(place, kind='stable')
+        ids, starts, counts = np.unique(place[order], return_index=True, return_counts=True)
+        lon, lat = table['lon'][point][order], table['lat'][point][order]
+        for place_id, start, count in zip(ids, starts, counts):
+            if count < min_count:
+                continue
+            names.append(table['place_names'][place_id])
+            types.append('')
+            lons.append(float(np.median(lon[start:start + count])))
+            lats.append(float(np.median(lat[start:start + count])))
+    return {'name': names, 'type': types, 'lon': np.asarray(lons), 'lat': np.asarray(lats), 'source': 'corpus'}
+
+
+def classify_modes(modes):
+    """出行方式文本 -> MODE_SPEEDS 中的类别下标，未识别的为-1"""
+    result = []
+    for mode in modes:
+        category = -1
+        for i, (keywords, _) in enumerate(MODE_SPEEDS):
+            if mode and any(k in mode for k in keywords):
+                category = i
+                break
+        result.append(category)
+    return np.asarray(result, dtype=np.int64)
+
+
+def mode_label(category):
+    return MODE_SPEEDS[category][0][0] if category >= 0 else UNKNOWN_MODE
+
+
+def build_spatial_table(parsed_list):
+    """将所有轨迹的出行/活动记录拼接为列式数组（含出行起点、出行方式和标注距离），缺失值为 NaN"""
+    numeric = ('start', 'end', 'stated_minutes', 'lon', 'lat', 'origin_lon', 'origin_lat', 'distance')
+    columns = {name: [] for name in numeric}
+    traj, kind, modes, places = [], [], [], []
+    for traj_index, parsed in enumerate(parsed_list):
+        for segment in parsed['segments']:
+            traj.append(traj_index)
+            kind.append(segment['kind'])
+            modes.append(segment['mode'] or '')
+            places.append(segment['place_name'] or '')
+            for name in numeric:
+                value = segment[name]
+                columns[name].append(np.nan if value is None else value)
+    return _finish_table(traj, kind, modes, places, columns)
+
+
+def _finish_table(traj, kind, modes, places, columns):
+    table = {name: np.asarray(values, dtype=np.float64) for name, values in columns.items()}
+    table['stated'] = table.pop('stated_minutes')
+    table['traj'] = np.asarray(traj, dtype=np.int64)
+    kind = np.asarray(kind, dtype=object)
+    table['is_activity'] = kind == SEGMENT_ACTIVITY
+    table['is_trip'] = kind == SEGMENT_TRIP
+
+    # 出行方式只对不同取值做一次关键词匹配
+    unique_modes, mode_inverse = np.unique(np.asarray(modes, dtype=object).astype(str), return_inverse=True)
+    table['mode'] = classify_modes(unique_modes)[mode_inverse.ravel()] if len(modes) else np.zeros(0, dtype=np.int64)
+
+    # 地点名称编码为整数，0 表示没有名称
+    place_ids = {'': 0}
+    table['place'] = np.asarray([place_ids.setdefault(p, len(place_ids)) for p in places], dtype=np.int64)
+    table['place_names'] = list(place_ids)
+    return table
+
+
+def spatial_table_from_store(persons, activities):
+    """由 trajectory_store.py 的列式存储构建 build_spatial_table 格式的数组，轨迹下标按 persons 的行顺序"""
+    person_ids = persons['person_id'].to_numpy()
+    order = np.argsort(person_ids, kind='stable')
+    traj = order[np.searchsorted(person_ids, activities['person_id'].to_numpy(), sorter=order)]
+
+    def strings(name):
+        return [value or '' for value in activities[name].to_pylist()]
+
+    columns = {name: activities[name].to_numpy(zero_copy_only=False).astype(np.float64)
+               for name in ('start', 'end', 'stated_minutes', 'lon', 'lat', 'origin_lon', 'origin_lat', 'distance')}
+    return _finish_table(traj, strings('kind'), strings('mode'), strings('place_name'), columns)
+
+
+def _count(traj, mask, n):
+    return np.bincount(traj[mask], minlength=n)
+
+
+def _share(numerator, denominator):
+    return np.divide(numerator, denominator, out=np.zeros(len(numerator)), where=denominator > 0)
+
+
+def check_trips(table, n):
+    """出行检查：起终点直线距离、由时长推算的速度是否符合出行方式、标注距离是否与坐标一致"""
+    trip = table['is_trip'] & ~np.isnan(table['origin_lon']) & ~np.isnan(table['lon'])
+    distance = np.full(len(trip), np.nan)
+    distance[trip] = haversine(table['origin_lon'][trip], table['origin_lat'][trip],
+                               table['lon'][trip], table['lat'][trip])
+
+    # 优先使用起止时间，缺失时使用标注的出行时耗
+    minutes = np.where(~np.isnan(table['start']) & ~np.isnan(table['end']),
+                       table['end'] - table['start'], table['stated'])
+    timed = trip & ~np.isnan(minutes)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        speed = np.where(minutes > 0, distance / 1000 / (minutes / 60), np.where(distance > 0, np.inf, 0.0))
+    speed[~timed] = np.nan
+
+    bounds = np.array([b for _, b in MODE_SPEEDS] + [(0.0, FASTEST_KMH)])
+    low, high = bounds[table['mode'], 0], bounds[table['mode'], 1]  # 未识别的方式(-1)取最后一行
+    too_fast = timed & (speed > high)
+    too_slow = timed & (distance >= MIN_CHECK_DISTANCE) & (speed < low)
+
+    stated = table['distance']
+    error = np.abs(stated - distance)
+    mismatch = trip & ~np.isnan(stated) & (error > MIN_DISTANCE_ERROR) & (error > DISTANCE_TOLERANCE * distance)
+
+    table['trip_distance'] = distance
+    table['trip_speed'] = speed
+    table['too_fast'] = too_fast
+    table['too_slow'] = too_slow
+    return {
+        'trips_checked': _count(table['traj'], timed, n),
+        'too_fast_trips': _count(table['traj'], too_fast, n),
+        'too_slow_trips': _count(table['traj'], too_slow, n),
+        'distance_mismatches': _count(table['traj'], mismatch, n),
+        'trip_km': np.bincount(table['traj'][trip], weights=distance[trip], minlength=n) / 1000,
+    }
+
+
+def check_jumps(table, n):
+    """相邻记录之间的衔接：上一条的终点与下一条的起点相距很远、而间隔时间不足以到达，视为瞬移"""
+    # 出行的起点是出行起点，其余位置均为记录本身的坐标（活动地点或出行终点）
+    start_lon = np.where(table['is_trip'], table['origin_lon'], table['lon'])
+    start_lat = np.where(table['is_trip'], table['origin_lat'], table['lat'])
+    located = ~np.isnan(start_lon) & ~np.isnan(table['lon'])
+    t = table['traj'][located]
+    same = t[1:] == t[:-1]
+    gap = haversine(table['lon'][located][:-1], table['lat'][located][:-1],
+                    start_lon[located][1:], start_lat[located][1:])
+    elapsed = table['start'][located][1:] - table['end'][located][:-1]
+    with np.errstate(divide='ignore', invalid='ignore'):
+        speed = np.where(elapsed > 0, gap / 1000 / (elapsed / 60), np.inf)
+    # 没有时间信息时无法判断，只统计有时间的衔接
+    jump = same & (gap > JUMP_TOLERANCE) & ~np.isnan(elapsed) & (speed > FASTEST_KMH)
+    return {
+        'teleports': np.bincount(t[1:][jump], minlength=n) if len(t) else np.zeros(n, dtype=np.int64),
+        'max_gap_m': _max_by(t[1:][same], gap[same], n) if len(t) else np.zeros(n),
+    }
+
+
+def _max_by(traj, values, n):
+    result = np.zeros(n)
+    np.maximum.at(result, traj, values)
+    return result
+
+
+def snap_points(table, index, pois, n, snap_radius=SNAP_RADIUS):
+    """把活动地点吸附到最近的POI，统计吸附成功率、距离以及与地点名称是否一致"""
+    point = table['is_activity'] & ~np.isnan(table['lon']) & ~np.isnan(table['lat'])
+    lon, lat = table['lon'][point], table['lat'][point]
+    _, nearest = index.query(lon, lat)
+    found = nearest >= 0
+    distance = np.full(len(lon), np.inf)
+    distance[found] = haversine(lon[found], lat[found], pois['lon'][nearest[found]], pois['lat'][nearest[found]])
+    snapped = distance <= snap_radius
+
+    # 有名称的地点：吸附到的POI名称与地点名称互相包含即视为一致
+    place_names = table['place_names']
+    place = table['place'][point]
+    poi_names = pois['name']
+    name_match = np.array([
+        bool(place_names[p]) and i >= 0 and bool(poi_names[i])
+        and (place_names[p] in poi_names[i] or poi_names[i] in place_names[p])
+        for p, i in zip(place, nearest)
+    ], dtype=bool)
+
+    t = table['traj'][point]
+    points = np.bincount(t, minlength=n)
+    snap_index = np.full(len(table['traj']), -1, dtype=np.int64)
+    snap_index[np.flatnonzero(point)[snapped]] = nearest[snapped]
+    table['snap_poi'] = snap_index
+    return {
+        'snapped_share': _share(np.bincount(t, weights=snapped, minlength=n), points),
+        'name_match_share': _share(np.bincount(t, weights=name_match, minlength=n), points),
+        'median_snap_m': _median_by(t, distance, n),
+    }
+
+
+def _median_by(traj, values, n):
+    result = np.full(n, np.nan)
+    if len(traj):
+        order = np.lexsort((values, traj))
+        ids, starts, counts = np.unique(traj[order], return_index=True, return_counts=True)
+        result[ids] = values[order][starts + (counts - 1) // 2]
+    return result
+
+
+def location_reuse(table, n):
+    """坐标重复使用：同一轨迹内重复的坐标、被多条轨迹共用的坐标，以及POI的集中程度"""
+    point = table['is_activity'] & ~np.isnan(table['lon']) & ~np.isnan(table['lat'])
+    t = table['traj'][point]
+    scale = 10 ** COORD_DECIMALS
+    coord = np.stack([np.round(table['lon'][point] * scale).astype(np.int64),
+                      np.round(table['lat'][point] * scale).astype(np.int64)], axis=1)
+    points = np.bincount(t, minlength=n)
+    result = {'activity_points': points}
+    corpus = {'points': int(len(t)), 'distinct_coords': 0, 'shared_coord_share': 0.0,
+              'repeated_in_traj_share': 0.0, 'top_coords': [], 'pois_used': 0, 'top10_poi_share': 0.0}
+    if not len(t):
+        result['repeated_coord_share'] = np.zeros(n)
+        result['shared_coord_share'] = np.zeros(n)
+        return result, corpus
+
+    coords, coord_inverse, coord_counts = np.unique(coord, axis=0, return_inverse=True, return_counts=True)
+    coord_inverse = coord_inverse.ravel()
+    # 每个坐标被多少条不同轨迹使用
+    pairs = np.unique(np.stack([coord_inverse, t], axis=1), axis=0)
+    traj_per_coord = np.bincount(pairs[:, 0], minlength=len(coords))
+    shared = traj_per_coord[coord_inverse] >= 2
+    # 同一轨迹内再次出现的坐标（第一次出现不计）
+    _, first = np.unique(np.stack([t, coord_inverse], axis=1), axis=0, return_index=True)
+    repeated = np.ones(len(t), dtype=bool)
+    repeated[first] = False
+
+    result['repeated_coord_share'] = _share(np.bincount(t, weights=repeated, minlength=n), points)
+    result['shared_coord_share'] = _share(np.bincount(t, weights=shared, minlength=n), points)
+
+    names = np.asarray(table['place_names'], dtype=object)[table['place'][point]]
+    top = np.argsort(-traj_per_coord, kind='stable')[:10]
+    corpus.update({
+        'distinct_coords': int(len(coords)),
+        'shared_coord_share': float(shared.mean()),
+        'repeated_in_traj_share': float(repeated.mean()),
+        'top_coords': [{'lon': float(coords[i, 0]) / scale, 'lat': float(coords[i, 1]) / scale,
+                        'trajectories': int(traj_per_coord[i]), 'uses': int(coord_counts[i]),
+                        'name': names[np.argmax(coord_inverse == i)]}
+                       for i in top if traj_per_coord[i] >= 2],
+    })
+    if 'snap_poi' in table:
+        snapped = table['snap_poi'][point]
+        snapped = snapped[snapped >= 0]
+        if len(snapped):
+            usage = np.sort(np.bincount(snapped))[::-1]
+            corpus['pois_used'] = int((usage > 0).sum())
+            corpus['top10_poi_share'] = float(usage[:10].sum() / len(snapped))
+    return result, corpus
+
+
+def run_spatial_checks(table, n, pois=None, use_kdtree=True, snap_radius=SNAP_RADIUS):
+    """
+    对整个语料运行空间检查
+
+    参数:
+        table (dict): build_spatial_table 格式的列式数组
+        n (int): 轨迹数
+        pois (dict): load_pois 格式的参考点；为None时由语料中的地点名称构建
+
+    返回:
+        tuple: (每条轨迹的指标数组 dict, 语料级统计 dict)
+    """
+    start_time = time.time()
+    if pois is None:
+        pois = pois_from_corpus(table)
+    index = build_index(pois['lon'], pois['lat'], use_kdtree)
+    results = {}
+    results.update(check_trips(table, n))
+    results.update(check_jumps(table, n))
+    results.update(snap_points(table, index, pois, n, snap_radius))
+    reuse, corpus = location_reuse(table, n)
+    results.update(reuse)
+    results['spatial_ok'] = (results['too_fast_trips'] == 0) & (results['teleports'] == 0)
+
+    trips = ~np.isnan(table['trip_speed'])
+    by_mode = {}
+    for category in np.unique(table['mode'][trips]):
+        mask = trips & (table['mode'] == category)
+        finite = mask & np.isfinite(table['trip_speed'])
+        by_mode[mode_label(category)] = {
+            'trips': int(mask.sum()),
+            'median_kmh': float(np.median(table['trip_speed'][finite])) if finite.any() else None,
+            'too_fast': int(table['too_fast'][mask].sum()),
+            'too_slow': int(table['too_slow'][mask].sum()),
+        }
+    corpus.update({
+        'trajectories': n,
+        'poi_source': pois['source'],
+        'pois': int(len(pois['lon'])),
+        'index': type(index).__name__,
+        'by_mode': by_mode,
+        'teleport_trajectories': int((results['teleports'] > 0).sum()),
+        'distance_mismatches': int(results['distance_mismatches'].sum()),
+        'snapped_share': float((table['snap_poi'] >= 0).sum() / corpus['points']) if corpus['points'] else 0.0,
+        'elapsed': time.time() - start_time,
+    })
+    return results, corpus
+
+
+def save_results(files, results, output_file):
+    """将每条轨迹的空间检查结果保存为CSV"""
+    fields = ['file'] + list(results)
+    with open(output_file, 'w', newline='', encoding='utf-8') as f:
+        writer = csv.DictWriter(f, fieldnames=fields)
+        writer.writeheader()
+        for i, file_name in enumerate(files):
+            row = {'file': file_name}
+            for key, values in results.items():
+                value = values[i].item() if isinstance(values[i], np.generic) else values[i]
+                row[key] = round(value, 4) if isinstance(value, float) else value
+            writer.writerow(row)
+
+
+def print_spatial_report(corpus):
+    """打印语料级别的空间检查汇总"""
+    print("\n========== 空间检查汇总 ==========")
+    print(f"轨迹数: {corpus['trajectories']}, 活动地点: {corpus['points']}, "
+          f"参考点: {corpus['pois']} ({corpus['poi_source']}, {corpus['index']}), 用时: {corpus['elapsed']:.2f}秒")
+    print("各出行方式的直线速度:")
+    for mode, s in corpus['by_mode'].items():
+        median = f"{s['median_kmh']:.1f}km/h" if s['median_kmh'] is not None else "-"
+        print(f"  {mode}: {s['trips']} 次, 中位数 {median}, 过快 {s['too_fast']}, 过慢 {s['too_slow']}")
+    print(f"存在瞬移的轨迹: {corpus['teleport_trajectories']}, 标注距离与坐标不一致的出行: {corpus['distance_mismatches']}")
+    print(f"吸附到POI的活动地点: {corpus['snapped_share'] * 100:.1f}%, 用到的POI: {corpus['pois_used']}, "
+          f"前10个POI占比: {corpus['top10_poi_share'] * 100:.1f}%")
+    print(f"不同坐标: {corpus['distinct_coords']}, 多条轨迹共用的坐标占比: {corpus['shared_coord_share'] * 100:.1f}%, "
+          f"同一轨迹内重复的坐标占比: {corpus['repeated_in_traj_share'] * 100:.1f}%")
+    for c in corpus['top_coords'][:5]:
+        print(f"  ({c['lon']:.5f}, {c['lat']:.5f}) {c['name'] or '-'}: {c['trajectories']} 条轨迹, {c['uses']} 次")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="轨迹坐标的空间索引与出行可行性检查")
+    parser.add_argument("--input_folder", type=str, default="/root/for_eval",
+                        help="对话JSON文件所在目录")
+    parser.add_argument("--store_dir", type=str, default=None,
+                        help="直接读取 trajectory_store.py 生成的Parquet存储，不再解析JSON文本")
+    parser.add_argument("--poi_file", type=str, default=None,
+                        help="POI参考点CSV（列：name,type,lon,lat），不指定时由语料中的地点名称构建")
+    parser.add_argument("--snap_radius", type=float, default=SNAP_RADIUS,
+                        help="吸附到最近POI的最大距离（米）")
+    parser.add_argument("--grid", action="store_true",
+                        help="即使安装了scipy也使用网格索引")
+    parser.add_argument("--output", type=str, default="/root/for_eval/spatial_checks.csv",
+                        help="每条轨迹检查结果的CSV文件")
+    parser.add_argument("--json", type=str, default=None,
+                        help="将语料级统计另存为JSON文件")
+    args = parser.parse_args()
+
+    start_time = time.time()
+    if args.store_dir:
+        from trajectory_store import load_tables
+
+        persons, activities = load_tables(args.store_dir)
+        table = spatial_table_from_store(persons, activities)
+        files = persons['file'].to_pylist()
+    else:
+        corpus = load_corpus(args.input_folder)
+        table = build_spatial_table([parse_trajectory(text) for _, _, text in corpus])
+        files = [file_name for file_name, _, _ in corpus]
+    print(f"读取 {len(files)} 条轨迹、{len(table['traj'])} 条记录，用时 {time.time() - start_time:.2f} 秒")
+
+    pois = load_pois(args.poi_file) if args.poi_file else None
+    results, summary = run_spatial_checks(table, len(files), pois, not args.grid, args.snap_radius)
+    print_spatial_report(summary)
+    save_results(files, results, args.output)
+    print(f"\n检查结果已保存到: {args.output}")
+    if args.json:
+        with open(args.json, 'w', encoding='utf-8') as f:
+            json.dump(summary, f, ensure_ascii=False, indent=2)
+        print(f"统计已保存到: {args.json}")
+
+
+if __name__ == "__main__":
+    main()
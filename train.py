@@ -0,0 +1,412 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+LoRA/SFT微调训练入口
+把 runft.ipynb 中的训练流程整理为可重复运行的脚本：所有参数（LoRA、SFTConfig、量化）来自JSON配置文件，
+训练中定期保存包含优化器、学习率调度器和随机数状态的检查点，中断后可从最近的检查点精确续训，并记录训练吞吐量
+
+用法:
+    python train.py --config configs/train_default.json
+    python train.py --config configs/train_smoke_cpu.json --set sft.max_steps=4
+
+较新版本的trl用Triton内核计算损失，在没有GPU的机器上运行冒烟配置时需要设置 TRITON_INTERPRET=1
+"""
+
+import os
+import copy
+import json
+import time
+import signal
+import argparse
+from enum import Enum
+
+import torch
+from datasets import load_dataset
+from peft import LoraConfig, TaskType
+from transformers import AutoConfig, AutoModelForCausalLM, AutoTokenizer, TrainerCallback, set_seed
+from transformers.trainer_pt_utils import LengthGroupedSampler
+from transformers.trainer_utils import get_last_checkpoint
+from trl import SFTConfig, SFTTrainer
+
+from new_token_rows import expose_output_bias, token_row_kwargs
+from train_instrumentation import InstrumentationCallback
+
+DEFAULT_CONFIG = 'configs/train_default.json'
+RUN_CONFIG_FILE = 'train_config.json'
+FINAL_DIR = 'final_model'
+
+# 与训练数据预处理一致的聊天模板（不支持system角色，system内容合并到第一条用户消息）
+CHAT_TEMPLATE = (
+    "{{ bos_token }}"
+    "{% if messages[0]['role'] == 'system' %}{{ raise_exception('System role not supported') }}{% endif %}"
+    "{% for message in messages %}"
+    "{{ '<start_of_turn>' + message['role'] + '\n' + message['content'] | trim + '<end_of_turn><eos>\n' }}"
+    "{% endfor %}"
+    "{% if add_generation_prompt %}{{'<start_of_turn>model\n'}}{% endif %}"
+)
+
+THINK_INSTRUCTION = (
+    "Also, before making a call to a function take the time to plan the function to take. "
+    "Make that thinking process between <think>{your thoughts}</think>\n\n"
+)
+
+
+class ChatmlSpecialTokens(str, Enum):
+    tools = "<tools>"
+    eotools = "</tools>"
+    think = "<think>"
+    eothink = "</think>"
+    tool_call = "<tool_call>"
+    eotool_call = "</tool_call>"
+    tool_response = "<tool_response>"
+    eotool_response = "</tool_response>"
+    answer = "<answer>"
+    eoanswer = "</answer>"
+    start_of_turn = "<start_of_turn>"
+    end_of_turn = "<end_of_turn>"
+    pad_token = "<pad>"
+    eos_token = "<eos>"
+
+    @classmethod
+    def list(cls):
+        return [c.value for c in cls]
+
+
+def parse_override(text):
+    """解析 --set 参数 "a.b=value"，value 能按JSON解析时按JSON解析"""
+    key, _, value = text.partition('=')
+    try:
+        value = json.loads(value)
+    except ValueError:
+        pass
+    return key.strip().split('.'), value
+
+
+def load_config(path, overrides=()):
+    """读取JSON配置并应用命令行覆盖项"""
+    with open(path, 'r', encoding='utf-8') as f:
+        config = json.load(f)
+    for override in overrides:
+        keys, value = parse_override(override)
+        node = config
+        for key in keys[:-1]:
+            node = node.setdefault(key, {})
+        node[keys[-1]] = value
+    return config
+
+
+def load_tokenizer(config):
+    """加载tokenizer，按配置添加特殊标记并设置聊天模板"""
+    kwargs = {}
+    if config.get('special_tokens', True):
+        kwargs = {'pad_token': ChatmlSpecialTokens.pad_token.value,
+                  'additional_special_tokens': ChatmlSpecialTokens.list()}
+    tokenizer = AutoTokenizer.from_pretrained(config.get('tokenizer_path') or config['model_path'], **kwargs)
+    tokenizer.chat_template = CHAT_TEMPLATE
+    if tokenizer.pad_token is None:
+        tokenizer.pad_token = tokenizer.eos_token
+    return tokenizer
+
+
+def to_messages(sample):
+    """对话格式（conversation/messages）或Alpaca格式（instruction/input/output）统一为消息列表"""
+    messages = sample.get('messages') or sample.get('conversation')
+    if messages is None and sample.get('output') is not None:
+        prompt = '\n'.join(part for part in (sample.get('instruction'), sample.get('input')) if part)
+        messages = [{'role': 'user', 'content': prompt}, {'role': 'assistant', 'content': sample['output']}]
+    return messages
+
+
+def merge_system_message(messages):
+    """聊天模板不支持system角色：把system内容和思考提示拼接到第一条用户消息前"""
+    if messages and isinstance(messages[0], dict) and messages[0].get('role') == 'system':
+        system_message_content = messages[0]['content']
+        messages = [dict(m) for m in messages[1:]]
+        if messages:
+            messages[0]['content'] = system_message_content + THINK_INSTRUCTION + messages[0]['content']
+    return messages
+
+
+def render_sample(sample, tokenizer):
+    messages = to_messages(sample)
+    if not isinstance(messages, list):
+        return {'text': 'Error: unexpected message format'}
+    return {'text': tokenizer.apply_chat_template(merge_system_message(messages), tokenize=False)}
+
+
+def build_dataset(config, tokenizer):
+    """读取JSONL数据集，渲染聊天模板并划分训练集和验证集"""
+    data = config['data']
+    dataset = load_dataset('json', data_files=data['path'])['train']
+    dataset = dataset.map(lambda sample: render_sample(sample, tokenizer), remove_columns=dataset.column_names)
+    dataset = dataset.filter(lambda sample: not sample['text'].startswith('Error:'))
+    split = dataset.train_test_split(test_size=data.get('test_size', 0.05), seed=config.get('seed', 42))
+    for name, limit in (('train', data.get('max_train_samples')), ('test', data.get('max_eval_samples'))):
+        if limit and len(split[name]) > limit:
+            print(f"缩减{name}集大小: {len(split[name])} -> {limit}")
+            split[name] = split[name].select(range(limit))
+    return split
+
+
+def resolve_dtype(name):
+    if name in (None, 'auto'):
+        return name
+    return getattr(torch, name)
+
+
+def build_quantization_config(quantization):
+    """由配置构造 BitsAndBytesConfig；未配置量化时返回None"""
+    if not quantization:
+        return None
+    try:
+        import bitsandbytes  # noqa: F401
+    except ImportError:
+        raise ImportError("量化训练需要bitsandbytes库，可以通过 'pip install bitsandbytes' 安装")
+    from transformers import BitsAndBytesConfig
+
+    kwargs = dict(quantization)
+    for key in ('bnb_4bit_compute_dtype', 'bnb_4bit_quant_storage'):
+        if key in kwargs:
+            kwargs[key] = resolve_dtype(kwargs[key])
+    return BitsAndBytesConfig(**kwargs)
+
+
+def load_model(config, tokenizer):
+    """加载基础模型；random_init 用于冒烟测试，按基础模型结构缩小后随机初始化，不下载权重"""
+    model_config = config.get('model', {})
+    dtype = resolve_dtype(model_config.get('torch_dtype', 'bfloat16'))
+    quantization_config = build_quantization_config(config.get('quantization'))
+
+    if model_config.get('random_init'):
+        base = AutoConfig.from_pretrained(config['model_path'])
+        for key, value in model_config['random_init'].items():
+            setattr(base, key, value)
+        model = AutoModelForCausalLM.from_config(base, dtype=dtype)
+    else:
+        kwargs = {'dtype': dtype, 'attn_implementation': model_config.get('attn_implementation', 'eager')}
+        if model_config.get('device_map'):
+            kwargs['device_map'] = model_config['device_map']
+        if quantization_config is not None:
+            kwargs['quantization_config'] = quantization_config
+        model = AutoModelForCausalLM.from_pretrained(config['model_path'], **kwargs)
+
+    if len(tokenizer) != model.get_input_embeddings().weight.shape[0]:
+        model.resize_token_embeddings(len(tokenizer))
+    if quantization_config is not None:
+        from peft import prepare_model_for_kbit_training
+
+        model = prepare_model_for_kbit_training(
+            model, use_gradient_checkpointing=config['sft'].get('gradient_checkpointing', False))
+    return model
+
+
+def build_peft_config(config, model=None, tokenizer=None):
+    lora = dict(config['lora'])
+    lora.setdefault('task_type', TaskType.CAUSAL_LM)
+    if config.get('new_token_rows', 'none') != 'none':
+        lora.update(token_row_kwargs(config['new_token_rows'], model, tokenizer))
+    return LoraConfig(**lora)
+
+
+def build_sft_config(config, pretokenized=False):
+    kwargs = dict(config['sft'])
+    batching = config['data'].get('batching', 'pad')
+    if batching == 'bucket':
+        kwargs.setdefault('train_sampling_strategy', 'group_by_length')
+    elif batching == 'pack' and not pretokenized:
+        kwargs['packing'] = True
+    if pretokenized:
+        # 预分词数据已包含 input_ids 和 labels，跳过 SFTTrainer 的分词；损失掩码由 pretokenize.py 处理，打包由 packing.py 处理
+        if kwargs.get('packing') and batching != 'pack':
+            print("预分词数据使用 data.batching=pack 打包，已关闭 sft.packing")
+        kwargs.update(packing=False, assistant_only_loss=False, remove_unused_columns=False,
+                      dataset_kwargs={'skip_prepare_dataset': True})
+    kwargs.setdefault('include_num_input_tokens_seen', True)
+    kwargs.setdefault('seed', config.get('seed', 42))
+    return SFTConfig(output_dir=config['output_dir'], **kwargs)
+
+
+class LengthAwareSFTTrainer(SFTTrainer):
+    """按长度分桶时直接读取数据集的 length 列，避免经过预分词数据集的 transform 逐条读取样本"""
+
+    def _get_train_sampler(self, train_dataset=None):
+        dataset = self.train_dataset if train_dataset is None else train_dataset
+        name = self.args.length_column_name
+        if self.args.train_sampling_strategy == 'group_by_length' and name in getattr(dataset, 'column_names', ()):
+            lengths = dataset.with_format(None)[name][:]
+            return LengthGroupedSampler(self.args.train_batch_size * self.args.gradient_accumulation_steps,
+                                        lengths=lengths)
+        return super()._get_train_sampler(train_dataset)
+
+
+class ThroughputCallback(TrainerCallback):
+    """在每次记录日志时计算两次日志之间的 tokens/秒、样本/秒 和每步耗时"""
+
+    def __init__(self, log_file=None):
+        self.log_file = log_file
+        self.last_time = None
+        self.last_step = 0
+        self.last_tokens = 0
+
+    def on_train_begin(self, args, state, control, **kwargs):
+        # 续训时从检查点的步数和已处理token数开始计算
+        self.last_time = time.time()
+        self.last_step = state.global_step
+        self.last_tokens = state.num_input_tokens_seen or 0
+
+    def on_log(self, args, state, control, logs=None, **kwargs):
+        if logs is None or 'loss' not in logs or self.last_time is None:
+            return
+        now = time.time()
+        elapsed = max(now - self.last_time, 1e-9)
+        steps = state.global_step - self.last_step
+        tokens = (state.num_input_tokens_seen or 0) - self.last_tokens
+        samples = steps * args.per_device_train_batch_size * args.gradient_accumulation_steps * args.world_size
+        record = {
+            'step': state.global_step,
+            'loss': logs['loss'],
+            'tokens_per_second': tokens / elapsed,
+            'samples_per_second': samples / elapsed,
+            'seconds_per_step': elapsed / steps if steps else None,
+        }
+        print(f"步骤: {state.global_step}/{state.max_steps} | 损失: {logs['loss']:.4f} | "
+              f"{record['tokens_per_second']:.0f} tokens/秒 | {record['samples_per_second']:.2f} 样本/秒")
+        if self.log_file and state.is_world_process_zero:
+            with open(self.log_file, 'a', encoding='utf-8') as f:
+                f.write(json.dumps(record) + '\n')
+        self.last_time, self.last_step, self.last_tokens = now, state.global_step, state.num_input_tokens_seen or 0
+
+
+class GracefulStopCallback(TrainerCallback):
+    """收到SIGTERM/SIGINT后在当前步结束时保存检查点再退出，避免丢失上次保存之后的进度"""
+
+    def __init__(self):
+        self.requested = False
+        signal.signal(signal.SIGTERM, self._request)
+        signal.signal(signal.SIGINT, self._request)
+
+    def _request(self, signum, frame):
+        if self.requested:
+            raise KeyboardInterrupt
+        print("\n收到停止信号，将在当前步结束后保存检查点并退出（再次按Ctrl+C立即退出）")
+        self.requested = True
+
+    def on_step_end(self, args, state, control, **kwargs):
+        if self.requested:
+            control.should_save = True
+            control.should_training_stop = True
+
+
+def find_checkpoint(output_dir, resume):
+    """resume 为 auto 时使用输出目录中最新的检查点，none 时从头训练，否则为检查点路径"""
+    if resume == 'none':
+        return None
+    if resume == 'auto':
+        return get_last_checkpoint(output_dir) if os.path.isdir(output_dir) else None
+    return resume
+
+
+def save_run_config(config, output_dir, resuming):
+    """保存本次运行的配置；续训时提示与上次配置不同的项"""
+    os.makedirs(output_dir, exist_ok=True)
+    path = os.path.join(output_dir, RUN_CONFIG_FILE)
+    if resuming and os.path.exists(path):
+        with open(path, 'r', encoding='utf-8') as f:
+            previous = json.load(f)
+        changed = sorted(k for k in set(previous) | set(config) if previous.get(k) != config.get(k))
+        if changed:
+            print(f"警告: 续训使用的配置与上次不同: {', '.join(changed)}")
+    with open(path, 'w', encoding='utf-8') as f:
+        json.dump(config, f, ensure_ascii=False, indent=2)
+
+
+def train(config, resume='auto'):
+    """
+    按配置训练
+
+    参数:
+        config (dict): load_config 读取的配置
+        resume (str): auto（默认，从最新检查点续训）、none 或检查点路径
+
+    返回:
+        dict: 训练和验证指标
+    """
+    set_seed(config.get('seed', 42))
+    output_dir = config['output_dir']
+    checkpoint = find_checkpoint(output_dir, resume)
+    save_run_config(copy.deepcopy(config), output_dir, checkpoint is not None)
+
+    tokenizer = load_tokenizer(config)
+    pretokenized = bool(config['data'].get('pretokenized_dir'))
+    if pretokenized:
+        from pretokenize import prepare_pretokenized, print_pretokenize_report
+        train_dataset, eval_dataset, report = prepare_pretokenized(config, tokenizer)
+        print_pretokenize_report(report)
+    else:
+        dataset = build_dataset(config, tokenizer)
+        train_dataset, eval_dataset = dataset['train'], dataset['test']
+    print(f"训练集: {len(train_dataset)} 样本, 验证集: {len(eval_dataset)} 样本")
+
+    model = load_model(config, tokenizer)
+    args = build_sft_config(config, pretokenized)
+    callbacks = [ThroughputCallback(os.path.join(output_dir, 'throughput.jsonl')), GracefulStopCallback()]
+    instrumentation = config.get('instrumentation') or {}
+    if instrumentation.get('enabled'):
+        callbacks.append(InstrumentationCallback(output_dir, instrumentation.get('sync_cuda', True),
+                                                 instrumentation.get('peak_tflops'),
+                                                 instrumentation.get('tensorboard', True)))
+    data_collator = None
+    if pretokenized and config['data'].get('batching') == 'pack':
+        from packing import PackedCollator
+        data_collator = PackedCollator(tokenizer.pad_token_id, args.pad_to_multiple_of)
+    trainer = LengthAwareSFTTrainer(
+        model=model,
+        args=args,
+        data_collator=data_collator,
+        train_dataset=train_dataset,
+        eval_dataset=eval_dataset if args.eval_strategy != 'no' else None,
+        processing_class=tokenizer,
+        peft_config=build_peft_config(config, model, tokenizer),
+        callbacks=callbacks,
+    )
+    expose_output_bias(trainer.model)
+    trainer.model.print_trainable_parameters()
+
+    if checkpoint:
+        print(f"从检查点续训: {checkpoint}")
+    train_result = trainer.train(resume_from_checkpoint=checkpoint)
+    metrics = dict(train_result.metrics)
+    print(f"训练损失: {train_result.training_loss:.4f}, 步数: {train_result.global_step}, "
+          f"用时: {metrics.get('train_runtime', 0) / 60:.2f}分钟")
+
+    if callbacks[1].requested:
+        print(f"训练已中断，检查点保存在 {output_dir}，再次运行同一命令即可续训")
+        return metrics
+
+    final_dir = os.path.join(output_dir, FINAL_DIR)
+    trainer.save_model(final_dir)
+    tokenizer.save_pretrained(final_dir)
+    print(f"最终模型已保存到: {final_dir}")
+    if trainer.eval_dataset is not None:
+        metrics.update(trainer.evaluate())
+    with open(os.path.join(output_dir, 'metrics.json'), 'w', encoding='utf-8') as f:
+        json.dump(metrics, f, ensure_ascii=False, indent=2)
+    return metrics
+
+
+def main():
+    parser = argparse.ArgumentParser(description="按配置文件进行LoRA微调，支持断点续训")
+    parser.add_argument("--config", type=str, default=DEFAULT_CONFIG,
+                        help="JSON配置文件")
+    parser.add_argument("--resume", type=str, default="auto",
+                        help="auto: 从输出目录中最新的检查点续训；none: 从头训练；也可以指定检查点路径")
+    parser.add_argument("--set", type=str, nargs='*', default=[], dest="overrides",
+                        help="覆盖配置项，例如 sft.learning_rate=5e-5 lora.r=8")
+    args = parser.parse_args()
+
+    config = load_config(args.config, args.overrides)
+    train(config, args.resume)
+
+
+if __name__ == "__main__":
+    main()
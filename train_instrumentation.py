@@ -0,0 +1,279 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+训练吞吐量与显存记录
+每个优化器步把耗时拆分为前向、反向（含损失计算和梯度裁剪）、优化器更新和其他，另外记录数据加载等待时间、
+tokens/秒、MFU估计和显存占用，写入JSONL和tensorboard，训练结束时打印汇总表，
+用于比较梯度检查点、4bit NF4量化、LoRA目标模块等设置的开销
+
+在 train.py 的配置中设置:
+    "instrumentation": {"enabled": true, "sync_cuda": true, "peak_tflops": null, "tensorboard": true}
+"""
+
+import os
+import json
+import time
+import resource
+
+import numpy as np
+import torch
+from transformers import TrainerCallback
+
+try:
+    from torch.utils.tensorboard import SummaryWriter
+    TENSORBOARD_AVAILABLE = True
+except ImportError:
+    TENSORBOARD_AVAILABLE = False
+
+LOG_FILE = 'instrumentation.jsonl'
+
+# 常见GPU的bf16稠密峰值算力（TFLOPS），按设备名称中的关键字匹配，未列出的可在配置中指定 peak_tflops
+PEAK_TFLOPS = [
+    ('H100', 989.0),
+    ('H800', 989.0),
+    ('H20', 148.0),
+    ('A100', 312.0),
+    ('A800', 312.0),
+    ('L40S', 362.0),
+    ('L40', 181.0),
+    ('L20', 119.5),
+    ('A10', 125.0),
+    ('4090', 165.2),
+    ('3090', 71.0),
+    ('V100', 125.0),
+]
+
+TIMING_FIELDS = ['data_wait', 'forward', 'backward', 'optimizer', 'other']
+
+
+def detect_peak_tflops():
+    """按当前GPU名称查找峰值算力，没有GPU或不在表中时返回None"""
+    if not torch.cuda.is_available():
+        return None
+    name = torch.cuda.get_device_name()
+    for keyword, tflops in PEAK_TFLOPS:
+        if keyword in name:
+            return tflops
+    return None
+
+
+def estimate_flops_per_token(model):
+    """
+    每个训练token的浮点运算量估计：前向 2N，反向对激活求梯度 2N，对可训练参数求梯度 2T
+
+    全参数微调时为 6N；LoRA 冻结了基座权重，约为 4N + 2T。未计入注意力中与序列长度相关的部分，
+    也不计梯度检查点的重复前向（即MFU而非HFU）
+    """
+    total = sum(p.numel() for p in model.parameters())
+    trainable = sum(p.numel() for p in model.parameters() if p.requires_grad)
+    # 4bit量化的参数按打包后的元素计数，每个元素存两个权重
+    packed = sum(p.numel() for p in model.parameters() if p.dtype == torch.uint8)
+    total += packed
+    return 4 * total + 2 * trainable
+
+
+def memory_snapshot():
+    """当前和峰值显存（GPU）或进程峰值常驻内存（CPU），单位MB"""
+    if torch.cuda.is_available():
+        return {
+            'memory_allocated_mb': torch.cuda.memory_allocated() / 2 ** 20,
+            'memory_reserved_mb': torch.cuda.memory_reserved() / 2 ** 20,
+            'memory_peak_mb': torch.cuda.max_memory_allocated() / 2 ** 20,
+        }
+    # Linux上 ru_maxrss 的单位是KB
+    return {'memory_peak_mb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024}
+
+
+class InstrumentationCallback(TrainerCallback):
+    """
+    逐步记录训练耗时拆分、吞吐量和显存
+
+    前向时间由模型顶层的 forward hook 计时；反向为前向结束到下一次前向或优化器更新之间的时间；
+    数据加载等待为上一步结束（及之后的日志、保存、评估）到下一步开始之间的时间。
+    sync_cuda 为True时在每个计时点同步CUDA，拆分才准确，代价是少量吞吐量
+
+    参数:
+        output_dir (str): JSONL文件所在目录
+        sync_cuda (bool): 计时点是否调用 torch.cuda.synchronize()
+        peak_tflops (float): 单卡峰值算力，None时按GPU名称查表，仍未知时不计算MFU
+        tensorboard (bool): 是否写入tensorboard标量
+        warmup_steps (int): 汇总时跳过的前几步（编译、显存分配等一次性开销）
+    """
+
+    def __init__(self, output_dir, sync_cuda=True, peak_tflops=None, tensorboard=True, warmup_steps=1):
+        self.log_file = os.path.join(output_dir, LOG_FILE)
+        self.sync_cuda = sync_cuda and torch.cuda.is_available()
+        self.peak_tflops = peak_tflops or detect_peak_tflops()
+        self.use_tensorboard = tensorboard
+        self.warmup_steps = warmup_steps
+        self.writer = None
+        self.hooks = []
+        self.records = []
+        self.flops_per_token = None
+        self._reset_step()
+        self.data_wait = 0.0
+        self.last_event = None
+
+    def _now(self):
+        if self.sync_cuda:
+            torch.cuda.synchronize()
+        return time.perf_counter()
+
+    def _reset_step(self):
+        self.step_start = None
+        self.forward_start = None
+        self.segment_start = None
+        self.optimizer_start = None
+        self.forward_time = 0.0
+        self.backward_time = 0.0
+        self.optimizer_time = 0.0
+        self.tokens_start = 0
+
+    def _forward_pre_hook(self, module, inputs):
+        if self.step_start is None:
+            return
+        now = self._now()
+        if self.segment_start is not None:
+            self.backward_time += now - self.segment_start
+        self.forward_start = now
+
+    def _forward_hook(self, module, inputs, outputs):
+        if self.step_start is None or self.forward_start is None:
+            return
+        now = self._now()
+        self.forward_time += now - self.forward_start
+        self.forward_start = None
+        self.segment_start = now
+
+    def on_train_begin(self, args, state, control, model=None, **kwargs):
+        if model is not None:
+            self.flops_per_token = estimate_flops_per_token(model)
+            self.hooks = [model.register_forward_pre_hook(self._forward_pre_hook),
+                          model.register_forward_hook(self._forward_hook)]
+        if self.use_tensorboard and state.is_world_process_zero:
+            if TENSORBOARD_AVAILABLE:
+                self.writer = SummaryWriter(log_dir=args.logging_dir or os.path.join(args.output_dir, 'runs'))
+            else:
+                print("提示: 未安装tensorboard库，耗时记录只写入JSONL。可以通过 'pip install tensorboard' 安装。")
+        self.last_event = self._now()
+
+    def on_step_begin(self, args, state, control, **kwargs):
+        now = self._now()
+        self._reset_step()
+        self.data_wait = now - self.last_event if self.last_event is not None else 0.0
+        self.step_start = now
+        self.tokens_start = state.num_input_tokens_seen or 0
+        if torch.cuda.is_available():
+            torch.cuda.reset_peak_memory_stats()
+
+    def on_pre_optimizer_step(self, args, state, control, **kwargs):
+        if self.step_start is None:
+            return
+        now = self._now()
+        if self.segment_start is not None:
+            self.backward_time += now - self.segment_start
+            self.segment_start = None
+        self.optimizer_start = now
+
+    def on_optimizer_step(self, args, state, control, **kwargs):
+        if self.optimizer_start is not None:
+            self.optimizer_time += self._now() - self.optimizer_start
+            self.optimizer_start = None
+
+    def on_step_end(self, args, state, control, **kwargs):
+        if self.step_start is None:
+            return
+        now = self._now()
+        step_time = now - self.step_start
+        tokens = (state.num_input_tokens_seen or 0) - self.tokens_start
+        wall = step_time + self.data_wait
+        record = {
+            'step': state.global_step,
+            'step_seconds': step_time,
+            'data_wait': self.data_wait,
+            'forward': self.forward_time,
+            'backward': self.backward_time,
+            'optimizer': self.optimizer_time,
+            'other': max(step_time - self.forward_time - self.backward_time - self.optimizer_time, 0.0),
+            'tokens': tokens,
+            'tokens_per_second': tokens / wall if wall > 0 else 0.0,
+        }
+        if self.peak_tflops and self.flops_per_token:
+            # num_input_tokens_seen 已是所有进程的合计
+            achieved = self.flops_per_token * tokens / wall if wall > 0 else 0.0
+            record['mfu'] = achieved / (self.peak_tflops * 1e12 * max(args.world_size, 1))
+        record.update(memory_snapshot())
+        self.records.append(record)
+        self._write(record, state)
+        self.step_start = None
+        self.last_event = self._now()
+
+    def _mark_event(self, *args, **kwargs):
+        # 日志、保存和评估的耗时不计入数据加载等待
+        self.last_event = self._now()
+
+    on_log = on_save = on_evaluate = _mark_event
+
+    def _write(self, record, state):
+        if not state.is_world_process_zero:
+            return
+        with open(self.log_file, 'a', encoding='utf-8') as f:
+            f.write(json.dumps(record) + '\n')
+        if self.writer is not None:
+            for key, value in record.items():
+                if key != 'step':
+                    self.writer.add_scalar(f'instrumentation/{key}', value, record['step'])
+
+    def on_train_end(self, args, state, control, **kwargs):
+        for hook in self.hooks:
+            hook.remove()
+        self.hooks = []
+        if self.writer is not None:
+            self.writer.close()
+            self.writer = None
+        if state.is_world_process_zero:
+            print_instrumentation_summary(summarize(self.records, self.warmup_steps))
+
+
+def summarize(records, warmup_steps=1):
+    """汇总各步的记录：耗时各部分的均值、P90和占比，平均吞吐量、MFU和峰值显存"""
+    if len(records) > warmup_steps:
+        records = records[warmup_steps:]
+    if not records:
+        return None
+    wall = np.asarray([r['step_seconds'] + r['data_wait'] for r in records])
+    summary = {'steps': len(records), 'wall_seconds': float(wall.sum()), 'timings': {}}
+    for field in TIMING_FIELDS:
+        values = np.asarray([r[field] for r in records])
+        summary['timings'][field] = {
+            'mean': float(values.mean()),
+            'p90': float(np.percentile(values, 90)),
+            'share': float(values.sum() / wall.sum()) if wall.sum() > 0 else 0.0,
+        }
+    tokens = sum(r['tokens'] for r in records)
+    summary['tokens_per_second'] = tokens / wall.sum() if wall.sum() > 0 else 0.0
+    if all('mfu' in r for r in records):
+        summary['mfu'] = float(np.average([r['mfu'] for r in records], weights=wall))
+    summary['memory_peak_mb'] = max(r['memory_peak_mb'] for r in records)
+    if 'memory_allocated_mb' in records[0]:
+        summary['memory_allocated_mb'] = float(np.mean([r['memory_allocated_mb'] for r in records]))
+    return summary
+
+
+def print_instrumentation_summary(summary):
+    """打印训练耗时拆分汇总表"""
+    if summary is None:
+        return
+    print("\n========== 训练耗时拆分 ==========")
+    print(f"统计步数: {summary['steps']}, 总耗时: {summary['wall_seconds']:.1f}秒")
+    print(f"{'阶段':<12}{'平均(秒)':>10}{'P90(秒)':>10}{'占比':>8}")
+    for field in TIMING_FIELDS:
+        timing = summary['timings'][field]
+        print(f"{field:<12}{timing['mean']:>10.3f}{timing['p90']:>10.3f}{timing['share'] * 100:>7.1f}%")
+    print(f"tokens/秒: {summary['tokens_per_second']:.1f}")
+    if 'mfu' in summary:
+        print(f"MFU估计: {summary['mfu'] * 100:.1f}%")
+    memory = f"峰值内存: {summary['memory_peak_mb']:.0f}MB"
+    if 'memory_allocated_mb' in summary:
+        memory += f", 平均已分配显存: {summary['memory_allocated_mb']:.0f}MB"
+    print(memory)
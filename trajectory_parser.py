@@ -0,0 +1,173 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+活动轨迹文本解析
+将 model_response 中的结构化文本（见 get_qwen_output.system_message 的输出格式）
+解析为人物画像字典和逐条出行/活动记录
+"""
+
+import re
+
+PERSONA_FIELDS = ['陆家嘴活动人群画像', '年龄', '性别', '家庭结构', '个人月收入', '家庭可支配收入', '交通工具保有情况']
+EVALUATION_FIELDS = ['工作效率', '休闲满意度', '交通便利度', '社交互动']
+
+SEGMENT_TRIP = 'trip'
+SEGMENT_ACTIVITY = 'activity'
+
+FIELD_LINE = re.compile(r'^\s*\[([^\]]+)\]\s*[:：]\s*(.*)$')
+TRIP_HEADER = re.compile(r'出行ID\s*[:：]\s*(\d+).*?出行方式\s*[:：]\s*(.+)$')
+ACTIVITY_HEADER = re.compile(r'活动ID\s*[:：]\s*(\d+).*?活动类型\s*[:：]\s*(.+)$')
+TIME_RANGE = re.compile(r'(\d{1,2})[:：](\d{2})(?:[:：](\d{2}))?\s*[-–—~至]\s*(\d{1,2})[:：](\d{2})(?:[:：](\d{2}))?')
+COORDINATE = re.compile(r'(\d{2,3}\.\d+)\s*[,，]\s*(\d{1,2}\.\d+)')
+NUMBER = r'\(?\s*(\d+(?:\.\d+)?)\s*\)?'
+TRIP_MINUTES = re.compile(r'出行时耗\s*' + NUMBER + r'\s*分钟')
+ACTIVITY_MINUTES = re.compile(r'累计\s*' + NUMBER + r'\s*分钟')
+DISTANCE = re.compile(r'直线距离\s*' + NUMBER + r'\s*米')
+PLACE = re.compile(r'名称为\s*\(?([^,，()（）]*)\)?\s*[,，]\s*类型为\s*\(?([^,，()（）]*)\)?')
+SCORE = re.compile(r'(\d+(?:\.\d+)?)\s*分')
+
+
+def clean_value(value):
+    """去掉模板占位符两侧的括号和空白"""
+    value = value.strip()
+    if len(value) >= 2 and value[0] in '(（' and value[-1] in ')）':
+        value = value[1:-1].strip()
+    return value
+
+
+def parse_minutes(hours, minutes, seconds=None):
+    """HH:MM[:SS] 转换为当天零点起的分钟数"""
+    return int(hours) * 60 + int(minutes) + (int(seconds) / 60 if seconds else 0)
+
+
+def parse_time_range(text):
+    """解析时段，返回 (开始分钟, 结束分钟)；跨午夜时结束时间加一天"""
+    match = TIME_RANGE.search(text)
+    if not match:
+        return None, None
+    start = parse_minutes(*match.group(1, 2, 3))
+    end = parse_minutes(*match.group(4, 5, 6))
+    if end < start and start >= 18 * 60:
+        end += 24 * 60
+    return start, end
+
+
+def parse_coordinates(text):
+    """返回文本中所有 (经度, 纬度)"""
+    return [(float(lon), float(lat)) for lon, lat in COORDINATE.findall(text)]
+
+
+def _new_segment(kind, seq, label):
+    return {
+        'kind': kind,
+        'seq': seq,
+        'type': label,       # 活动类型；出行记录为出行目的
+        'mode': None,        # 出行方式，仅出行记录
+        'start': None,       # 开始时间（分钟）
+        'end': None,         # 结束时间（分钟）
+        'stated_minutes': None,
+        'lon': None,         # 活动地点或出行终点
+        'lat': None,
+        'origin_lon': None,  # 出行起点，仅出行记录
+        'origin_lat': None,
+        'distance': None,
+        'place_name': None,
+        'place_type': None,
+    }
+
+
+def parse_trajectory(text):
+    """
+    解析一条活动轨迹文本
+
+    参数:
+        text (str): model_response 文本
+
+    返回:
+        dict: persona（画像字段）、segments（按出现顺序的出行/活动记录）、
+              evaluation（主观评分）、ingress/egress（进出陆家嘴前后的坐标）、sections（出现的一级标题数）
+    """
+    result = {'persona': {}, 'segments': [], 'evaluation': {}, 'ingress': None, 'egress': None, 'sections': 0}
+    if not text:
+        return result
+
+    current = None
+    in_persona = False
+    for raw_line in text.splitlines():
+        line = raw_line.strip().strip('*')
+        if not line:
+            continue
+
+        if line.startswith('# ') or line.startswith('#\t'):
+            result['sections'] += 1
+            in_persona = '基本信息' in line
+            current = None
+            continue
+        if line.startswith('---'):
+            in_persona = False
+            continue
+
+        if line.startswith('##'):
+            in_persona = False
+            trip = TRIP_HEADER.search(line)
+            activity = ACTIVITY_HEADER.search(line)
+            if trip:
+                current = _new_segment(SEGMENT_TRIP, int(trip.group(1)), None)
+                current['mode'] = clean_value(trip.group(2))
+                result['segments'].append(current)
+            elif activity:
+                current = _new_segment(SEGMENT_ACTIVITY, int(activity.group(1)), clean_value(activity.group(2)))
+                result['segments'].append(current)
+            else:
+                current = None
+            continue
+
+        # [Ingress Phase]/[Egress Phase] 行的标签后没有冒号，单独处理
+        if 'Ingress' in line or 'Egress' in line:
+            coords = parse_coordinates(line)
+            result['ingress' if 'Ingress' in line else 'egress'] = coords[0] if coords else None
+            continue
+
+        field = FIELD_LINE.match(line)
+        if not field:
+            continue
+        name, value = field.group(1).strip(), field.group(2)
+
+        if in_persona:
+            result['persona'][name] = clean_value(value)
+        elif name in EVALUATION_FIELDS:
+            score = SCORE.search(value)
+            result['evaluation'][name] = float(score.group(1)) if score else None
+        elif current is not None:
+            _parse_segment_field(current, name, value)
+
+    return result
+
+
+def _parse_segment_field(segment, name, value):
+    """填充出行/活动记录的字段"""
+    if name == '时段':
+        segment['start'], segment['end'] = parse_time_range(value)
+        minutes = (TRIP_MINUTES if segment['kind'] == SEGMENT_TRIP else ACTIVITY_MINUTES).search(value)
+        if minutes:
+            segment['stated_minutes'] = float(minutes.group(1))
+    elif name == '起点终点':
+        coords = parse_coordinates(value)
+        if len(coords) >= 1:
+            segment['origin_lon'], segment['origin_lat'] = coords[0]
+        if len(coords) >= 2:
+            segment['lon'], segment['lat'] = coords[1]
+    elif name == '距离':
+        distance = DISTANCE.search(value)
+        if distance:
+            segment['distance'] = float(distance.group(1))
+    elif name == '出行目的':
+        segment['type'] = clean_value(value)
+    elif name == '地点':
+        place = PLACE.search(value)
+        if place:
+            segment['place_name'] = place.group(1).strip()
+            segment['place_type'] = place.group(2).strip()
+        coords = parse_coordinates(value)
+        if coords:
+            segment['lon'], segment['lat'] = coords[-1]
@@ -0,0 +1,353 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+列式轨迹存储
+将 get_qwen_output.py / finetuned_inference.py 生成的对话JSON只解析一次，写成两张Parquet表：
+    persons     每人一行（画像字段、主观评分、进出陆家嘴坐标等）
+    activities  每条出行/活动记录一行（开始、结束、活动类型、出行方式、经纬度等）
+之后的分析和检查通过内存映射直接读取列数据，不必再反复解析 model_response 文本
+"""
+
+import os
+import re
+import json
+import time
+import argparse
+from multiprocessing import Pool
+
+import numpy as np
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.parquet as pq
+
+from trajectory_parser import EVALUATION_FIELDS, PERSONA_FIELDS, SEGMENT_ACTIVITY, parse_trajectory
+
+PERSONS_DIR = 'persons'
+ACTIVITIES_DIR = 'activities'
+
+# 画像字段与评分字段对应的英文列名
+PERSONA_COLUMNS = {
+    '陆家嘴活动人群画像': 'persona_type',
+    '年龄': 'age',
+    '性别': 'gender',
+    '家庭结构': 'family_structure',
+    '个人月收入': 'monthly_income',
+    '家庭可支配收入': 'household_income',
+    '交通工具保有情况': 'vehicles',
+}
+EVALUATION_COLUMNS = {
+    '工作效率': 'eval_work_efficiency',
+    '休闲满意度': 'eval_leisure',
+    '交通便利度': 'eval_transport',
+    '社交互动': 'eval_social',
+}
+NUMERIC_PERSONA = {'age', 'monthly_income', 'household_income'}
+
+PERSONS_SCHEMA = pa.schema([
+    ('person_id', pa.int64()),
+    ('source_dir', pa.dictionary(pa.int32(), pa.string())),
+    ('file', pa.string()),
+    ('record_id', pa.string()),
+    ('model', pa.dictionary(pa.int32(), pa.string())),
+    ('user_prompt', pa.dictionary(pa.int32(), pa.string())),
+    ('timestamp', pa.string()),
+    ('generation_time', pa.float32()),
+    ('persona_type', pa.dictionary(pa.int32(), pa.string())),
+    ('age', pa.float32()),
+    ('gender', pa.dictionary(pa.int32(), pa.string())),
+    ('family_structure', pa.dictionary(pa.int32(), pa.string())),
+    ('monthly_income', pa.float64()),
+    ('household_income', pa.float64()),
+    ('vehicles', pa.string()),
+    ('eval_work_efficiency', pa.float32()),
+    ('eval_leisure', pa.float32()),
+    ('eval_transport', pa.float32()),
+    ('eval_social', pa.float32()),
+    ('ingress_lon', pa.float64()),
+    ('ingress_lat', pa.float64()),
+    ('egress_lon', pa.float64()),
+    ('egress_lat', pa.float64()),
+    ('persona_fields', pa.int8()),
+    ('evaluation_fields', pa.int8()),
+    ('n_trips', pa.int16()),
+    ('n_activities', pa.int16()),
+    ('valid', pa.bool_()),
+])
+
+ACTIVITIES_SCHEMA = pa.schema([
+    ('person_id', pa.int64()),
+    ('kind', pa.dictionary(pa.int8(), pa.string())),
+    ('seq', pa.int16()),
+    ('type', pa.dictionary(pa.int32(), pa.string())),
+    ('mode', pa.dictionary(pa.int32(), pa.string())),
+    ('start', pa.float32()),
+    ('end', pa.float32()),
+    ('stated_minutes', pa.float32()),
+    ('lon', pa.float64()),
+    ('lat', pa.float64()),
+    ('origin_lon', pa.float64()),
+    ('origin_lat', pa.float64()),
+    ('distance', pa.float32()),
+    ('place_name', pa.dictionary(pa.int32(), pa.string())),
+    ('place_type', pa.dictionary(pa.int32(), pa.string())),
+])
+
+FIRST_NUMBER = re.compile(r'\d+(?:\.\d+)?')
+
+
+def parse_number(value):
+    """提取字符串中的第一个数字，如 '32岁' -> 32.0"""
+    if not value:
+        return None
+    match = FIRST_NUMBER.search(value.replace(',', ''))
+    return float(match.group()) if match else None
+
+
+def list_dialogue_files(input_dirs):
+    """列出输入目录中的对话JSON文件，返回 [(source_dir, file_name)]"""
+    files = []
+    for input_dir in input_dirs:
+        if not os.path.isdir(input_dir):
+            print(f"Warning: {input_dir} does not exist, skipping")
+            continue
+        for file_name in sorted(os.listdir(input_dir)):
+            if file_name.endswith('.json'):
+                files.append((os.path.abspath(input_dir), file_name))
+    return files
+
+
+def load_and_parse(source):
+    """读取并解析一个对话文件（在子进程中执行）；不是对话文件时返回None"""
+    source_dir, file_name = source
+    try:
+        with open(os.path.join(source_dir, file_name), 'r', encoding='utf-8') as f:
+            data = json.load(f)
+    except (OSError, json.JSONDecodeError):
+        return None
+    if not isinstance(data, dict) or 'model_response' not in data:
+        return None
+
+    response = data.get('model_response') or ''
+    parsed = parse_trajectory(response)
+    usage = data.get('usage') or {}
+    person = {
+        'source_dir': source_dir,
+        'file': file_name,
+        'record_id': None if data.get('id') is None else str(data.get('id')),
+        'model': data.get('model') or usage.get('model'),
+        'user_prompt': data.get('user_prompt'),
+        'timestamp': data.get('timestamp'),
+        'generation_time': data.get('generation_time'),
+        'valid': bool(response) and not response.startswith('Error:'),
+    }
+    for field, column in PERSONA_COLUMNS.items():
+        value = parsed['persona'].get(field) or None
+        person[column] = parse_number(value) if column in NUMERIC_PERSONA else value
+    for field, column in EVALUATION_COLUMNS.items():
+        person[column] = parsed['evaluation'].get(field)
+    for name in ('ingress', 'egress'):
+        point = parsed[name] or (None, None)
+        person[f'{name}_lon'], person[f'{name}_lat'] = point
+    person['persona_fields'] = sum(1 for f in PERSONA_FIELDS if parsed['persona'].get(f))
+    person['evaluation_fields'] = sum(1 for f in EVALUATION_FIELDS if parsed['evaluation'].get(f) is not None)
+    person['n_activities'] = sum(1 for s in parsed['segments'] if s['kind'] == SEGMENT_ACTIVITY)
+    person['n_trips'] = len(parsed['segments']) - person['n_activities']
+    return person, parsed['segments']
+
+
+def _parts(directory):
+    """目录中已完成的分片文件名"""
+    if not os.path.isdir(directory):
+        return set()
+    return {f for f in os.listdir(directory) if f.startswith('part-') and f.endswith('.parquet')}
+
+
+def _next_part(directory):
+    """返回目录中下一个分片文件的路径"""
+    os.makedirs(directory, exist_ok=True)
+    return os.path.join(directory, f"part-{len(_parts(directory)):05d}.parquet")
+
+
+def _temp_path(path):
+    """分片写入时的临时路径（以.开头，读取目录时被忽略）"""
+    directory, name = os.path.split(path)
+    return os.path.join(directory, f".{name}.tmp")
+
+
+def recover_parts(store_dir):
+    """
+    清理上次中断的写入：删除临时文件，以及只在 persons 或 activities 一张表中存在的分片
+    （否则这些人会被当作已入库而永远跳过，或残留的活动记录与新分配的 person_id 错配）
+
+    返回:
+        int: 被删除的人员分片中最大的 person_id 加1（没有时为0）。重新入库时 person_id 从这里之后分配，
+             不复用 OccupancyCube 的水位线已经越过的编号
+    """
+    dirs = [os.path.join(store_dir, PERSONS_DIR), os.path.join(store_dir, ACTIVITIES_DIR)]
+    for directory in dirs:
+        if os.path.isdir(directory):
+            for name in os.listdir(directory):
+                if name.startswith('.part-') and name.endswith('.tmp'):
+                    os.remove(os.path.join(directory, name))
+    persons, activities = (_parts(directory) for directory in dirs)
+    min_next_id = 0
+    for directory, orphans in ((dirs[0], persons - activities), (dirs[1], activities - persons)):
+        for name in sorted(orphans):
+            path = os.path.join(directory, name)
+            if directory == dirs[0]:
+                ids = pq.read_table(path, columns=['person_id'])['person_id']
+                if len(ids):
+                    min_next_id = max(min_next_id, int(pc.max(ids).as_py()) + 1)
+            print(f"Removing orphaned part {path} left by an interrupted ingest")
+            os.remove(path)
+    return min_next_id
+
+
+def _table(rows, schema):
+    """将字典列表按schema转换为Arrow表"""
+    columns = {field.name: [row.get(field.name) for row in rows] for field in schema}
+    arrays = []
+    for field in schema:
+        values = columns[field.name]
+        if pa.types.is_dictionary(field.type):
+            arrays.append(pa.array(values, type=pa.string()).dictionary_encode().cast(field.type))
+        else:
+            arrays.append(pa.array(values, type=field.type))
+    return pa.Table.from_arrays(arrays, schema=schema)
+
+
+def load_tables(store_dir, person_columns=None, activity_columns=None):
+    """以内存映射方式读取两张表，可只读取需要的列"""
+    persons = pq.read_table(os.path.join(store_dir, PERSONS_DIR), columns=person_columns, memory_map=True)
+    activities = pq.read_table(os.path.join(store_dir, ACTIVITIES_DIR), columns=activity_columns, memory_map=True)
+    return persons, activities
+
+
+def stored_files(store_dir):
+    """返回已入库的 (source_dir, file) 集合及下一个可用的 person_id"""
+    if not os.path.isdir(os.path.join(store_dir, PERSONS_DIR)):
+        return set(), 0
+    persons = pq.read_table(os.path.join(store_dir, PERSONS_DIR),
+                            columns=['person_id', 'source_dir', 'file'], memory_map=True)
+    if persons.num_rows == 0:
+        return set(), 0
+    keys = set(zip(persons['source_dir'].to_pylist(), persons['file'].to_pylist()))
+    return keys, int(pc.max(persons['person_id']).as_py()) + 1
+
+
+def ingest(input_dirs, store_dir, workers=None, chunk_size=20000):
+    """
+    增量解析对话文件并写入列式存储；已入库的文件会被跳过
+
+    参数:
+        input_dirs (list): 对话JSON所在目录列表
+        store_dir (str): 存储目录
+        workers (int): 解析进程数，默认等于CPU核数
+        chunk_size (int): 每个Parquet分片包含的最多人数
+
+    返回:
+        dict: 新增人数、活动记录数和耗时
+    """
+    start_time = time.time()
+    min_next_id = recover_parts(store_dir)
+    known, next_id = stored_files(store_dir)
+    next_id = max(next_id, min_next_id)
+    sources = [s for s in list_dialogue_files(input_dirs) if s not in known]
+    print(f"Found {len(sources)} new dialogue files ({len(known)} already stored)")
+
+    stats = {'persons': 0, 'activities': 0}
+    persons, activities = [], []
+
+    def write_chunk():
+        if not persons:
+            return
+        # 两张表的分片先写临时文件，都写完后再改名；先改名活动分片，
+        # 因为人员分片决定文件是否已入库，中断时最多留下一个没有人员的活动分片，下次启动时清理
+        persons_path = _next_part(os.path.join(store_dir, PERSONS_DIR))
+        activities_path = _next_part(os.path.join(store_dir, ACTIVITIES_DIR))
+        pq.write_table(_table(persons, PERSONS_SCHEMA), _temp_path(persons_path))
+        pq.write_table(_table(activities, ACTIVITIES_SCHEMA), _temp_path(activities_path))
+        os.replace(_temp_path(activities_path), activities_path)
+        os.replace(_temp_path(persons_path), persons_path)
+        stats['persons'] += len(persons)
+        stats['activities'] += len(activities)
+        print(f"Wrote {stats['persons']} persons, {stats['activities']} activity rows")
+        persons.clear()
+        activities.clear()
+
+    with Pool(processes=workers) as pool:
+        for item in pool.imap(load_and_parse, sources, chunksize=64):
+            if item is None:
+                continue
+            person, segments = item
+            person['person_id'] = next_id
+            persons.append(person)
+            for segment in segments:
+                row = dict(segment)
+                row['person_id'] = next_id
+                activities.append(row)
+            next_id += 1
+            if len(persons) >= chunk_size:
+                write_chunk()
+    write_chunk()
+
+    stats['elapsed'] = time.time() - start_time
+    return stats
+
+
+def to_segment_table(persons, activities):
+    """
+    将列式存储转换为 rule_checks.build_segment_table 的数组格式
+
+    返回:
+        tuple: (table, persona_fields, evaluation_fields)，轨迹下标按 persons 的行顺序
+    """
+    person_ids = persons['person_id'].to_numpy()
+    order = np.argsort(person_ids, kind='stable')
+    traj = order[np.searchsorted(person_ids, activities['person_id'].to_numpy(), sorter=order)]
+
+    def column(name):
+        return activities[name].to_numpy(zero_copy_only=False).astype(np.float64)
+
+    # 各分片的字典编码不同，先转换为普通字符串再合并
+    kind = activities['kind'].cast(pa.string())
+    place = pc.fill_null(activities['place_name'].cast(pa.string()), '').combine_chunks()
+    table = {
+        'traj': traj.astype(np.int64),
+        'is_activity': pc.equal(kind, SEGMENT_ACTIVITY).to_numpy(zero_copy_only=False),
+        'start': column('start'),
+        'end': column('end'),
+        'stated': column('stated_minutes'),
+        'lon': column('lon'),
+        'lat': column('lat'),
+        'place': place.dictionary_encode().indices.to_numpy().astype(np.int64),
+    }
+    persona = persons['persona_fields'].to_numpy().astype(np.float64)
+    evaluation = persons['evaluation_fields'].to_numpy().astype(np.float64)
+    return table, persona, evaluation
+
+
+def main():
+    parser = argparse.ArgumentParser(description="将生成的轨迹对话解析为Parquet列式存储")
+    parser.add_argument("--input_dirs", type=str, nargs='+', default=["/root/for_eval"],
+                        help="对话JSON文件所在目录，可指定多个")
+    parser.add_argument("--store_dir", type=str, default="/root/trajectory_store",
+                        help="Parquet存储目录")
+    parser.add_argument("--workers", type=int, default=None,
+                        help="解析进程数，默认等于CPU核数")
+    parser.add_argument("--chunk_size", type=int, default=20000,
+                        help="每个Parquet分片包含的最多人数")
+    args = parser.parse_args()
+
+    stats = ingest(args.input_dirs, args.store_dir, args.workers, args.chunk_size)
+    print(f"\n新增 {stats['persons']} 人、{stats['activities']} 条出行/活动记录，用时 {stats['elapsed']:.2f} 秒")
+
+    if not os.path.isdir(os.path.join(args.store_dir, PERSONS_DIR)):
+        return
+    start_time = time.time()
+    persons, activities = load_tables(args.store_dir)
+    print(f"存储中共有 {persons.num_rows} 人、{activities.num_rows} 条记录，内存映射读取用时 {time.time() - start_time:.3f} 秒")
+
+
+if __name__ == "__main__":
+    main()
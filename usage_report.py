@@ -0,0 +1,295 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Token用量与成本统计脚本
+从生成的对话JSON文件和评估结果CSV中读取每次请求的usage信息，
+汇总 tokens/秒、每条有效轨迹的token数、每千条轨迹成本和缓存前缀命中占比
+
+tokens/秒按忙碌时间（各请求 [开始, 结束] 区间合并后的总长，不含多次运行之间的空闲）计算，
+反映并发时的实际吞吐；
+单请求输出速度按各请求耗时之和计算，只反映单个请求的解码速度
+"""
+
+import os
+import csv
+import json
+import sqlite3
+import argparse
+from datetime import datetime
+
+# 每百万token价格（元），可通过命令行覆盖
+# 键为模型名称，值为 (输入价格, 缓存命中输入价格, 输出价格)
+MODEL_PRICING = {
+    "qwen2.5-7b-instruct": (0.5, 0.2, 1.0),
+    "gpt-4o-mini-2024-07-18": (1.08, 0.54, 4.32),
+}
+DEFAULT_PRICING = (1.0, 0.5, 2.0)
+
+USAGE_FIELDS = ['prompt_tokens', 'completion_tokens', 'total_tokens', 'cached_tokens', 'latency']
+
+
+def empty_usage(model=None):
+    """返回一条空的usage记录"""
+    usage = {field: 0 for field in USAGE_FIELDS}
+    usage['latency'] = 0.0
+    usage['model'] = model
+    usage['attempts'] = 0
+    return usage
+
+
+def extract_usage(response_json):
+    """
+    从OpenAI兼容接口的响应中提取usage信息
+
+    参数:
+        response_json (dict): 接口返回的JSON
+
+    返回:
+        dict: prompt_tokens / completion_tokens / total_tokens / cached_tokens
+    """
+    usage = response_json.get('usage') or {}
+    prompt_tokens = int(usage.get('prompt_tokens') or usage.get('input_tokens') or 0)
+    completion_tokens = int(usage.get('completion_tokens') or usage.get('output_tokens') or 0)
+    total_tokens = int(usage.get('total_tokens') or prompt_tokens + completion_tokens)
+
+    # 缓存命中的前缀token：OpenAI格式在prompt_tokens_details中，部分兼容接口使用prompt_cache_hit_tokens
+    details = usage.get('prompt_tokens_details') or {}
+    cached_tokens = int(details.get('cached_tokens') or usage.get('prompt_cache_hit_tokens') or 0)
+
+    return {
+        'prompt_tokens': prompt_tokens,
+        'completion_tokens': completion_tokens,
+        'total_tokens': total_tokens,
+        'cached_tokens': cached_tokens,
+    }
+
+
+def get_pricing(model, overrides=None):
+    """获取模型价格，未知模型使用默认价格"""
+    if overrides is not None:
+        return overrides
+    return MODEL_PRICING.get(model, DEFAULT_PRICING)
+
+
+def estimate_cost(usage, pricing):
+    """按每百万token价格估算单次请求成本"""
+    input_price, cached_price, output_price = pricing
+    cached = usage.get('cached_tokens', 0)
+    uncached = max(usage.get('prompt_tokens', 0) - cached, 0)
+    completion = usage.get('completion_tokens', 0)
+    return (uncached * input_price + cached * cached_price + completion * output_price) / 1e6
+
+
+def _to_number(value, cast=int):
+    """将CSV中的字符串转换为数字，空值返回0"""
+    try:
+        return cast(value)
+    except (TypeError, ValueError):
+        return cast(0)
+
+
+def _parse_timestamp(value):
+    """对话文件中的 timestamp（请求开始时间）转换为秒，无法解析时返回None"""
+    try:
+        return datetime.strptime(value, "%Y-%m-%d %H:%M:%S").timestamp()
+    except (TypeError, ValueError):
+        return None
+
+
+def load_generation_usage(dialogue_dir):
+    """读取对话目录中每个JSON文件的usage字段"""
+    records = []
+    if not os.path.isdir(dialogue_dir):
+        return records
+
+    for file_name in sorted(os.listdir(dialogue_dir)):
+        if not file_name.endswith('.json'):
+            continue
+        try:
+            with open(os.path.join(dialogue_dir, file_name), 'r', encoding='utf-8') as f:
+                data = json.load(f)
+        except (OSError, json.JSONDecodeError):
+            continue
+        if not isinstance(data, dict) or 'model_response' not in data:
+            continue
+
+        usage = data.get('usage') or {}
+        response = data.get('model_response') or ''
+        latency = _to_number(usage.get('latency', data.get('generation_time')), float)
+        start = _parse_timestamp(data.get('timestamp'))
+        records.append({
+            'id': data.get('id'),
+            'model': usage.get('model') or data.get('model'),
+            'prompt_tokens': _to_number(usage.get('prompt_tokens')),
+            'completion_tokens': _to_number(usage.get('completion_tokens')),
+            'cached_tokens': _to_number(usage.get('cached_tokens')),
+            'latency': latency,
+            'start': start,
+            'end': start + latency if start is not None else None,
+            'valid': bool(response) and not response.startswith('Error:'),
+        })
+    return records
+
+
+def load_judge_times(results_db):
+    """从评估结果库读取每个文件的完成时间 {文件名: created_at}，结果库不存在时返回空字典"""
+    if not results_db or not os.path.isfile(results_db):
+        return {}
+    conn = sqlite3.connect(results_db)
+    try:
+        return {row[0]: row[1] for row in conn.execute("SELECT file, created_at FROM results")}
+    except sqlite3.Error:
+        return {}
+    finally:
+        conn.close()
+
+
+def load_judge_usage(result_csv, results_db=None):
+    """读取评估结果CSV中的usage列；提供结果库时从中读取完成时间，用于计算墙钟吞吐"""
+    records = []
+    if not os.path.isfile(result_csv):
+        return records
+
+    finished = load_judge_times(results_db)
+    with open(result_csv, 'r', newline='', encoding='utf-8') as f:
+        for row in csv.DictReader(f):
+            latency = _to_number(row.get('latency'), float)
+            end = finished.get(row.get('file'))
+            records.append({
+                'id': row.get('id'),
+                'model': row.get('judge_model'),
+                'prompt_tokens': _to_number(row.get('prompt_tokens')),
+                'completion_tokens': _to_number(row.get('completion_tokens')),
+                'cached_tokens': _to_number(row.get('cached_tokens')),
+                'rubric_tokens': _to_number(row.get('rubric_tokens_est')),
+                'latency': latency,
+                'start': end - latency if end is not None else None,
+                'end': end,
+            })
+    return records
+
+
+def busy_seconds(intervals):
+    """合并重叠的 (开始, 结束) 区间，返回总长度：并发请求只算一次，两次运行之间的空闲不计入"""
+    total = 0.0
+    current_start = current_end = None
+    for start, end in sorted(intervals):
+        if current_end is None or start > current_end:
+            if current_end is not None:
+                total += current_end - current_start
+            current_start, current_end = start, end
+        else:
+            current_end = max(current_end, end)
+    if current_end is not None:
+        total += current_end - current_start
+    return total
+
+
+def summarize_stage(records, pricing_overrides=None):
+    """汇总某一阶段（生成或评估）的token用量和成本"""
+    summary = {
+        'requests': len(records),
+        'with_usage': 0,
+        'prompt_tokens': 0,
+        'completion_tokens': 0,
+        'cached_tokens': 0,
+        'rubric_tokens': 0,
+        'latency': 0.0,
+        'cost': 0.0,
+    }
+    for record in records:
+        if record['prompt_tokens'] or record['completion_tokens']:
+            summary['with_usage'] += 1
+        summary['prompt_tokens'] += record['prompt_tokens']
+        summary['completion_tokens'] += record['completion_tokens']
+        summary['cached_tokens'] += record['cached_tokens']
+        summary['rubric_tokens'] += record.get('rubric_tokens', 0)
+        summary['latency'] += record['latency']
+        summary['cost'] += estimate_cost(record, get_pricing(record.get('model'), pricing_overrides))
+
+    summary['total_tokens'] = summary['prompt_tokens'] + summary['completion_tokens']
+    # 忙碌时间：并发请求的耗时互相重叠，不能用各请求耗时之和；只统计有请求时间的记录
+    timed = [r for r in records if r.get('start') is not None and r.get('end') is not None]
+    busy = busy_seconds([(r['start'], r['end']) for r in timed])
+    timed_completion = sum(r['completion_tokens'] for r in timed)
+    timed_total = timed_completion + sum(r['prompt_tokens'] for r in timed)
+    summary['busy_seconds'] = busy
+    summary['completion_tokens_per_sec'] = timed_completion / busy if busy > 0 else 0.0
+    summary['total_tokens_per_sec'] = timed_total / busy if busy > 0 else 0.0
+    latency = summary['latency']
+    summary['per_request_completion_tokens_per_sec'] = summary['completion_tokens'] / latency if latency > 0 else 0.0
+    prompt = summary['prompt_tokens']
+    summary['cached_prefix_share'] = summary['cached_tokens'] / prompt if prompt > 0 else 0.0
+    summary['rubric_share'] = summary['rubric_tokens'] / prompt if prompt > 0 else 0.0
+    return summary
+
+
+def build_report(dialogue_dir, result_csv, pricing_overrides=None, results_db=None):
+    """生成完整的用量报告"""
+    generation = load_generation_usage(dialogue_dir)
+    judge = load_judge_usage(result_csv, results_db)
+
+    report = {
+        'generation': summarize_stage(generation, pricing_overrides),
+        'judge': summarize_stage(judge, pricing_overrides),
+    }
+
+    valid = sum(1 for record in generation if record['valid'])
+    total_tokens = report['generation']['total_tokens'] + report['judge']['total_tokens']
+    total_cost = report['generation']['cost'] + report['judge']['cost']
+    report['valid_trajectories'] = valid
+    report['tokens_per_valid_trajectory'] = total_tokens / valid if valid else 0.0
+    report['cost_per_1k_trajectories'] = total_cost / valid * 1000 if valid else 0.0
+    return report
+
+
+def print_report(report):
+    """打印用量报告"""
+    print("\n========== Token用量与成本报告 ==========")
+    for stage, title in (('generation', '生成'), ('judge', '评估')):
+        s = report[stage]
+        print(f"\n[{title}] 请求数: {s['requests']} (含usage: {s['with_usage']})")
+        print(f"  输入tokens: {s['prompt_tokens']}, 输出tokens: {s['completion_tokens']}, 合计: {s['total_tokens']}")
+        if s['busy_seconds'] > 0:
+            print(f"  忙碌 {s['busy_seconds']:.1f} 秒, 输出吞吐: {s['completion_tokens_per_sec']:.2f} tokens/秒, "
+                  f"总吞吐: {s['total_tokens_per_sec']:.2f} tokens/秒")
+        else:
+            print("  缺少请求时间，无法计算吞吐")
+        print(f"  单请求输出速度: {s['per_request_completion_tokens_per_sec']:.2f} tokens/秒")
+        print(f"  缓存前缀命中占比: {s['cached_prefix_share'] * 100:.1f}%")
+        if stage == 'judge':
+            print(f"  评估提示词(rubric)占输入比例(估算): {s['rubric_share'] * 100:.1f}%")
+        print(f"  估算成本: {s['cost']:.4f} 元")
+
+    print(f"\n有效轨迹数: {report['valid_trajectories']}")
+    print(f"每条有效轨迹tokens: {report['tokens_per_valid_trajectory']:.1f}")
+    print(f"每千条轨迹成本: {report['cost_per_1k_trajectories']:.4f} 元")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="统计生成与评估阶段的token用量和成本")
+    parser.add_argument("--dialogue_dir", type=str, default="/root/for_eval",
+                        help="对话JSON文件所在目录")
+    parser.add_argument("--result_csv", type=str, default="/root/for_eval/result.csv",
+                        help="评估结果CSV文件")
+    parser.add_argument("--results_db", type=str, default="/root/for_eval/results.db",
+                        help="评估结果库，用于读取评估请求的完成时间（计算墙钟吞吐）")
+    parser.add_argument("--price", type=float, nargs=3, default=None,
+                        metavar=("INPUT", "CACHED", "OUTPUT"),
+                        help="覆盖每百万token价格（输入 缓存命中输入 输出）")
+    parser.add_argument("--json", type=str, default=None,
+                        help="将报告另存为JSON文件")
+    args = parser.parse_args()
+
+    pricing = tuple(args.price) if args.price else None
+    report = build_report(args.dialogue_dir, args.result_csv, pricing, args.results_db)
+    print_report(report)
+
+    if args.json:
+        with open(args.json, 'w', encoding='utf-8') as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+        print(f"\n报告已保存到: {args.json}")
+
+
+if __name__ == "__main__":
+    main()